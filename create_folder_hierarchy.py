@@ -1,8 +1,11 @@
-from pymongo import MongoClient
+import argparse
+
+from pymongo import MongoClient, UpdateOne, DeleteMany
 
 
 database_name = "MODAL_data"  # Replace with your database name
 collection_name = "collection_name"  # Replace with your collection name
+write_batch_size = 10000  # Number of folder upserts sent per bulk_write
 
 
 # Connect to MongoDB
@@ -10,32 +13,159 @@ client = MongoClient("mongodb://localhost:27017/")  # Adjust if necessary
 db = client[database_name]
 collection = db[collection_name]
 
-def create_folder_records():
-    all_docs = list(collection.find())
-    all_folder_paths = []
-    for doc in all_docs:
-        # Get the file_path and split it into levels
-        # file_path = doc.get("file_path", "").split(path_start_to_ignore)[-1]
+
+def parent_folder(path):
+    """Returns the folder path (ending in '/') that directly contains a file or folder path."""
+    stripped = path.rstrip("/")
+    if "/" not in stripped:
+        return None  # top level, no parent folder
+    return stripped[:stripped.rfind("/") + 1]
+
+
+def folder_depth(path):
+    """The number of path levels above a file or folder, e.g. 0 for '/' and 2 for '/media/henk/'."""
+    return path.rstrip("/").count("/")
+
+
+def collect_folder_paths():
+    """Streams the file paths and returns the set of all folder paths above them."""
+    folder_paths = set()
+    cursor = collection.find({"file_name": {"$ne": "folder_summary"}}, {"_id": 0, "file_path": 1}, batch_size=10000)
+    for doc in cursor:
+        folder_path = parent_folder(doc.get("file_path", ""))
+        # Once a folder is known, all folders above it are known as well
+        while folder_path is not None and folder_path not in folder_paths:
+            folder_paths.add(folder_path)
+            folder_path = parent_folder(folder_path)
+    return folder_paths
+
+
+def remove_duplicate_folder_records(remove=False):
+    """
+    Keeps one record per folder path (the one with the most enrichments), so the unique index can be built.
+    The enrichments only found on the other records are added to the kept one before those are deleted, and
+    every removed _id is printed. Without remove, the duplicates are only printed and a ValueError is raised.
+    """
+    duplicates = collection.aggregate([
+        {"$match": {"file_name": "folder_summary"}},
+        {"$group": {
+            "_id": "$file_path",
+            "records": {"$push": {"id": "$_id", "enrichments": {"$size": {"$ifNull": ["$enrichments", []]}}}},
+            "count": {"$sum": 1}
+        }},
+        {"$match": {"count": {"$gt": 1}}}
+    ], allowDiskUse=True)
+
+    kept_ids = {}  # removed _id -> the _id of the record kept for the same folder
+    for group in duplicates:
+        records = sorted(group["records"], key=lambda record: (-record["enrichments"], record["id"]))
+        removed = [record["id"] for record in records[1:]]
+        print(f"Duplicate folder records of '{group['_id']}': keeping {records[0]['id']}, "
+              f"{'removing' if remove else 'found'} {', '.join(str(doc_id) for doc_id in removed)}")
+        kept_ids.update((doc_id, records[0]["id"]) for doc_id in removed)
+    if not kept_ids:
+        return 0
+    if not remove:
+        raise ValueError(f"Found {len(kept_ids)} duplicate folder records; run with --remove-duplicates to merge "
+                         f"their enrichments into the kept records and delete them")
+
+    # The enrichments of the removed records that the kept record doesn't have yet
+    record_ids = list(kept_ids) + list(set(kept_ids.values()))
+    enrichments = {doc["_id"]: doc.get("enrichments") or []
+                   for doc in collection.find({"_id": {"$in": record_ids}}, {"enrichments": 1})}
+    merged = {}
+    for doc_id, kept_id in kept_ids.items():
+        kept = merged.setdefault(kept_id, list(enrichments.get(kept_id, [])))
+        kept += [enrichment for enrichment in enrichments.get(doc_id, []) if enrichment not in kept]
+    requests = [UpdateOne({"_id": kept_id}, {"$set": {"enrichments": kept}})
+                for kept_id, kept in merged.items() if len(kept) > len(enrichments.get(kept_id, []))]
+
+    duplicate_ids = list(kept_ids)
+    requests += [DeleteMany({"_id": {"$in": duplicate_ids[start:start + write_batch_size]}})
+                 for start in range(0, len(duplicate_ids), write_batch_size)]
+    collection.bulk_write(requests)  # Ordered, so the enrichments are merged before their records are deleted
+    print(f"Removed {len(duplicate_ids)} duplicate folder records")
+    return len(duplicate_ids)
+
+
+def create_path_indexes(collection=collection):
+    """Indexes used to look up the direct children of a folder and the folders of a given depth."""
+    collection.create_index("parent_path", name="parent_path")
+    collection.create_index([("file_name", 1), ("depth", 1)], name="file_name_depth")
+
+
+def backfill_path_fields(collection=collection, only_missing=True):
+    """
+    Stores parent_path and depth on every record, so the children of a folder can be found with an equality
+    query on parent_path instead of a regex on file_path.
+
+    Args:
+        collection: The MongoDB collection to update, defaults to the collection configured above.
+        only_missing (bool): Only update records without a parent_path, e.g. files added since the last run.
+    """
+    query = {"parent_path": {"$exists": False}} if only_missing else {}
+    cursor = collection.find(query, {"file_path": 1}, batch_size=10000)
+
+    updated = 0
+    requests = []
+    for doc in cursor:
         file_path = doc.get("file_path", "")
-        path_parts = file_path.split("/")
+        requests.append(UpdateOne(
+            {"_id": doc["_id"]},
+            {"$set": {"parent_path": parent_folder(file_path), "depth": folder_depth(file_path)}}
+        ))
+        if len(requests) >= write_batch_size:
+            updated += collection.bulk_write(requests, ordered=False).modified_count
+            requests = []
+    if requests:
+        updated += collection.bulk_write(requests, ordered=False).modified_count
+
+    print(f"Set parent_path and depth on {updated} records")
+    return updated
+
 
-        # Construct paths for all folder levels and add them to all_folder_paths
-        for i in range(1, len(path_parts)):
-            folder_path = "/".join(path_parts[:i]) + "/"
-            if folder_path not in all_folder_paths:
-                all_folder_paths.append(folder_path)
+def create_folder_records(remove_duplicates=False):
+    folder_paths = collect_folder_paths()
+    print(f"Found {len(folder_paths)} folders")
 
-    all_folder_paths = sorted(all_folder_paths, reverse=True)
-    for folder in all_folder_paths:
-        folder_record = {
-            "file_name": "folder_summary",  # Fixed value
-            "file_path": folder  # Path of the folder
-        }
-        # Insert the record into the collection
-        collection.insert_one(folder_record)
-        print(f"Inserted record: {folder_record}")
+    # Folder records are unique per file_path, so running this again never creates duplicates
+    remove_duplicate_folder_records(remove_duplicates)
+    collection.create_index(
+        "file_path",
+        name="folder_file_path_unique",
+        unique=True,
+        partialFilterExpression={"file_name": "folder_summary"}
+    )
 
+    all_folder_paths = sorted(folder_paths, reverse=True)
+    inserted = 0
+    for start in range(0, len(all_folder_paths), write_batch_size):
+        requests = [
+            UpdateOne(
+                {"file_name": "folder_summary", "file_path": folder},  # Path of the folder
+                {"$set": {"parent_path": parent_folder(folder), "depth": folder_depth(folder)}},
+                upsert=True
+            )
+            for folder in all_folder_paths[start:start + write_batch_size]
+        ]
+        result = collection.bulk_write(requests, ordered=False)
+        inserted += result.upserted_count
+    print(f"Inserted {inserted} new folder records, {len(all_folder_paths) - inserted} already existed")
 
     return all_folder_paths
 
-create_folder_records()
\ No newline at end of file
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Create the folder records and the parent_path/depth fields")
+    parser.add_argument("--backfill-only", action="store_true",
+                        help="only add parent_path and depth to records that miss them (e.g. after new files)")
+    parser.add_argument("--all", action="store_true", help="recompute parent_path and depth on every record")
+    parser.add_argument("--remove-duplicates", action="store_true",
+                        help="merge duplicate folder records into one (keeping all their enrichments) and delete "
+                             "the others")
+    args = parser.parse_args()
+
+    if not args.backfill_only:
+        create_folder_records(args.remove_duplicates)
+    backfill_path_fields(only_missing=not args.all)
+    create_path_indexes()
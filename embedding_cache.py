@@ -0,0 +1,386 @@
+# Local cache of the text embeddings of a collection, shared by the search and report scripts.
+# The embeddings are stored as one contiguous float32 matrix (embeddings.npy, memory-mapped when loaded)
+# and the document metadata as an aligned Parquet table (metadata.parquet), both sorted by _id.
+# The metadata includes the facets used to filter searches (see facet_filters.py).
+# The cache is refreshed when the collection's document count or highest _id changes: documents
+# inserted after the cached ones are appended, any other change rebuilds the cache.
+#
+#     python embedding_cache.py            # create or refresh the cache
+#     python embedding_cache.py --rebuild  # rebuild it, e.g. after embeddings of existing documents changed
+#     python embedding_cache.py --quantize int8  # also derive the int8 embeddings for search and similarity
+
+import argparse
+import json
+import os
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+from bson import ObjectId
+from pymongo import MongoClient
+
+from year_counts import YEAR_EXPRESSION
+
+database_name = "MODAL_data"  # Replace with your database name
+collection_name = "collection_name"  # Replace with your collection name
+
+CACHE_ROOT = "data/embedding_cache"
+CACHE_VERSION = 2  # Increase when the cached columns change, so old caches are rebuilt
+PREVIEW_LENGTH = 100  # Number of characters of extracted_text kept in the metadata
+METADATA_COLUMNS = ["_id", "file_path", "file_mimetype", "word_count", "creation_date", "year", "text_preview"]
+
+
+def cache_directory(db_name, collection_name):
+    return os.path.join(CACHE_ROOT, f"{db_name}_{collection_name}")
+
+
+def collection_state(collection):
+    """The document count and highest _id of a collection, used to detect changes."""
+    last_doc = collection.find_one({}, {"_id": 1}, sort=[("_id", -1)])
+    return {
+        "document_count": collection.estimated_document_count(),
+        "max_id": str(last_doc["_id"]) if last_doc else None
+    }
+
+
+def format_date(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return str(value) if value is not None else None
+
+
+def resize_rows(path, rows, chunk_size=65536):
+    """Replaces a .npy matrix by one of `rows` rows, keeping as many of its first rows as fit."""
+    old = np.load(path, mmap_mode="r")
+    resized = np.lib.format.open_memmap(path + ".resize.npy", mode="w+", dtype=old.dtype, shape=(rows, old.shape[1]))
+    for start in range(0, min(rows, len(old)), chunk_size):
+        end = min(start + chunk_size, rows, len(old))
+        resized[start:end] = old[start:end]
+    resized.flush()
+    del resized, old
+    os.replace(path + ".resize.npy", path)
+    return np.load(path, mmap_mode="r+")
+
+
+def fetch_rows(collection, embeddings_file, after_id=None):
+    """
+    Reads the embeddings and metadata of the documents with embeddings, sorted by _id. The embeddings are written
+    straight into the .npy file embeddings_file (sized with a count first), which isn't created when no document
+    has embeddings, so they are never all held in memory.
+    """
+    match = {"embeddings.0.text_embeddings.0": {"$exists": True}}
+    if after_id is not None:
+        match["_id"] = {"$gt": ObjectId(after_id)}
+    expected = collection.count_documents(match)
+
+    cursor = collection.aggregate([
+        {"$match": match},
+        {"$sort": {"_id": 1}},
+        {"$project": {
+            "embedding": {"$arrayElemAt": ["$embeddings.text_embeddings", 0]},
+            "file_path": 1,
+            "file_mimetype": 1,
+            "word_count": 1,
+            "creation_date": 1,
+            "year": YEAR_EXPRESSION,  # of estimated_creation_date, null when unknown
+            # Only the start of extracted_text is sent back, never the full text
+            "text_preview": {"$substrCP": [{"$ifNull": ["$extracted_text", ""]}, 0, PREVIEW_LENGTH]}
+        }}
+    ], allowDiskUse=True, batchSize=1000)
+
+    matrix = None
+    row = 0
+    columns = {column: [] for column in METADATA_COLUMNS}
+    for doc in cursor:
+        embedding = np.asarray(doc["embedding"], dtype=np.float32)
+        if matrix is None:
+            matrix = np.lib.format.open_memmap(embeddings_file, mode="w+", dtype=np.float32,
+                                               shape=(max(expected, 1), len(embedding)))
+        elif row == len(matrix):  # Documents embedded since the count
+            matrix.flush()
+            del matrix
+            matrix = resize_rows(embeddings_file, 2 * row)
+        matrix[row] = embedding
+        row += 1
+        columns["_id"].append(str(doc["_id"]))
+        columns["file_path"].append(doc.get("file_path", "N/A"))
+        columns["file_mimetype"].append(doc.get("file_mimetype", "Unknown"))
+        columns["word_count"].append(doc.get("word_count") or 0)
+        columns["creation_date"].append(format_date(doc.get("creation_date")))
+        columns["year"].append(doc.get("year") or 0)
+        columns["text_preview"].append(doc.get("text_preview", ""))
+
+    if matrix is not None:
+        matrix.flush()
+        resize = row < len(matrix)  # Documents deleted since the count
+        del matrix
+        if resize:
+            resize_rows(embeddings_file, row)
+
+    metadata = pd.DataFrame(columns, columns=METADATA_COLUMNS)
+    metadata["word_count"] = pd.to_numeric(metadata["word_count"], errors="coerce").fillna(0).astype(np.int64)
+    metadata["year"] = metadata["year"].astype(np.int64)  # 0 when unknown
+    return metadata
+
+
+def write_cache(cache_dir, fetched_file, metadata, info, append=False, chunk_size=65536):
+    """
+    Moves (or appends) the embeddings written by fetch_rows() to fetched_file into the cache, and writes the
+    metadata; each file is replaced in one step once it is complete.
+    """
+    embeddings_file = os.path.join(cache_dir, "embeddings.npy")
+    metadata_file = os.path.join(cache_dir, "metadata.parquet")
+
+    if append:
+        old_embeddings = np.load(embeddings_file, mmap_mode="r")
+        new_embeddings = np.load(fetched_file, mmap_mode="r")
+        old_count = len(old_embeddings)
+        tmp_file = embeddings_file + ".tmp"
+        matrix = np.lib.format.open_memmap(tmp_file, mode="w+", dtype=np.float32,
+                                           shape=(old_count + len(new_embeddings), old_embeddings.shape[1]))
+        for start in range(0, old_count, chunk_size):
+            end = min(start + chunk_size, old_count)
+            matrix[start:end] = old_embeddings[start:end]
+        for start in range(0, len(new_embeddings), chunk_size):
+            end = min(start + chunk_size, len(new_embeddings))
+            matrix[old_count + start:old_count + end] = new_embeddings[start:end]
+        matrix.flush()
+        del matrix, old_embeddings, new_embeddings
+        os.replace(tmp_file, embeddings_file)
+        os.remove(fetched_file)
+        metadata = pd.concat([pd.read_parquet(metadata_file), metadata], ignore_index=True)
+    else:
+        if not os.path.exists(fetched_file):  # No document has embeddings
+            np.save(fetched_file, np.empty((0, 0), dtype=np.float32))
+        os.replace(fetched_file, embeddings_file)
+
+    metadata.to_parquet(metadata_file + ".tmp", index=False)
+    os.replace(metadata_file + ".tmp", metadata_file)
+
+    info["rows"] = len(metadata)
+    return save_info(cache_dir, info)
+
+
+def save_info(cache_dir, info):
+    info["updated"] = datetime.now().isoformat()
+    with open(os.path.join(cache_dir, "info.json"), "w", encoding="utf-8") as f:
+        json.dump(info, f)
+    return info
+
+
+def update_embedding_cache(db_name, collection_name, rebuild=False):
+    """Creates the cache, appends newly inserted documents to it, or rebuilds it when the collection changed."""
+    cache_dir = cache_directory(db_name, collection_name)
+    info_file = os.path.join(cache_dir, "info.json")
+    fetched_file = os.path.join(cache_dir, "fetched.tmp.npy")
+    os.makedirs(cache_dir, exist_ok=True)
+
+    with MongoClient('mongodb://localhost:27017/') as client:
+        collection = client[db_name][collection_name]
+        state = collection_state(collection)
+
+        info = None
+        if not rebuild and os.path.exists(info_file):
+            with open(info_file, encoding="utf-8") as f:
+                info = json.load(f)
+            if info.get("version") != CACHE_VERSION:
+                info = None
+
+        if info is not None:
+            if state == {key: info[key] for key in state}:
+                return info
+
+            # Documents inserted after the cached ones explain the change: only those are read
+            if info["max_id"] is not None and state["max_id"] is not None:
+                new_documents = collection.count_documents({"_id": {"$gt": ObjectId(info["max_id"])}})
+                if state["document_count"] == info["document_count"] + new_documents:
+                    metadata = fetch_rows(collection, fetched_file, after_id=info["max_id"])
+                    print(f"Adding {len(metadata)} documents to the embedding cache")
+                    info.update(state)
+                    if len(metadata) == 0:
+                        return save_info(cache_dir, info)
+                    return write_cache(cache_dir, fetched_file, metadata, info, append=info["rows"] > 0)
+
+        print(f"Building the embedding cache for {db_name}.{collection_name}")
+        metadata = fetch_rows(collection, fetched_file)
+        info = {"version": CACHE_VERSION, **state}
+        info = write_cache(cache_dir, fetched_file, metadata, info)
+        print(f"Cached {info['rows']} embeddings in '{cache_dir}'")
+        return info
+
+
+def load_embedding_cache(db_name, collection_name, refresh=True):
+    """
+    Loads the cached embeddings and metadata of a collection.
+
+    Args:
+        db_name (str): The name of the MongoDB database.
+        collection_name (str): The name of the MongoDB collection.
+        refresh (bool): Check the collection for changes and update the cache first.
+
+    Returns:
+        tuple: (embeddings, metadata) with the float32 embeddings memory-mapped from disk and the metadata
+        as a DataFrame, row i of both describing the same document.
+    """
+    if refresh:
+        update_embedding_cache(db_name, collection_name)
+    cache_dir = cache_directory(db_name, collection_name)
+    embeddings = np.load(os.path.join(cache_dir, "embeddings.npy"), mmap_mode="r")
+    metadata = pd.read_parquet(os.path.join(cache_dir, "metadata.parquet"))
+    return embeddings, metadata
+
+
+
+def load_normalized_embeddings(db_name, collection_name, refresh=True, chunk_size=65536):
+    """
+    Loads the cached embeddings scaled to unit length, so inner products are cosine similarities.
+
+    The normalized copy (embeddings_normalized.npy) is derived from the cache in chunks the first time and
+    again whenever the cache was updated since; it is memory-mapped like the cache itself.
+
+    Returns:
+        tuple: (embeddings, metadata) like load_embedding_cache(), with normalized float32 embeddings.
+    """
+    if refresh:
+        update_embedding_cache(db_name, collection_name)
+    cache_dir = cache_directory(db_name, collection_name)
+    normalized_file = os.path.join(cache_dir, "embeddings_normalized.npy")
+    normalized_info_file = os.path.join(cache_dir, "normalized.json")
+    with open(os.path.join(cache_dir, "info.json"), encoding="utf-8") as f:
+        source_updated = json.load(f)["updated"]
+
+    normalized_info = None
+    if os.path.exists(normalized_info_file) and os.path.exists(normalized_file):
+        with open(normalized_info_file, encoding="utf-8") as f:
+            normalized_info = json.load(f)
+    if normalized_info is None or normalized_info.get("source_updated") != source_updated:
+        embeddings = np.load(os.path.join(cache_dir, "embeddings.npy"), mmap_mode="r")
+        tmp_file = normalized_file + ".tmp.npy"
+        if len(embeddings):
+            normalized = np.lib.format.open_memmap(tmp_file, mode="w+", dtype=np.float32, shape=embeddings.shape)
+            for start in range(0, len(embeddings), chunk_size):
+                chunk = np.asarray(embeddings[start:start + chunk_size], dtype=np.float64)
+                norms = np.linalg.norm(chunk, axis=1, keepdims=True)
+                norms[norms == 0] = 1
+                normalized[start:start + chunk_size] = chunk / norms
+            normalized.flush()
+            del normalized
+        else:
+            np.save(tmp_file, np.empty(embeddings.shape, dtype=np.float32))
+        os.replace(tmp_file, normalized_file)
+        with open(normalized_info_file, "w", encoding="utf-8") as f:
+            json.dump({"source_updated": source_updated}, f)
+
+    embeddings = np.load(normalized_file, mmap_mode="r")
+    metadata = pd.read_parquet(os.path.join(cache_dir, "metadata.parquet"))
+    return embeddings, metadata
+
+
+class QuantizedEmbeddings:
+    """
+    Normalized embeddings stored as float16, or as int8 with a float32 scale per row (2x and 4x smaller than
+    float32). Indexed like an array, e.g. corpus[start:end] or corpus[rows], it returns float32 rows, so a
+    chunk at a time can be scored without ever holding the float32 matrix.
+    """
+
+    def __init__(self, codes, scales=None, error_bound=0.0):
+        self.codes = codes
+        self.scales = scales
+        self.error_bound = error_bound  # The largest distance between a stored row and its float32 original
+
+    def __len__(self):
+        return len(self.codes)
+
+    @property
+    def shape(self):
+        return self.codes.shape
+
+    @property
+    def nbytes(self):
+        return self.codes.nbytes + (self.scales.nbytes if self.scales is not None else 0)
+
+    def __getitem__(self, rows):
+        chunk = np.asarray(self.codes[rows], dtype=np.float32)
+        if self.scales is not None:
+            chunk *= np.asarray(self.scales[rows])[..., np.newaxis]
+        return chunk
+
+
+def quantize_rows(rows, dtype):
+    """Returns the (codes, scales) of normalized float32 rows; the scales are None for float16."""
+    if dtype == "float16":
+        return rows.astype(np.float16), None
+    # Symmetric int8: the largest component of every row maps to +-127
+    scales = np.abs(rows).max(axis=1) / 127
+    scales[scales == 0] = 1
+    codes = np.rint(rows / scales[:, np.newaxis]).astype(np.int8)
+    return codes, scales.astype(np.float32)
+
+
+def load_quantized_embeddings(db_name, collection_name, dtype="int8", refresh=True, chunk_size=65536):
+    """
+    Loads the normalized embeddings quantized to float16 or int8, see QuantizedEmbeddings.
+
+    The quantized copy (embeddings_<dtype>.npy, plus embeddings_int8_scales.npy for int8) is derived from the
+    normalized embeddings like those are from the cache, and memory-mapped when loaded.
+
+    Returns:
+        tuple: (embeddings, metadata) like load_normalized_embeddings(), with QuantizedEmbeddings.
+    """
+    if dtype not in ("float16", "int8"):
+        raise ValueError(f"Unknown quantized format: {dtype}")
+    normalized, metadata = load_normalized_embeddings(db_name, collection_name, refresh, chunk_size)
+    cache_dir = cache_directory(db_name, collection_name)
+    codes_file = os.path.join(cache_dir, f"embeddings_{dtype}.npy")
+    scales_file = os.path.join(cache_dir, "embeddings_int8_scales.npy")
+    quantized_info_file = os.path.join(cache_dir, f"{dtype}.json")
+    with open(os.path.join(cache_dir, "normalized.json"), encoding="utf-8") as f:
+        source_updated = json.load(f)["source_updated"]
+
+    quantized_info = None
+    if os.path.exists(quantized_info_file) and os.path.exists(codes_file):
+        with open(quantized_info_file, encoding="utf-8") as f:
+            quantized_info = json.load(f)
+    if quantized_info is None or quantized_info.get("source_updated") != source_updated:
+        scales = np.empty(len(normalized), dtype=np.float32)
+        error_bound = 0.0
+        if len(normalized):
+            codes = np.lib.format.open_memmap(codes_file + ".tmp.npy", mode="w+", dtype=dtype,
+                                              shape=normalized.shape)
+            for start in range(0, len(normalized), chunk_size):
+                rows = np.asarray(normalized[start:start + chunk_size])
+                chunk_codes, chunk_scales = quantize_rows(rows, dtype)
+                codes[start:start + chunk_size] = chunk_codes
+                restored = chunk_codes.astype(np.float32)
+                if chunk_scales is not None:
+                    scales[start:start + chunk_size] = chunk_scales
+                    restored *= chunk_scales[:, np.newaxis]
+                error_bound = max(error_bound, float(np.linalg.norm(restored - rows, axis=1).max()))
+            codes.flush()
+            del codes
+        else:
+            np.save(codes_file + ".tmp.npy", np.empty(normalized.shape, dtype=dtype))
+        os.replace(codes_file + ".tmp.npy", codes_file)
+        if dtype == "int8":
+            np.save(scales_file + ".tmp.npy", scales)
+            os.replace(scales_file + ".tmp.npy", scales_file)
+        quantized_info = {"source_updated": source_updated, "error_bound": error_bound}
+        with open(quantized_info_file, "w", encoding="utf-8") as f:
+            json.dump(quantized_info, f)
+
+    codes = np.load(codes_file, mmap_mode="r")
+    scales = np.load(scales_file, mmap_mode="r") if dtype == "int8" else None
+    return QuantizedEmbeddings(codes, scales, quantized_info["error_bound"]), metadata
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Create or refresh the local embedding cache of a collection")
+    parser.add_argument("--rebuild", action="store_true", help="rebuild the cache instead of appending to it")
+    parser.add_argument("--quantize", choices=["float16", "int8"], help="also derive the quantized embeddings")
+    args = parser.parse_args()
+
+    update_embedding_cache(database_name, collection_name, rebuild=args.rebuild)
+    if args.quantize:
+        embeddings, _ = load_quantized_embeddings(database_name, collection_name, args.quantize, refresh=False)
+        print(f"Quantized {len(embeddings)} embeddings to {args.quantize} ({embeddings.nbytes / 2 ** 20:.1f} MB, "
+              f"largest error {embeddings.error_bound:.4f})")
@@ -0,0 +1,74 @@
+# Search filters on the metadata of the embedding cache (see embedding_cache.py): file_mimetype, word_count,
+# year of estimated_creation_date and folder. The facets are turned once into NumPy arrays aligned with the
+# embedding matrix (a boolean mask per mimetype, the word counts and years, and the file paths in sorted order),
+# so a filter is a few vectorised comparisons giving a boolean mask over the cache rows, applied before
+# scoring, instead of a MongoDB query per search.
+
+import numpy as np
+
+
+def build_facets(metadata):
+    """The filterable facets of the cache rows described by the cache metadata."""
+    mimetypes, mimetype_codes = np.unique(metadata["file_mimetype"].fillna("Unknown").astype(str).to_numpy(),
+                                          return_inverse=True)
+    mimetype_codes = mimetype_codes.ravel()
+    paths = metadata["file_path"].fillna("").astype(str).to_numpy(dtype=object)
+    path_order = np.argsort(paths, kind="stable")
+    return {
+        "count": len(metadata),
+        "mimetype_masks": {mimetype: mimetype_codes == code for code, mimetype in enumerate(mimetypes)},
+        "word_count": metadata["word_count"].to_numpy(),
+        "year": metadata["year"].to_numpy(),  # 0 when unknown
+        "path_order": path_order,
+        "sorted_paths": paths[path_order],
+    }
+
+
+def folder_rows(facets, folder):
+    """The rows of the documents below a folder, found with a binary search in the sorted file paths."""
+    prefix = folder if folder.endswith("/") else folder + "/"
+    start, end = np.searchsorted(facets["sorted_paths"], [prefix, prefix + "\U0010ffff"])
+    return facets["path_order"][start:end]
+
+
+def filter_mask(facets, mimetypes=None, min_words=None, max_words=None, min_year=None, max_year=None,
+                folder=None):
+    """
+    Combines the given filters into a boolean mask over the cache rows.
+
+    Args:
+        facets (dict): The facets from build_facets().
+        mimetypes (list[str]): Keep the documents with one of these mimetypes.
+        min_words, max_words (int): Keep the documents with a word_count in this range (inclusive).
+        min_year, max_year (int): Keep the documents whose estimated_creation_date is in this range of years
+            (inclusive); documents without a year are left out by either bound.
+        folder (str): Keep the documents below this folder path.
+
+    Returns:
+        numpy.ndarray: The mask, or None when no filter is given (so the whole collection is searched).
+    """
+    mask = None
+
+    def restrict(selected):
+        nonlocal mask
+        mask = selected if mask is None else np.logical_and(mask, selected, out=mask)
+
+    if mimetypes:
+        selected = np.zeros(facets["count"], dtype=bool)
+        for mimetype in mimetypes:
+            if mimetype in facets["mimetype_masks"]:
+                selected |= facets["mimetype_masks"][mimetype]
+        restrict(selected)
+    if min_words is not None:
+        restrict(facets["word_count"] >= min_words)
+    if max_words is not None:
+        restrict(facets["word_count"] <= max_words)
+    if min_year is not None:
+        restrict(facets["year"] >= min_year)
+    if max_year is not None:
+        restrict((facets["year"] <= max_year) & (facets["year"] > 0))
+    if folder:
+        selected = np.zeros(facets["count"], dtype=bool)
+        selected[folder_rows(facets, folder)] = True
+        restrict(selected)
+    return mask
@@ -0,0 +1,237 @@
+# Persistent, mergeable per-folder aggregates of the enrichments summarized by summarize_records_to_db.py, so the
+# folder summaries can be kept up to date incrementally instead of recomputing every folder.
+#
+# Three collections next to the archive collection hold the aggregates:
+#   <collection>_folder_counts     one record per (folder, field, item) with its count in all documents below
+#                                  the folder, updated with $inc
+#   <collection>_folder_stats      one record per folder with the number of documents below it
+#   <collection>_folder_snapshots  what every document contributed, so a changed document can be subtracted
+# When documents are added, changed or deleted, apply_document_changes() computes the difference with their
+# snapshots, applies it to the folders above them, and refreshes the top_n lists of only those folders.
+#
+#     python folder_aggregates.py --rebuild  # build the aggregates and all folder summaries from scratch
+#     python folder_aggregates.py            # add the documents inserted since the last run
+
+import argparse
+import heapq
+from collections import Counter, defaultdict
+from itertools import islice
+
+from pymongo import ASCENDING, DESCENDING, DeleteOne, InsertOne, ReplaceOne, UpdateOne
+
+from create_folder_hierarchy import folder_depth, parent_folder
+from summarize_records_to_db import SUMMARY_FIELDS, build_enrichment_record, collection, extract_ner_data, top_n
+
+write_batch_size = 10000  # Number of operations sent per bulk_write
+
+counts_collection = collection.database[f"{collection.name}_folder_counts"]
+stats_collection = collection.database[f"{collection.name}_folder_stats"]
+snapshots_collection = collection.database[f"{collection.name}_folder_snapshots"]
+
+DOCUMENT_PROJECTION = {"file_path": 1, "parent_path": 1, "file_name": 1,
+                       **{f"enrichments.{field}": 1 for field in SUMMARY_FIELDS}}
+
+
+def create_aggregate_indexes():
+    counts_collection.create_index([("folder", ASCENDING), ("field", ASCENDING), ("item", ASCENDING)],
+                                   name="folder_field_item", unique=True)
+    # Covers the sort of top_items(), so the top items of even the top-level folders are read off the index
+    counts_collection.create_index([("folder", ASCENDING), ("field", ASCENDING), ("count", DESCENDING),
+                                    ("item", ASCENDING)], name="folder_field_count")
+
+
+def bulk_write(target, requests, ordered=False):
+    """Sends the requests in batches of write_batch_size; a generator is only read one batch at a time."""
+    requests = iter(requests)
+    batch = list(islice(requests, write_batch_size))
+    while batch:
+        target.bulk_write(batch, ordered=ordered)
+        batch = list(islice(requests, write_batch_size))
+
+
+def ancestor_folders(folder):
+    """The folder itself and every folder above it, up to the top level."""
+    while folder is not None:
+        yield folder
+        folder = parent_folder(folder)
+
+
+def document_snapshot(doc):
+    """What a document contributes to the aggregates: its folder and the [field, item, count] of its values."""
+    folder = doc.get("parent_path") or parent_folder(doc.get("file_path", ""))
+    enrichments = doc.get("enrichments", [])
+    entries = []
+    if enrichments:
+        for field in SUMMARY_FIELDS:
+            entries += [[field, item, count] for item, count in Counter(extract_ner_data(enrichments, field)).items()]
+    return {"_id": doc["_id"], "folder": folder, "entries": entries}
+
+
+def add_snapshot(deltas, doc_deltas, snapshot, sign):
+    """Adds (sign 1) or subtracts (sign -1) the contribution of a document to all folders above it."""
+    for folder in ancestor_folders(snapshot["folder"]):
+        doc_deltas[folder] += sign
+        for field, item, count in snapshot["entries"]:
+            deltas[folder, field, item] += sign * count
+
+
+def top_items(folder):
+    """The top_n most common items of every field of a folder, from the stored counts."""
+    return {
+        field: Counter({record["item"]: record["count"] for record in counts_collection.find(
+            {"folder": folder, "field": field, "count": {"$gt": 0}}, {"_id": 0, "item": 1, "count": 1}
+        ).sort([("count", DESCENDING), ("item", ASCENDING)]).limit(top_n)})
+        for field in SUMMARY_FIELDS
+    }
+
+
+def summary_requests(folder, counters):
+    """Replaces the summarizer enrichment of a folder record (created if missing) with a fresh one."""
+    folder_filter = {"file_name": "folder_summary", "file_path": folder}
+    return [
+        UpdateOne(folder_filter, {"$set": {"parent_path": parent_folder(folder), "depth": folder_depth(folder)}},
+                  upsert=True),
+        UpdateOne(folder_filter, {"$pull": {"enrichments": {"model_used": "summarizer"}}}),
+        # First in the enrichments array, where summarize_records() puts it
+        UpdateOne(folder_filter, {"$push": {"enrichments": {"$each": [build_enrichment_record(counters)],
+                                                            "$position": 0}}}),
+    ]
+
+
+def refresh_folder_summaries(folders):
+    requests = []
+    for folder in folders:
+        requests += summary_requests(folder, top_items(folder))
+    # Ordered, so the old enrichment is pulled before the new one is pushed
+    bulk_write(collection, requests, ordered=True)
+
+
+def apply_document_changes(doc_ids):
+    """
+    Brings the aggregates up to date for documents that were inserted, changed or deleted, and refreshes the
+    summaries of the folders above them. The work is proportional to the changed documents and their folders.
+
+    Args:
+        doc_ids (list): The _ids of the changed documents; ids that no longer exist are treated as deleted.
+
+    Returns:
+        set: The folders whose summaries were refreshed.
+    """
+    doc_ids = list(dict.fromkeys(doc_ids))  # each document once, even when it changed several times
+    if not doc_ids:
+        return set()
+
+    old_snapshots = {snapshot["_id"]: snapshot for snapshot in snapshots_collection.find({"_id": {"$in": doc_ids}})}
+    new_snapshots = {doc["_id"]: document_snapshot(doc)
+                     for doc in collection.find({"_id": {"$in": doc_ids}, "file_name": {"$ne": "folder_summary"}},
+                                                DOCUMENT_PROJECTION)}
+
+    deltas = Counter()
+    doc_deltas = Counter()
+    snapshot_requests = []
+    for doc_id in doc_ids:
+        old, new = old_snapshots.get(doc_id), new_snapshots.get(doc_id)
+        if old is not None:
+            add_snapshot(deltas, doc_deltas, old, -1)
+        if new is not None:
+            add_snapshot(deltas, doc_deltas, new, 1)
+            snapshot_requests.append(ReplaceOne({"_id": doc_id}, new, upsert=True))
+        elif old is not None:
+            snapshot_requests.append(DeleteOne({"_id": doc_id}))
+
+    # Only folders whose counts actually changed get a new summary
+    folders = ({folder for (folder, _, _), delta in deltas.items() if delta} |
+               {folder for folder, delta in doc_deltas.items() if delta})
+    count_requests = [UpdateOne({"folder": folder, "field": field, "item": item}, {"$inc": {"count": delta}},
+                                upsert=True)
+                      for (folder, field, item), delta in deltas.items() if delta]
+    bulk_write(counts_collection, count_requests)
+    if count_requests:
+        # Items that no longer occur below a folder
+        counts_collection.delete_many({"folder": {"$in": list(folders)}, "count": {"$lte": 0}})
+    bulk_write(stats_collection, [UpdateOne({"_id": folder}, {"$inc": {"doc_count": delta}}, upsert=True)
+                                  for folder, delta in doc_deltas.items() if delta])
+    bulk_write(snapshots_collection, snapshot_requests)
+
+    refresh_folder_summaries(sorted(folders))
+    print(f"Applied {len(doc_ids)} changed documents to {len(folders)} folders")
+    return folders
+
+
+def update_new_documents(batch_size=1000):
+    """Applies the documents inserted after the last document in the aggregates, detected by a higher _id."""
+    last = snapshots_collection.find_one({}, {"_id": 1}, sort=[("_id", DESCENDING)])
+    query = {"file_name": {"$ne": "folder_summary"}}
+    if last is not None:
+        query["_id"] = {"$gt": last["_id"]}
+
+    batch = []
+    applied = 0
+    for doc in collection.find(query, {"_id": 1}).sort("_id", ASCENDING):
+        batch.append(doc["_id"])
+        if len(batch) >= batch_size:
+            apply_document_changes(batch)
+            applied += len(batch)
+            batch = []
+    if batch:
+        apply_document_changes(batch)
+        applied += len(batch)
+    print(f"Added {applied} new documents to the folder aggregates")
+    return applied
+
+
+def rebuild_aggregates():
+    """Builds the aggregates and the summaries of all folders from scratch in one scan of the collection."""
+    for target in (counts_collection, stats_collection, snapshots_collection):
+        target.drop()
+    create_aggregate_indexes()
+
+    folder_counters = defaultdict(Counter)  # (folder, field) -> item counts, of all documents below the folder
+    doc_counts = Counter()
+    snapshots = []
+    doc_count = 0
+    cursor = collection.find({"file_name": {"$ne": "folder_summary"}}, DOCUMENT_PROJECTION, batch_size=1000)
+    for doc in cursor:
+        snapshot = document_snapshot(doc)
+        snapshots.append(InsertOne(snapshot))
+        if len(snapshots) >= write_batch_size:
+            bulk_write(snapshots_collection, snapshots)
+            snapshots = []
+        for folder in ancestor_folders(snapshot["folder"]):
+            doc_counts[folder] += 1
+            for field, item, count in snapshot["entries"]:
+                folder_counters[folder, field][item] += count
+        doc_count += 1
+        if doc_count % 10000 == 0:
+            print(f"Counted {doc_count} documents")
+    bulk_write(snapshots_collection, snapshots)
+
+    # The requests are generated while they are written, write_batch_size at a time
+    bulk_write(counts_collection, (InsertOne({"folder": folder, "field": field, "item": item, "count": count})
+                                   for (folder, field), counter in folder_counters.items()
+                                   for item, count in counter.items()))
+    bulk_write(stats_collection, (InsertOne({"_id": folder, "doc_count": count})
+                                  for folder, count in doc_counts.items()))
+
+    def folder_summaries():
+        for folder in sorted(doc_counts):
+            # Ties ordered by item, like top_items()
+            counters = {field: Counter(dict(heapq.nsmallest(top_n, folder_counters[folder, field].items(),
+                                                            key=lambda pair: (-pair[1], pair[0]))))
+                        for field in SUMMARY_FIELDS}
+            yield from summary_requests(folder, counters)
+
+    bulk_write(collection, folder_summaries(), ordered=True)
+    print(f"Built the aggregates of {doc_count} documents in {len(doc_counts)} folders")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Keep the folder summaries up to date from per-folder aggregates")
+    parser.add_argument("--rebuild", action="store_true", help="rebuild the aggregates and all folder summaries")
+    args = parser.parse_args()
+
+    create_aggregate_indexes()
+    if args.rebuild:
+        rebuild_aggregates()
+    else:
+        update_new_documents()
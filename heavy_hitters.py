@@ -0,0 +1,117 @@
+# Approximate counting of the most frequent items in bounded memory, used instead of exact Counters when the
+# number of distinct items (e.g. every person named anywhere in an archive) gets too large to keep.
+#
+# SpaceSaving (Metwally, Agrawal & El Abbadi, 2005) monitors at most `capacity` items. An item that isn't monitored
+# replaces the monitored item with the lowest count and inherits that count as its error, so for every monitored
+# item  count - error <= true count <= count,  and error <= total / capacity. Any item whose true count exceeds
+# total / capacity is guaranteed to be monitored. Sketches can be merged, e.g. from child folders into a parent,
+# keeping the same bound for the combined total.
+
+import heapq
+from collections import Counter
+from collections.abc import Mapping
+from itertools import count as sequence
+
+
+class SpaceSaving:
+    """
+    Space-Saving sketch of the most frequent items, usable where a Counter is updated and asked for most_common().
+
+    Args:
+        capacity (int): The number of monitored items k; memory is O(k) and the error of a count at most total / k.
+        track_keys (bool): Also count the occurrences of every monitored item per key (e.g. per year), counted
+            since the item was last monitored, so they add up to count - error.
+    """
+
+    def __init__(self, capacity=1000, track_keys=False):
+        if capacity < 1:
+            raise ValueError("capacity must be at least 1")
+        self.capacity = capacity
+        self.track_keys = track_keys
+        self.total = 0
+        self.counts = {}
+        self.errors = {}
+        self.keys = {}
+        self._heap = []  # (count, sequence, item) entries; entries whose count is outdated are skipped
+        self._sequence = sequence()
+
+    def __len__(self):
+        return len(self.counts)
+
+    @property
+    def error_bound(self):
+        """The most any count overestimates the true count, total / capacity."""
+        return self.total / self.capacity
+
+    def _push(self, item):
+        heapq.heappush(self._heap, (self.counts[item], next(self._sequence), item))
+        if len(self._heap) > 4 * self.capacity:
+            self._heap = [(item_count, next(self._sequence), item) for item, item_count in self.counts.items()]
+            heapq.heapify(self._heap)
+
+    def _pop_minimum(self):
+        while True:
+            item_count, _, item = heapq.heappop(self._heap)
+            if self.counts.get(item) == item_count:
+                return item
+
+    def add(self, item, count=1, key=None):
+        """Counts `count` occurrences of an item (for `key` when track_keys is set)."""
+        self.total += count
+        if item not in self.counts:
+            if len(self.counts) < self.capacity:
+                self.counts[item], self.errors[item] = 0, 0
+            else:
+                # Replace the item with the lowest count, whose count becomes the error of the new item
+                evicted = self._pop_minimum()
+                minimum = self.counts.pop(evicted)
+                del self.errors[evicted]
+                self.keys.pop(evicted, None)
+                self.counts[item], self.errors[item] = minimum, minimum
+        self.counts[item] += count
+        if self.track_keys:
+            self.keys.setdefault(item, Counter())[key] += count
+        self._push(item)
+
+    def update(self, items):
+        """Adds an iterable of items, a mapping of item counts, or merges another SpaceSaving sketch."""
+        if isinstance(items, SpaceSaving):
+            self.merge(items)
+        elif isinstance(items, Mapping):
+            for item, item_count in items.items():
+                self.add(item, item_count)
+        else:
+            for item in items:
+                self.add(item)
+
+    def minimum(self):
+        """The count an item that isn't monitored may at most have: the lowest count once the sketch is full."""
+        return min(self.counts.values()) if len(self.counts) >= self.capacity else 0
+
+    def merge(self, other):
+        """Adds the counts of another sketch, keeping the `capacity` items with the highest combined counts."""
+        own_minimum, other_minimum = self.minimum(), other.minimum()
+        counts, errors = {}, {}
+        for item in self.counts.keys() | other.counts.keys():
+            # An item missing from a full sketch occurred at most that sketch's minimum number of times there
+            counts[item] = self.counts.get(item, own_minimum) + other.counts.get(item, other_minimum)
+            errors[item] = self.errors.get(item, own_minimum) + other.errors.get(item, other_minimum)
+
+        kept = heapq.nlargest(self.capacity, counts, key=counts.get)
+        if self.track_keys:
+            self.keys = {item: self.keys.get(item, Counter()) + other.keys.get(item, Counter()) for item in kept}
+        self.counts = {item: counts[item] for item in kept}
+        self.errors = {item: errors[item] for item in kept}
+        self.total += other.total
+        self._heap = [(item_count, next(self._sequence), item) for item, item_count in self.counts.items()]
+        heapq.heapify(self._heap)
+
+    def most_common(self, n=None):
+        """The (item, count) pairs of the monitored items with the highest (over)estimated counts."""
+        if n is None:
+            return sorted(self.counts.items(), key=lambda pair: pair[1], reverse=True)
+        return heapq.nlargest(n, self.counts.items(), key=lambda pair: pair[1])
+
+    def guaranteed_count(self, item):
+        """The lower bound count - error of an item's true count (0 when it isn't monitored)."""
+        return self.counts.get(item, 0) - self.errors.get(item, 0)
@@ -0,0 +1,298 @@
+# Local BM25 index over the extracted_text of a collection, for exact words that embeddings miss (names,
+# dossier numbers, ...), and hybrid search that fuses its ranking with the semantic one.
+# Index rows are embedding cache rows (see embedding_cache.py), like the vector index, so both rankings
+# describe the same documents. The index is stored as arrays that are memory-mapped when loaded:
+#   vocab.npy                     the sorted terms, looked up with a binary search
+#   offsets.npy                   where the postings of each term start
+#   postings_rows.npy / _tf.npy   the rows containing each term, and how often it occurs in them
+#   lengths.npy                   the number of terms in each row
+#
+#     python lexical_index.py           # build the index
+#     python lexical_index.py --update  # add the documents added to the embedding cache since the last build
+
+import argparse
+import json
+import os
+import re
+from array import array
+from collections import Counter, defaultdict
+from datetime import datetime
+
+import numpy as np
+from bson import ObjectId
+from pymongo import MongoClient
+
+from embedding_cache import load_embedding_cache
+from facet_filters import filter_mask
+from search_engine import encode_queries, load_corpus, load_facets, results_for, search_vectors, top_k_indices
+from vector_index import save_array, save_json
+
+database_name = "MODAL_data"  # Replace with your database name
+collection_name = "collection_name"  # Replace with your collection name
+
+LEXICAL_ROOT = "data/lexical_index"
+k1 = 1.2  # BM25 term frequency saturation
+b = 0.75  # BM25 document length normalization
+max_term_length = 40  # Longer tokens (e.g. base64 or OCR noise) are not indexed
+rrf_k = 60  # Reciprocal rank fusion constant
+fusion_candidates = 100  # Number of results of each ranking that are fused
+
+TOKEN_PATTERN = re.compile(r"\w+")
+
+
+def lexical_directory(db_name, collection_name):
+    return os.path.join(LEXICAL_ROOT, f"{db_name}_{collection_name}")
+
+
+def tokenize(text):
+    return [token for token in TOKEN_PATTERN.findall(text.lower()) if len(token) <= max_term_length]
+
+
+def fetch_texts(db_name, collection_name, after_id=None):
+    """Yields the (_id, extracted_text) of the documents with embeddings, sorted by _id like the cache."""
+    match = {"embeddings.0.text_embeddings.0": {"$exists": True}}
+    if after_id is not None:
+        match["_id"] = {"$gt": ObjectId(after_id)}
+
+    with MongoClient('mongodb://localhost:27017/') as client:
+        cursor = client[db_name][collection_name].find(match, {"extracted_text": 1}).sort("_id", 1).batch_size(1000)
+        for doc in cursor:
+            yield str(doc["_id"]), doc.get("extracted_text") or ""
+
+
+def build_postings(documents, first_row, row_count):
+    """
+    Builds the index arrays of rows first_row .. first_row + row_count from (row, text) pairs.
+
+    Returns:
+        dict: vocab, offsets, rows, tf and lengths arrays; the postings of each term are sorted by row.
+    """
+    term_ids = {}
+    posting_terms, posting_rows, posting_tf = array("q"), array("q"), array("q")
+    lengths = np.zeros(row_count, dtype=np.int32)
+    for row, text in documents:
+        tokens = tokenize(text)
+        lengths[row - first_row] = len(tokens)
+        for term, tf in Counter(tokens).items():
+            posting_terms.append(term_ids.setdefault(term, len(term_ids)))
+            posting_rows.append(row)
+            posting_tf.append(tf)
+
+    vocab = np.array(list(term_ids), dtype=f"<U{max(map(len, term_ids), default=1)}")
+    term_order = np.argsort(vocab)
+    term_rank = np.empty(len(vocab), dtype=np.int64)
+    term_rank[term_order] = np.arange(len(vocab))
+
+    terms = term_rank[np.frombuffer(posting_terms, dtype=np.int64)]
+    rows = np.frombuffer(posting_rows, dtype=np.int64)
+    order = np.lexsort((rows, terms))
+    offsets = np.zeros(len(vocab) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum(np.bincount(terms, minlength=len(vocab)))
+    return {"vocab": vocab[term_order], "offsets": offsets, "rows": rows[order].astype(np.int32),
+            "tf": np.frombuffer(posting_tf, dtype=np.int64)[order].astype(np.int32), "lengths": lengths}
+
+
+def merge_postings(old, new):
+    """Merges the postings of new rows (all after the old rows) into the old index arrays."""
+    vocab = np.union1d(old["vocab"], new["vocab"])
+    old_counts, new_counts = np.diff(old["offsets"]), np.diff(new["offsets"])
+    old_terms = np.searchsorted(vocab, old["vocab"])
+    new_terms = np.searchsorted(vocab, new["vocab"])
+
+    merged_old_counts = np.zeros(len(vocab), dtype=np.int64)
+    merged_old_counts[old_terms] = old_counts
+    counts = merged_old_counts.copy()
+    counts[new_terms] += new_counts
+    offsets = np.zeros(len(vocab) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum(counts)
+
+    # The old postings of a term come first, then the new ones, so every term stays sorted by row
+    old_target = np.repeat(offsets[old_terms] - old["offsets"][:-1], old_counts) + np.arange(old_counts.sum())
+    new_start = offsets[new_terms] + merged_old_counts[new_terms]
+    new_target = np.repeat(new_start - new["offsets"][:-1], new_counts) + np.arange(new_counts.sum())
+
+    rows = np.empty(offsets[-1], dtype=np.int32)
+    tf = np.empty(offsets[-1], dtype=np.int32)
+    rows[old_target], tf[old_target] = old["rows"], old["tf"]
+    rows[new_target], tf[new_target] = new["rows"], new["tf"]
+    return {"vocab": vocab, "offsets": offsets, "rows": rows, "tf": tf,
+            "lengths": np.concatenate([old["lengths"], new["lengths"]])}
+
+
+def index_rows(db_name, collection_name, ids, start=0):
+    """The (row, extracted_text) of the cache rows from `start` onwards."""
+    row_of = {doc_id: row for row, doc_id in enumerate(ids[start:], start)}
+    after_id = ids[start - 1] if start > 0 else None
+    for doc_id, text in fetch_texts(db_name, collection_name, after_id):
+        if doc_id in row_of:  # Documents added after the cache was refreshed wait for the next update
+            yield row_of[doc_id], text
+
+
+def save_postings(index_dir, postings, info):
+    os.makedirs(index_dir, exist_ok=True)
+    for name, values in postings.items():
+        file_name = f"postings_{name}.npy" if name in ("rows", "tf") else f"{name}.npy"
+        save_array(os.path.join(index_dir, file_name), values)
+    info.update({"count": len(postings["lengths"]), "terms": len(postings["vocab"]),
+                 "average_length": float(postings["lengths"].mean()) if len(postings["lengths"]) else 0.0})
+    save_json(os.path.join(index_dir, "info.json"), info)
+    return info
+
+
+def build_lexical_index(db_name, collection_name, index_dir=None):
+    """Builds the BM25 index of the extracted_text of the documents in the embedding cache."""
+    index_dir = index_dir or lexical_directory(db_name, collection_name)
+    _, metadata = load_embedding_cache(db_name, collection_name)
+    ids = metadata["_id"].tolist()
+    print(f"Building the lexical index for {len(ids)} documents")
+
+    postings = build_postings(index_rows(db_name, collection_name, ids), 0, len(ids))
+    info = {"last_id": ids[-1] if ids else None, "built": datetime.now().isoformat()}
+    info = save_postings(index_dir, postings, info)
+    print(f"Indexed {info['terms']} terms in '{index_dir}'")
+    return info
+
+
+def lexical_matches_cache(info, ids):
+    """Whether the index rows are still embedding cache rows, which a rebuilt cache (e.g. after deletions) shifts."""
+    count = info["count"]
+    return len(ids) >= count and (count == 0 or ids[count - 1] == info["last_id"])
+
+
+def update_lexical_index(db_name, collection_name, index_dir=None):
+    """Adds the cache rows after the last indexed document, merging their postings into the index."""
+    index_dir = index_dir or lexical_directory(db_name, collection_name)
+    info_file = os.path.join(index_dir, "info.json")
+    if not os.path.exists(info_file):
+        return build_lexical_index(db_name, collection_name, index_dir)
+
+    with open(info_file, encoding="utf-8") as f:
+        info = json.load(f)
+    _, metadata = load_embedding_cache(db_name, collection_name)
+    ids = metadata["_id"].tolist()
+    count = info["count"]
+
+    if not lexical_matches_cache(info, ids):
+        print("The embedding cache was rebuilt, rebuilding the lexical index.")
+        return build_lexical_index(db_name, collection_name, index_dir)
+    if len(ids) == count:
+        print("Lexical index is up to date.")
+        return info
+    print(f"Adding {len(ids) - count} documents to the lexical index")
+
+    new = build_postings(index_rows(db_name, collection_name, ids, count), count, len(ids) - count)
+    old = open_lexical_index(index_dir)
+    postings = merge_postings(old, new)
+    del old  # Close the memory maps before their files are replaced
+    info.update({"last_id": ids[-1], "updated": datetime.now().isoformat()})
+    return save_postings(index_dir, postings, info)
+
+
+def load_lexical_index(db_name, collection_name, index_dir=None):
+    """
+    Opens the lexical index for searching, with all arrays memory-mapped. An index that no longer lines up with
+    the embedding cache is rebuilt first, so its rows never describe the wrong documents.
+    """
+    index_dir = index_dir or lexical_directory(db_name, collection_name)
+    index = open_lexical_index(index_dir)
+    _, metadata = load_embedding_cache(db_name, collection_name, refresh=False)
+    if not lexical_matches_cache(index, metadata["_id"].tolist()):
+        print("The embedding cache was rebuilt since the lexical index was built, rebuilding the lexical index.")
+        del index  # Close the memory maps before their files are replaced
+        build_lexical_index(db_name, collection_name, index_dir)
+        index = open_lexical_index(index_dir)
+    return index
+
+
+def open_lexical_index(index_dir):
+    with open(os.path.join(index_dir, "info.json"), encoding="utf-8") as f:
+        index = json.load(f)
+    for name, file_name in (("vocab", "vocab"), ("offsets", "offsets"), ("rows", "postings_rows"),
+                            ("tf", "postings_tf"), ("lengths", "lengths")):
+        index[name] = np.load(os.path.join(index_dir, f"{file_name}.npy"), mmap_mode="r")
+    return index
+
+
+def bm25_scores(index, query):
+    """The BM25 scores of the rows containing any term of the query, as (rows, scores)."""
+    vocab, offsets = index["vocab"], index["offsets"]
+    count, average_length = index["count"], index["average_length"] or 1.0
+    all_rows, all_scores = [], []
+    for term in set(tokenize(query)):
+        position = np.searchsorted(vocab, term)
+        if position >= len(vocab) or vocab[position] != term:
+            continue
+        start, end = offsets[position], offsets[position + 1]
+        rows = np.asarray(index["rows"][start:end])
+        tf = np.asarray(index["tf"][start:end], dtype=np.float32)
+        idf = np.log(1 + (count - (end - start) + 0.5) / (end - start + 0.5))
+        length_norm = k1 * (1 - b + b * index["lengths"][rows] / average_length)
+        all_rows.append(rows)
+        all_scores.append(idf * tf * (k1 + 1) / (tf + length_norm))
+
+    if not all_rows:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+    # Sum the scores of the terms per row
+    rows, inverse = np.unique(np.concatenate(all_rows), return_inverse=True)
+    return rows, np.bincount(inverse.ravel(), weights=np.concatenate(all_scores)).astype(np.float32)
+
+
+def search_lexical(index, query, top_k=10, mask=None):
+    """
+    Returns the (rows, scores) of the top_k documents with the highest BM25 score for a query, only among the
+    rows selected by the boolean mask if one is given (see facet_filters.py).
+    """
+    rows, scores = bm25_scores(index, query)
+    if mask is not None:
+        keep = mask[rows]
+        rows, scores = rows[keep], scores[keep]
+    best = top_k_indices(scores[np.newaxis, :], top_k)[0]
+    return rows[best], scores[best]
+
+
+def reciprocal_rank_fusion(rankings, top_k=10, k=rrf_k):
+    """
+    Fuses rankings of rows (best first) by summing 1 / (k + rank) over the rankings each row appears in.
+
+    Returns:
+        tuple: (rows, scores) of the top_k rows by fused score.
+    """
+    fused = defaultdict(float)
+    for ranking in rankings:
+        for rank, row in enumerate(ranking, 1):
+            fused[int(row)] += 1.0 / (k + rank)
+    best = sorted(fused.items(), key=lambda pair: pair[1], reverse=True)[:top_k]
+    return (np.array([row for row, _ in best], dtype=np.int64),
+            np.array([score for _, score in best], dtype=np.float32))
+
+
+def hybrid_rows(queries, query_vectors, corpus, lexical, top_k=10, mask=None, exact=None):
+    """The fused (rows, scores) of every query, from its semantic and its lexical ranking."""
+    dense_rows, _ = search_vectors(query_vectors, corpus, max(top_k, fusion_candidates), mask=mask, exact=exact)
+    fused = [reciprocal_rank_fusion([query_rows, search_lexical(lexical, query, fusion_candidates, mask)[0]],
+                                    top_k)
+             for query, query_rows in zip(queries, dense_rows)]
+    return [rows for rows, _ in fused], [scores for _, scores in fused]
+
+
+def hybrid_search(queries, top_k=10, db_name=database_name, collection_name=collection_name, filters=None):
+    """
+    Searches every query semantically and lexically and fuses both rankings, see search_engine.search().
+    The score of a result is its fused reciprocal rank score.
+    """
+    corpus, metadata = load_corpus(db_name, collection_name)
+    lexical = load_lexical_index(db_name, collection_name)
+    mask = filter_mask(load_facets(db_name, collection_name), **filters) if filters else None
+    rows, scores = hybrid_rows(queries, encode_queries(queries), corpus, lexical, top_k, mask)
+    return [results_for(metadata, query_rows, query_scores) for query_rows, query_scores in zip(rows, scores)]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build the BM25 index used for lexical and hybrid search")
+    parser.add_argument("--update", action="store_true", help="only add documents added since the last build")
+    args = parser.parse_args()
+
+    if args.update:
+        update_lexical_index(database_name, collection_name)
+    else:
+        build_lexical_index(database_name, collection_name)
@@ -0,0 +1,178 @@
+# Scalable 2D projection of document embeddings for the bubble graph reports, for collections where fitting
+# UMAP or t-SNE on every document is too slow (beyond ~50k documents). The reducer is fitted on a sample
+# stratified by file_mimetype, after a PCA pre-reduction to pca_components dimensions, and every other document
+# is then placed a chunk at a time: with the transform of UMAP, openTSNE or PCA, or for scikit-learn's t-SNE
+# (which can't transform) at the distance-weighted mean position of its nearest sample documents.
+# The fitted PCA and reducer are stored in PROJECTION_ROOT, so later runs place new documents without refitting;
+# the sample documents keep the positions they were fitted at. A stored model is refitted once the method, its
+# parameters or the sample settings it was fitted with change.
+
+import os
+
+import joblib
+import numpy as np
+from sklearn.decomposition import PCA
+from sklearn.manifold import TSNE
+from sklearn.neighbors import NearestNeighbors
+
+from vector_index import normalize_rows
+
+try:
+    import umap
+except ImportError:
+    umap = None
+
+try:
+    import openTSNE
+except ImportError:
+    openTSNE = None
+
+PROJECTION_ROOT = "data/projections"
+sample_size = 20000  # Number of documents the reducer is fitted on
+min_per_mimetype = 50  # Every mimetype gets at least this many sample documents (or all it has)
+pca_components = 50  # Dimensions kept by the PCA pre-reduction
+transform_chunk_rows = 10000  # Number of documents projected at once
+placement_neighbors = 10  # Nearest sample documents a t-SNE placement is averaged over
+
+
+def projection_file(db_name, collection_name, method):
+    return os.path.join(PROJECTION_ROOT, f"{db_name}_{collection_name}_{method}.joblib")
+
+
+def projection_settings(method, params):
+    """What a stored model was fitted with, compared before reusing it (the params as given, before any clamping)."""
+    return {"method": method, "params": dict(params), "sample_size": sample_size, "pca_components": pca_components,
+            "min_per_mimetype": min_per_mimetype}
+
+
+def stratified_sample(labels, size, seed=42):
+    """
+    Positions of a random sample of about `size` labels, each label (e.g. mimetype) drawn in proportion to how
+    often it occurs, but at least min_per_mimetype times so rare labels still shape the projection.
+    """
+    labels = np.asarray(labels)
+    if len(labels) <= size:
+        return np.arange(len(labels))
+    rng = np.random.default_rng(seed)
+    values, inverse, counts = np.unique(labels, return_inverse=True, return_counts=True)
+    inverse = inverse.ravel()
+    sample = []
+    for code, count in enumerate(counts):
+        quota = min(count, max(min_per_mimetype, round(size * count / len(labels))))
+        sample.append(rng.choice(np.flatnonzero(inverse == code), quota, replace=False))
+    return np.sort(np.concatenate(sample))
+
+
+def reduced_vectors(embeddings, rows, pca):
+    """The normalized embeddings of the rows after the PCA, read a chunk at a time."""
+    for start in range(0, len(rows), transform_chunk_rows):
+        yield start, pca.transform(normalize_rows(embeddings[rows[start:start + transform_chunk_rows]]))
+
+
+def fit_projection(embeddings, rows, labels, ids, method, params):
+    """
+    Fits the PCA and the reducer on a stratified sample of the rows.
+
+    Args:
+        embeddings: The embeddings (may be memory-mapped).
+        rows (numpy.ndarray): The embedding rows of the documents to project.
+        labels: The file_mimetype of each of those documents, the strata of the sample.
+        ids: The _id of each of those documents.
+        method (str): "umap", "tsne", "opentsne" or "pca".
+        params (dict): The arguments of umap.UMAP, sklearn's TSNE, openTSNE.TSNE or sklearn's PCA.
+
+    Returns:
+        dict: The fitted model, see project_documents().
+    """
+    settings = projection_settings(method, params)
+    sample = stratified_sample(labels, sample_size)
+    sample_vectors = normalize_rows(embeddings[rows[sample]])
+    pca = PCA(n_components=min(pca_components, *sample_vectors.shape), random_state=42).fit(sample_vectors)
+    sample_reduced = pca.transform(sample_vectors)
+    print(f"Fitting {method} on a sample of {len(sample)} of {len(rows)} documents "
+          f"({pca.n_components_} PCA dimensions, {pca.explained_variance_ratio_.sum():.0%} of the variance)")
+
+    reducer = None
+    if method == "umap":
+        if umap is None:
+            raise ImportError("umap-learn is required for the UMAP projection")
+        reducer = umap.UMAP(**params).fit(sample_reduced)
+        sample_coords = reducer.embedding_
+    elif method == "tsne":
+        params = dict(params, perplexity=min(params.get("perplexity", 30), (len(sample) - 1) / 3))
+        sample_coords = TSNE(**params).fit_transform(sample_reduced)
+    elif method == "opentsne":
+        if openTSNE is None:
+            raise ImportError("openTSNE is required for the openTSNE projection")
+        reducer = openTSNE.TSNE(**params).fit(sample_reduced)
+        sample_coords = reducer
+    elif method == "pca":
+        reducer = PCA(**params).fit(sample_reduced)
+        sample_coords = reducer.transform(sample_reduced)
+    else:
+        raise ValueError(f"Unknown projection method: {method}")
+
+    return {"method": method, "params": params, "settings": settings, "pca": pca, "reducer": reducer,
+            "sample_ids": np.asarray(ids)[sample], "sample_reduced": sample_reduced,
+            "sample_coords": np.asarray(sample_coords, dtype=np.float32)}
+
+
+def place(model, reduced, neighbors):
+    """Projects PCA-reduced vectors with a fitted model."""
+    if model["reducer"] is not None:
+        return np.asarray(model["reducer"].transform(reduced))
+    distances, indices = neighbors.kneighbors(reduced)
+    weights = 1 / np.maximum(distances, 1e-9)
+    return np.einsum("nk,nkd->nd", weights, model["sample_coords"][indices]) / weights.sum(axis=1, keepdims=True)
+
+
+def project_documents(embeddings, rows, labels, ids, method, params, model_file=None, refit=False):
+    """
+    Projects documents to 2D, fitting the model on a sample first unless a stored model can be reused.
+
+    Args:
+        embeddings: The embeddings (may be memory-mapped).
+        rows (numpy.ndarray): The embedding rows of the documents to project.
+        labels: The file_mimetype of each of those documents.
+        ids: The _id of each of those documents.
+        method (str): "umap", "tsne", "opentsne" or "pca".
+        params (dict): The arguments of the reducer (see fit_projection()); a stored model fitted with other
+            params or sample settings is refitted.
+        model_file (str): Where the fitted model is stored and reused from, or None to always fit.
+        refit (bool): Fit a new model even if one is stored.
+
+    Returns:
+        numpy.ndarray: The (x, y) of every document.
+    """
+    rows = np.asarray(rows)
+    model = None
+    if model_file and os.path.exists(model_file) and not refit:
+        model = joblib.load(model_file)
+        if model.get("settings") != projection_settings(method, params):
+            print(f"The stored model '{model_file}' was fitted with other settings, refitting")
+            model = None
+    if model is None:
+        model = fit_projection(embeddings, rows, labels, ids, method, params)
+        if model_file:
+            os.makedirs(os.path.dirname(model_file) or ".", exist_ok=True)
+            joblib.dump(model, model_file)
+            print(f"Projection model saved to '{model_file}'")
+    else:
+        print(f"Placing {len(rows)} documents with the stored {method} model '{model_file}'")
+
+    neighbors = None
+    if model["reducer"] is None:
+        neighbors = NearestNeighbors(n_neighbors=min(placement_neighbors, len(model["sample_reduced"])))
+        neighbors.fit(model["sample_reduced"])
+
+    coords = np.empty((len(rows), 2), dtype=np.float32)
+    for start, reduced in reduced_vectors(embeddings, rows, model["pca"]):
+        coords[start:start + len(reduced)] = place(model, reduced, neighbors)
+
+    # The sample documents keep the positions they were fitted at
+    positions = {doc_id: position for position, doc_id in enumerate(model["sample_ids"])}
+    fitted = [(row, positions[doc_id]) for row, doc_id in enumerate(ids) if doc_id in positions]
+    if fitted:
+        targets, sources = np.array(fitted).T
+        coords[targets] = model["sample_coords"][sources]
+    return coords
@@ -0,0 +1,454 @@
+# Bubble graphs of the text documents of a collection (TEXT_MIMETYPES, at least min_word_count words): every
+# document is a bubble sized by its word count and coloured by its mimetype, positioned by a 2D projection of its
+# embedding. The embeddings and metadata are loaded once from the embedding cache (see embedding_cache.py) and
+# projected with one or more methods:
+#   umap      UMAP (umap-learn)
+#   tsne      scikit-learn's t-SNE
+#   opentsne  openTSNE's FFT-accelerated t-SNE, when it is installed
+#   pca       the first two principal components
+# Large collections are projected by fitting on a sample (see projection.py). Every projection is cached in
+# PROJECTION_ROOT under a hash of its method, parameters, mode and documents, so restyling a plot or adding a
+# method doesn't compute the other projections again.
+#
+# Graphs are rendered according to render_mode:
+#   svg         every bubble with its hover text in the HTML file, fine up to some ten thousand documents
+#   webgl       bubbles drawn with WebGL (scattergl) and no hover text in the file: the details of a hovered
+#               document are looked up in a side index (<graph>_hover.js), loaded on the first hover
+#   datashader  the documents rasterised by datashader into one image, for millions of documents; hovering
+#               shows the document nearest to the pointer from the same side index
+# The size of the written files is printed, and the page shows (and logs) how long the browser took to render it.
+#
+#     python report_cluster_bubblegraph.py --methods umap tsne pca
+#     python report_cluster_bubblegraph.py --methods opentsne --mode sample --refit
+#     python report_cluster_bubblegraph.py --render webgl
+
+import argparse
+import datetime
+import hashlib
+import json
+import os
+
+import numpy as np
+import pandas as pd
+import plotly.express as px
+import plotly.graph_objects as go
+from sklearn.decomposition import PCA
+from sklearn.manifold import TSNE
+from sklearn.preprocessing import StandardScaler
+
+from embedding_cache import load_embedding_cache
+import projection
+from projection import PROJECTION_ROOT, project_documents, projection_file
+
+try:
+    import umap
+except ImportError:
+    umap = None
+
+try:
+    import openTSNE
+except ImportError:
+    openTSNE = None
+
+try:
+    import datashader as ds
+    import datashader.transfer_functions as tf
+except ImportError:
+    ds = None
+
+database_name = "MODAL_testdata"
+collection_name = "LH_JPearce"
+output_dir = "/home/henk/DATABLE/1_Projecten/2024_MODAL/3_Data/similarities"
+output_pattern = "{collection}_document_similarity_texts_{method}.html"
+
+TEXT_MIMETYPES = [
+    "application/msword",
+    "application/vnd.wordperfect; version=5.1",
+    "application/vnd.wordperfect; version=5.0",
+    "application/rtf",
+    "application/pdf",
+    "application/vnd.ms-works",
+    "application/x-tika-msoffice",
+    "application/vnd.oasis.opendocument.tika.flat.document",
+    "application/vnd.ms-word.document.macroenabled.12",
+    "application/msword2",
+    "application/vnd.wordperfect",
+    "application/x-mspublisher",
+    "application/vnd.openxmlformats-officedocument.presentationml.presentation",
+    "application/vnd.openxmlformats-officedocument.presentationml.slideshow",
+    "application/vnd.oasis.opendocument.text",
+    "application/vnd.oasis.opendocument.presentation",
+    "message/rfc822",
+    "application/vnd.openxmlformats-officedocument.wordprocessingml.document",
+    "message/x-emlx",
+    "application/vnd.ms-powerpoint",
+    "application/vnd.wordperfect; version=6.x",
+]
+min_word_count = 20
+projection_mode = "auto"  # "full" fits on every document, "sample" on a sample (see projection.py), "auto" picks
+full_fit_limit = 50000  # "auto" fits on every document up to this many documents
+render_mode = "auto"  # "svg", "webgl", "datashader", or "auto" to pick by the number of documents
+svg_point_limit = 20000  # "auto" renders up to this many documents as svg, more with webgl
+webgl_point_limit = 1000000  # ... and more than this with datashader, when it is installed
+raster_size = (1600, 1200)  # Width and height in pixels of the datashader image
+hover_grid = 200  # Cells per axis in which datashader hovers look up the nearest document
+
+METHOD_PARAMS = {
+    "umap": dict(
+        n_neighbors=50,  # More neighbors for better global structure
+        min_dist=0.2,  # Adjust separation between clusters
+        metric='cosine',  # Select 'euclidian' or 'cosine' if needed
+        random_state=42,
+        init='random'  # Avoid spectral initialization issues
+    ),
+    "tsne": dict(n_components=2, random_state=42, perplexity=50, learning_rate=300),
+    "opentsne": dict(perplexity=50, negative_gradient_method="fft", random_state=42, n_jobs=-1),
+    "pca": dict(n_components=2, random_state=42),
+}
+METHOD_TITLES = {"umap": "UMAP", "tsne": "t-SNE", "opentsne": "openTSNE", "pca": "PCA"}
+METHOD_FILE_NAMES = {"umap": "UMAP", "tsne": "tSNE", "opentsne": "openTSNE", "pca": "PCA"}
+# The hover label of the creation date, where a graph had its own before the reports were merged
+DATE_LABELS = {"tsne": "Date Created"}
+
+
+def format_date(date_created):
+    """Formats an ISO creation_date as YYYY-MM-DD, or "Unknown"."""
+    if isinstance(date_created, str):
+        try:
+            return datetime.datetime.fromisoformat(date_created.replace('Z', '+00:00')).strftime('%Y-%m-%d')
+        except ValueError:
+            pass
+    return "Unknown"
+
+
+def load_documents(db_name, collection_name):
+    """
+    The text documents to plot, from the embedding cache.
+
+    Returns:
+        tuple: (embeddings, rows, documents) with the (memory-mapped) cache embeddings, the embedding rows of the
+        selected documents and their plot columns, or None when there are no such documents.
+    """
+    embeddings, metadata = load_embedding_cache(db_name, collection_name)
+    selected = metadata["file_mimetype"].isin(TEXT_MIMETYPES) & (metadata["word_count"] >= min_word_count)
+    if not selected.any() or not len(embeddings):
+        return None
+
+    documents = metadata[selected]
+    plot_columns = pd.DataFrame({
+        '_id': documents['_id'].to_numpy(),
+        'File Path': documents['file_path'].to_numpy(),
+        'Word Count': documents['word_count'].to_numpy(),
+        'MIME Type': documents['file_mimetype'].to_numpy(),
+        'Creation Date': [format_date(date_created) for date_created in documents['creation_date']],
+        'Text': documents['text_preview'].to_numpy()
+    })
+    return embeddings, np.flatnonzero(selected.to_numpy()), plot_columns
+
+
+def resolve_mode(mode, document_count):
+    if mode == "auto":
+        return "full" if document_count <= full_fit_limit else "sample"
+    return mode
+
+
+def projection_key(method, params, mode, ids):
+    """A hash of everything a projection depends on, naming its cache file."""
+    settings = {"method": method, "params": params, "mode": mode}
+    if mode == "sample":
+        settings.update(sample_size=projection.sample_size, min_per_mimetype=projection.min_per_mimetype,
+                        pca_components=projection.pca_components)
+    digest = hashlib.sha256(json.dumps(settings, sort_keys=True, default=str).encode("utf-8"))
+    digest.update("\n".join(ids).encode("utf-8"))
+    return digest.hexdigest()[:16]
+
+
+def fit_full(embeddings, method, params):
+    """Projects all the (in-memory) embeddings at once."""
+    if method == "umap":
+        if umap is None:
+            raise ImportError("umap-learn is required for the UMAP projection")
+        # Normalize embeddings for better clustering
+        embeddings = StandardScaler().fit_transform(embeddings)
+        # Add small random noise to prevent numerical issues
+        embeddings += np.random.normal(0, 0.01, embeddings.shape)
+        return umap.UMAP(**params).fit_transform(embeddings)
+    if method == "tsne":
+        return TSNE(**params).fit_transform(embeddings)
+    if method == "opentsne":
+        if openTSNE is None:
+            raise ImportError("openTSNE is required for the openTSNE projection")
+        return np.asarray(openTSNE.TSNE(**params).fit(embeddings))
+    if method == "pca":
+        return PCA(**params).fit_transform(embeddings)
+    raise ValueError(f"Unknown projection method: {method}")
+
+
+def project(db_name, collection_name, embeddings, rows, documents, method, mode=projection_mode, refit=False):
+    """The 2D positions of the documents with a method, from the projection cache or computed and cached."""
+    params = METHOD_PARAMS[method]
+    mode = resolve_mode(mode, len(rows))
+    key = projection_key(method, params, mode, documents['_id'].tolist())
+    cache_file = os.path.join(PROJECTION_ROOT, f"{db_name}_{collection_name}_{method}_{key}.npy")
+    if os.path.exists(cache_file) and not refit:
+        print(f"Using the cached {method} projection '{cache_file}'")
+        return np.load(cache_file)
+
+    if mode == "sample":
+        coords = project_documents(embeddings, rows, documents['MIME Type'].to_numpy(), documents['_id'].to_numpy(),
+                                   method, params, projection_file(db_name, collection_name, method), refit=refit)
+    else:
+        print(f"Fitting {method} on {len(rows)} documents")
+        coords = fit_full(np.asarray(embeddings[rows], dtype=np.float64), method, params)
+
+    coords = np.asarray(coords, dtype=np.float32)
+    os.makedirs(PROJECTION_ROOT, exist_ok=True)
+    np.save(cache_file, coords)
+    return coords
+
+
+def resolve_render_mode(mode, document_count):
+    if mode != "auto":
+        return mode
+    if document_count <= svg_point_limit:
+        return "svg"
+    return "datashader" if ds is not None and document_count > webgl_point_limit else "webgl"
+
+
+def hover_file_name(output_file):
+    return os.path.splitext(output_file)[0] + "_hover.js"
+
+
+def write_hover_index(documents, output_file, cells=None):
+    """
+    Writes the hover details of every document to a script next to the graph, which defines
+    window.bubbleHoverIndex. A script (rather than JSON) can be loaded from a local file by the browser.
+    """
+    index = {column: documents[column].tolist() for column in ('File Path', 'MIME Type', 'Word Count',
+                                                               'Creation Date', 'Text')}
+    if cells is not None:
+        index["cells"] = cells
+    hover_file = hover_file_name(output_file)
+    with open(hover_file, "w", encoding="utf-8") as f:
+        f.write("window.bubbleHoverIndex = ")
+        json.dump(index, f, ensure_ascii=False, separators=(",", ":"))
+        f.write(";\n")
+    return hover_file
+
+
+def cell_index(coords, x_range, y_range):
+    """Groups the documents by hover_grid cell: the rows ordered by cell, and where each cell starts."""
+    cell_x = np.clip(((coords[:, 0] - x_range[0]) / (x_range[1] - x_range[0]) * hover_grid).astype(int),
+                     0, hover_grid - 1)
+    cell_y = np.clip(((coords[:, 1] - y_range[0]) / (y_range[1] - y_range[0]) * hover_grid).astype(int),
+                     0, hover_grid - 1)
+    cells = cell_y * hover_grid + cell_x
+    order = np.argsort(cells, kind="stable")
+    offsets = np.zeros(hover_grid * hover_grid + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum(np.bincount(cells, minlength=hover_grid * hover_grid))
+    return {"grid": hover_grid, "x_range": list(x_range), "y_range": list(y_range),
+            "order": order.tolist(), "offsets": offsets.tolist(),
+            "x": np.round(coords[:, 0], 4).tolist(), "y": np.round(coords[:, 1], 4).tolist()}
+
+
+# Runs once the graph is drawn: shows how long the page took to render, and shows the details of hovered
+# documents from the side index (see write_hover_index), which is only loaded on the first hover
+PAGE_SCRIPT = """
+var gd = document.getElementById('{plot_id}');
+var renderTime = performance.now();
+var status = document.createElement('div');
+status.style.cssText = 'font: 12px sans-serif; color: #555; margin: 4px 8px';
+status.textContent = 'Rendered %(points)d documents in ' + Math.round(renderTime) + ' ms';
+gd.parentNode.insertBefore(status, gd.nextSibling);
+console.log(status.textContent);
+
+var hoverFile = %(hover_file)s;
+if (hoverFile) {
+    var panel = document.createElement('pre');
+    panel.style.cssText = 'font: 12px sans-serif; white-space: pre-wrap; margin: 4px 8px';
+    status.parentNode.insertBefore(panel, status.nextSibling);
+    var waiting = null;
+    var withIndex = function(callback) {
+        if (window.bubbleHoverIndex) { callback(window.bubbleHoverIndex); return; }
+        var loading = waiting !== null;
+        waiting = callback;  // only the latest hover is shown once the index has loaded
+        if (!loading) {
+            panel.textContent = 'Loading the document details...';
+            var script = document.createElement('script');
+            script.src = hoverFile;
+            script.onload = function() { waiting(window.bubbleHoverIndex); };
+            document.head.appendChild(script);
+        }
+    };
+    var nearestRow = function(index, x, y) {
+        var cells = index.cells, grid = cells.grid;
+        var cellOf = function(value, range) {
+            return Math.min(grid - 1, Math.max(0, Math.floor((value - range[0]) / (range[1] - range[0]) * grid)));
+        };
+        var cell = cellOf(y, cells.y_range) * grid + cellOf(x, cells.x_range), best = -1, bestDistance = Infinity;
+        for (var i = cells.offsets[cell]; i < cells.offsets[cell + 1]; i++) {
+            var row = cells.order[i], dx = cells.x[row] - x, dy = cells.y[row] - y;
+            if (dx * dx + dy * dy < bestDistance) { best = row; bestDistance = dx * dx + dy * dy; }
+        }
+        return best;
+    };
+    gd.on('plotly_hover', function(event) {
+        var point = event.points[0];
+        withIndex(function(index) {
+            var row = point.customdata !== undefined ? point.customdata[0] : nearestRow(index, point.x, point.y);
+            if (row < 0) { panel.textContent = ''; return; }
+            panel.textContent = index['File Path'][row] + '\\n' + index['MIME Type'][row] + ', ' +
+                index['Word Count'][row] + ' words, created ' + index['Creation Date'][row] + '\\n' +
+                index['Text'][row];
+        });
+    });
+}
+"""
+
+
+def page_script(point_count, hover_file=None):
+    return PAGE_SCRIPT % {"points": point_count,
+                          "hover_file": json.dumps(os.path.basename(hover_file) if hover_file else None)}
+
+
+def plot_svg(df, title, date_label='Creation Date'):
+    return px.scatter(
+        df,
+        x='Dimension 1',
+        y='Dimension 2',
+        hover_name='File Path',
+        hover_data={'MIME Type': True, 'Word Count': True, 'Creation Date': True, 'Text': True},
+        labels={'Creation Date': date_label},
+        color='MIME Type',  # Color by MIME type
+        size='Word Count',
+        size_max=100,
+        title=title
+    )
+
+
+def plot_webgl(df, title):
+    # Only the row of every document goes into the graph, its details are looked up in the hover index
+    fig = px.scatter(
+        df.assign(Row=np.arange(len(df))),
+        x='Dimension 1',
+        y='Dimension 2',
+        custom_data=['Row'],
+        color='MIME Type',  # Color by MIME type
+        size='Word Count',
+        size_max=100,
+        render_mode='webgl',
+        title=title
+    )
+    fig.update_traces(hoverinfo="none", hovertemplate=None)
+    return fig
+
+
+def mimetype_colors(mimetypes):
+    """A color per mimetype, the most common first."""
+    palette = px.colors.qualitative.Alphabet
+    return {mimetype: palette[i % len(palette)]
+            for i, mimetype in enumerate(pd.Series(mimetypes).value_counts().index)}
+
+
+def plot_datashader(df, coords, title):
+    """The documents rasterised into one image, with an invisible grid on top that reports hovers."""
+    if ds is None:
+        raise ImportError("datashader is required for the datashader render mode")
+    x_range, y_range = [(float(axis.min()), float(axis.max()) + 1e-9) for axis in (coords[:, 0], coords[:, 1])]
+    points = pd.DataFrame({"x": coords[:, 0], "y": coords[:, 1], "mimetype": pd.Categorical(df['MIME Type'])})
+    colors = mimetype_colors(df['MIME Type'])
+
+    canvas = ds.Canvas(plot_width=raster_size[0], plot_height=raster_size[1], x_range=x_range, y_range=y_range)
+    aggregate = canvas.points(points, "x", "y", ds.count_cat("mimetype"))
+    image = tf.dynspread(tf.shade(aggregate, color_key=colors, how="eq_hist"), threshold=0.5, max_px=3)
+
+    fig = go.Figure()
+    fig.add_layout_image(source=image.to_pil(), xref="x", yref="y", x=x_range[0], y=y_range[1],
+                         sizex=x_range[1] - x_range[0], sizey=y_range[1] - y_range[0], sizing="stretch",
+                         layer="below")
+    counts, x_edges, y_edges = np.histogram2d(coords[:, 0], coords[:, 1], bins=hover_grid, range=[x_range, y_range])
+    fig.add_trace(go.Heatmap(z=counts.T, x=(x_edges[:-1] + x_edges[1:]) / 2, y=(y_edges[:-1] + y_edges[1:]) / 2,
+                             opacity=0, showscale=False, hovertemplate="%{z} documents<extra></extra>"))
+    # Legend entries for the colors of the image
+    for mimetype, color in colors.items():
+        fig.add_trace(go.Scattergl(x=[None], y=[None], mode="markers", marker=dict(color=color), name=mimetype))
+    fig.update_layout(title=title, xaxis=dict(range=x_range, title='Dimension 1'),
+                      yaxis=dict(range=y_range, title='Dimension 2'), legend_title_text='MIME Type')
+    return fig, cell_index(coords, x_range, y_range)
+
+
+def plot_bubblegraph(documents, coords, collection_name, method, output_file, render=render_mode):
+    df = documents.drop(columns='_id').assign(**{'Dimension 1': coords[:, 0], 'Dimension 2': coords[:, 1]})
+    title = f"{collection_name} Document Similarity Visualization ({METHOD_TITLES[method]})"
+    render = resolve_render_mode(render, len(df))
+
+    hover_file = None
+    if render == "svg":
+        fig = plot_svg(df, title, DATE_LABELS.get(method, 'Creation Date'))
+    elif render == "webgl":
+        fig = plot_webgl(df, title)
+        hover_file = write_hover_index(df, output_file)
+    elif render == "datashader":
+        fig, cells = plot_datashader(df, coords, title)
+        hover_file = write_hover_index(df, output_file, cells)
+    else:
+        raise ValueError(f"Unknown render mode: {render}")
+
+    # Large graphs share one plotly.min.js next to them instead of embedding it in every file
+    include_plotlyjs = True if render == "svg" else "directory"
+    fig.write_html(output_file, include_plotlyjs=include_plotlyjs, post_script=page_script(len(df), hover_file))
+
+    files = [output_file] + ([hover_file] if hover_file else [])
+    if include_plotlyjs == "directory":
+        files.append(os.path.join(os.path.dirname(output_file), "plotly.min.js"))
+    sizes = ", ".join(f"{os.path.basename(file)} {os.path.getsize(file) / 2 ** 20:.1f} MB" for file in files)
+    print(f"Interactive plot ({render}) saved to '{output_file}': {sizes}")
+
+
+def report_projections(db_name, collection_name, methods, output_dir=output_dir, pattern=output_pattern,
+                       mode=projection_mode, refit=False, render=render_mode):
+    """
+    Writes an interactive bubble graph per projection method, loading the documents once.
+
+    Args:
+        db_name (str): The name of the MongoDB database.
+        collection_name (str): The name of the MongoDB collection.
+        methods (list[str]): The projection methods, keys of METHOD_PARAMS.
+        output_dir (str): The folder of the HTML files.
+        pattern (str): The file name of each graph, with {collection} and {method} filled in.
+        mode (str): "full", "sample" or "auto", see projection_mode.
+        refit (bool): Compute the projections again instead of using the cached ones.
+        render (str): "svg", "webgl", "datashader" or "auto", see render_mode.
+    """
+    loaded = load_documents(db_name, collection_name)
+    if loaded is None:
+        print("No documents with valid embeddings found.")
+        return
+    embeddings, rows, documents = loaded
+
+    for method in methods:
+        coords = project(db_name, collection_name, embeddings, rows, documents, method, mode, refit)
+        output_file = os.path.join(output_dir, pattern.format(collection=collection_name,
+                                                              method=METHOD_FILE_NAMES[method]))
+        plot_bubblegraph(documents, coords, collection_name, method, output_file, render)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Bubble graphs of the documents of a collection")
+    parser.add_argument("--db", default=database_name)
+    parser.add_argument("--collection", default=collection_name)
+    parser.add_argument("--methods", nargs="+", choices=list(METHOD_PARAMS), default=["umap"])
+    parser.add_argument("--mode", choices=["auto", "full", "sample"], default=projection_mode,
+                        help="fit on every document, or on a sample and place the others")
+    parser.add_argument("--refit", action="store_true", help="compute the projections again instead of using the cache")
+    parser.add_argument("--render", choices=["auto", "svg", "webgl", "datashader"], default=render_mode,
+                        help="how the bubbles are drawn, see the top of this file")
+    parser.add_argument("--output-dir", default=output_dir)
+    args = parser.parse_args()
+
+    report_projections(args.db, args.collection, args.methods, args.output_dir, mode=args.mode, refit=args.refit,
+                       render=args.render)
+
+
+if __name__ == "__main__":
+    main()
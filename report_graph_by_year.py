@@ -0,0 +1,300 @@
+# Year reports for the items of one or more fields (NER persons, organisations, correspondents, ...): per field a
+# line plot and heatmap of the relative frequency of the top items per year, and the year matrices as CSV.
+# All fields are counted in one scan of the collection (see year_counts.py) into sparse item by year matrices;
+# only the top items are ever turned into a dense table.
+#
+#     python report_graph_by_year.py --collection LH_HH_71_Kristien_Hemmerechts \
+#         --enrichment-fields NER_persons NER_organisations NER_locations \
+#         --document-fields recipient_name sender_name --name-filter emmerechts
+#     python report_graph_by_year.py --render html  # interactive Plotly figures instead of PNGs
+#     python report_graph_by_year.py --render none  # only the CSVs
+
+import argparse
+import csv
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pymongo
+import pandas as pd
+import matplotlib
+matplotlib.use("Agg")  # Figures are only saved to files, also from the render worker processes
+import matplotlib.pyplot as plt
+import seaborn as sns
+
+try:
+    import plotly.graph_objects as go
+except ImportError:
+    go = None
+
+from year_counts import count_fields_by_year
+
+# Default settings
+mongo_uri = "mongodb://localhost:27017/"
+DB_NAME = "MODAL_data"
+COLLECTION_NAME = "collection_name"
+output_dir = "/home/henk/DATABLE/1_Projecten/2024_MODAL/3_Data/exports"
+top_n = 50  # Number of top items to display
+min_occurrences = 1  # Minimum number of occurrences to include in analysis
+enrichment_fields = ["NER_persons", "NER_organisations", "NER_locations"]  # Fields of the first enrichment
+document_fields = ["recipient_name", "sender_name"]  # Fields of the document itself
+render = "png"  # "png", "html" (interactive Plotly figures, needs plotly) or "none" to only write the CSVs
+render_workers = min(4, os.cpu_count() or 1)  # Number of processes rendering figures in parallel
+
+
+def item_label(field, source):
+    """The name of one item of a field, e.g. "person" for NER_persons."""
+    return field.split('_')[-1].rstrip('s') if source == "enrichments" else field
+
+
+def filter_items(items, years, matrix, min_occurrences=1):
+    """
+    Keeps the items with at least min_occurrences, and the years in which any of them occurs.
+
+    Returns:
+        tuple: (items, years, matrix, totals) with the total occurrences of every remaining item.
+    """
+    totals = np.asarray(matrix.sum(axis=1)).ravel()
+    keep = np.flatnonzero(totals >= min_occurrences)
+    matrix = matrix[keep]
+    used_years = np.flatnonzero(matrix.getnnz(axis=0))
+    return items[keep], years[used_years], matrix[:, used_years], totals[keep]
+
+
+def percentage_matrix(items, years, matrix, totals, year_totals, top_n=50, index_name=None):
+    """
+    Returns the total occurrences of the top_n items (sorted) and their item by year matrix as percentages
+    of all occurrences in each year; only these top_n rows are ever made dense.
+    """
+    # Select top N most frequently mentioned items
+    top = np.argsort(-totals, kind="stable")[:top_n]
+    index = pd.Index(items[top], name=index_name)
+
+    # Convert absolute numbers to percentages; only stored (non-zero) counts are divided, so a year
+    # without occurrences is never divided by its zero total
+    percentages = matrix[top].astype(np.float64)
+    percentages.data = percentages.data / year_totals[percentages.indices] * 100
+    return pd.Series(totals[top], index=index), pd.DataFrame(percentages.toarray(), index=index, columns=years)
+
+
+def write_sparse_csv(output_file, index_name, items, years, matrix, chunk_rows=10000):
+    """Writes the item by year matrix as CSV (like DataFrame.to_csv), densifying chunk_rows rows at a time."""
+    with open(output_file, "w", newline="", encoding="utf-8") as f:
+        writer = csv.writer(f, lineterminator="\n")
+        writer.writerow([index_name] + years.tolist())
+        for start in range(0, matrix.shape[0], chunk_rows):
+            block = matrix[start:start + chunk_rows].toarray().tolist()
+            writer.writerows([item] + row for item, row in zip(items[start:start + chunk_rows].tolist(), block))
+
+
+def plot_line(df_percentages, item_name, top_n, output_file):
+    plt.figure(figsize=(15, 8))
+    for item in df_percentages.index:
+        plt.plot(df_percentages.columns, df_percentages.loc[item], marker='o', label=item)
+
+    plt.title(f'Relative Frequency of Top {top_n} {item_name.title()}s Over Time (% per year)', pad=20)
+    plt.xlabel('Year')
+    plt.ylabel('Percentage of Total Occurrences')
+    plt.legend(bbox_to_anchor=(1.05, 1), loc='upper left')
+    plt.grid(True)
+    plt.tight_layout()
+    plt.savefig(output_file, dpi=300, bbox_inches='tight')
+    plt.close()
+
+
+def plot_heatmap(df_percentages, item_name, output_file):
+    plt.figure(figsize=(15, max(10, len(df_percentages) * 0.3)))  # Dynamic height based on number of rows
+
+    sns.heatmap(df_percentages, cmap='YlOrRd', annot=True, fmt='.1f',
+                cbar_kws={'label': 'Percentage of Total Occurrences'})
+    plt.title(f'Heatmap of {item_name.title()} Relative Frequency by Year (%)', pad=20)
+    plt.xlabel('Year')
+    plt.ylabel(item_name.capitalize())
+
+    # Rotate x-axis labels for better readability
+    plt.xticks(rotation=45)
+
+    # Adjust layout to prevent label cutoff
+    plt.tight_layout()
+    plt.savefig(output_file, dpi=300, bbox_inches='tight')
+    plt.close()
+
+
+def plot_line_html(df_percentages, item_name, top_n, output_file):
+    fig = go.Figure()
+    for item in df_percentages.index:
+        fig.add_trace(go.Scatter(x=df_percentages.columns.tolist(), y=df_percentages.loc[item].tolist(),
+                                 mode="lines+markers", name=str(item)))
+    fig.update_layout(title=f'Relative Frequency of Top {top_n} {item_name.title()}s Over Time (% per year)',
+                      xaxis_title='Year', yaxis_title='Percentage of Total Occurrences')
+    fig.write_html(output_file, include_plotlyjs="cdn")
+
+
+def plot_heatmap_html(df_percentages, item_name, output_file):
+    fig = go.Figure(go.Heatmap(
+        z=df_percentages.values,
+        x=[str(year) for year in df_percentages.columns],
+        y=[str(item) for item in df_percentages.index],
+        text=np.round(df_percentages.values, 1),
+        texttemplate="%{text}",
+        colorscale="YlOrRd",
+        colorbar={"title": "Percentage of Total Occurrences"}
+    ))
+    fig.update_layout(title=f'Heatmap of {item_name.title()} Relative Frequency by Year (%)',
+                      xaxis_title='Year', yaxis_title=item_name.capitalize(),
+                      height=max(700, len(df_percentages) * 22))
+    fig.update_yaxes(autorange="reversed")  # First (most frequent) item on top, like the PNG heatmap
+    fig.write_html(output_file, include_plotlyjs="cdn")
+
+
+def render_figure(task):
+    """Renders one figure from a (render, kind, df_percentages, item_name, top_n, output_file) task."""
+    render, kind, df_percentages, item_name, top_n, output_file = task
+    if render == "html":
+        if kind == "line":
+            plot_line_html(df_percentages, item_name, top_n, output_file)
+        else:
+            plot_heatmap_html(df_percentages, item_name, output_file)
+    else:
+        sns.set_theme()
+        if kind == "line":
+            plot_line(df_percentages, item_name, top_n, output_file)
+        else:
+            plot_heatmap(df_percentages, item_name, output_file)
+    return output_file
+
+
+def render_figures(tasks, workers=render_workers):
+    """Renders the figures in a pool of worker processes, as rendering takes longer than the counting."""
+    if workers > 1 and len(tasks) > 1:
+        with ProcessPoolExecutor(max_workers=min(workers, len(tasks))) as executor:
+            return list(executor.map(render_figure, tasks))
+    return [render_figure(task) for task in tasks]
+
+
+def write_field_report(collection_name, field, item_name, counts, output_dir, top_n=50, min_occurrences=1,
+                       render="png", sketch_capacity=None):
+    """Writes the CSVs of one field, prints its statistics and returns the figures to render."""
+    all_items, all_years, all_matrix, year_totals = counts
+    if not len(all_items):
+        print(f"\nNo items with a valid year found for '{field}', skipping.")
+        return []
+
+    index_name = item_name.capitalize()
+    items, years, matrix, totals = filter_items(all_items, all_years, all_matrix, min_occurrences)
+    top_totals, df_percentages = percentage_matrix(items, years, matrix, totals,
+                                                   year_totals[np.searchsorted(all_years, years)], top_n, index_name)
+    prefix = os.path.join(output_dir, f"{collection_name}_{field}")
+
+    # Save both absolute and percentage data to CSV
+    output_file_abs = f"{prefix}_year_matrix_absolute_min{min_occurrences}.csv"
+    output_file_pct = f"{prefix}_year_matrix_percentage_min{min_occurrences}.csv"
+    write_sparse_csv(output_file_abs, index_name, items, years, matrix)
+    df_percentages.to_csv(output_file_pct)
+
+    print(f"\n=== {field} ===")
+    print(f"Absolute numbers exported to {output_file_abs}")
+    print(f"Percentages exported to {output_file_pct}")
+
+    # Print statistics
+    if sketch_capacity:
+        print(f"\nApproximate counts (Space-Saving, {len(all_items)} of at most {sketch_capacity} {item_name}s kept): "
+              f"every count is at most {year_totals.sum() / sketch_capacity:.1f} below the true count "
+              f"(total occurrences / {sketch_capacity})")
+    else:
+        print(f"\nTotal number of unique {item_name}s: {len(all_items)}")
+    print(f"Number of {item_name}s with ≥{min_occurrences} occurrences: {len(items)}")
+
+    # Display total occurrences and yearly totals
+    print(f"\nTotal occurrences for top {top_n} {item_name}s:")
+    print(top_totals)
+    print("\nTotal occurrences per year:")
+    print(pd.Series(year_totals, index=all_years))
+
+    # Visualizations, rendered later for all fields together
+    if render == "none":
+        return []
+    extension = "html" if render == "html" else "png"
+    return [
+        (render, "line", df_percentages, item_name, top_n, f"{prefix}_line_plot_percentage.{extension}"),
+        (render, "heatmap", df_percentages, item_name, top_n, f"{prefix}_heatmap_percentage.{extension}")
+    ]
+
+
+def report_fields(collection, collection_name, fields, output_dir=output_dir, top_n=50, min_occurrences=1,
+                  name_filter=None, use_aggregation=True, item_names=None, render=render, workers=render_workers,
+                  sketch_capacity=None):
+    """
+    Counts all fields in one scan of the collection and writes the report of every field.
+
+    Args:
+        collection: The MongoDB collection.
+        collection_name (str): Used in the names of the output files.
+        fields (dict): The source ("enrichments" or "document") of every field, see count_fields_by_year().
+        output_dir (str): The directory the CSVs and plots are written to.
+        top_n (int): Number of top items in the plots and the percentage matrix.
+        min_occurrences (int): Minimum number of occurrences of an item in the absolute matrix.
+        name_filter (str): Leave out document items containing this (lowercase) text, e.g. the archive creator.
+        use_aggregation (bool): Count on the server instead of reading the documents.
+        item_names (dict): Optional item names per field for titles and labels, see item_label().
+        render (str): "png", "html" for interactive Plotly figures, or "none" to only write the CSVs.
+        workers (int): Number of processes rendering the figures.
+        sketch_capacity (int): Approximate the counts in bounded memory by keeping only this many items per
+            field (see heavy_hitters.py); None counts every item exactly.
+    """
+    if render not in ("png", "html", "none"):
+        raise ValueError(f"Unknown render mode: {render}")
+    if render == "html" and go is None:
+        raise ImportError("render='html' needs plotly (pip install plotly)")
+
+    os.makedirs(output_dir, exist_ok=True)
+    counts = count_fields_by_year(collection, fields, name_filter, use_aggregation, sketch_capacity)
+    figures = []
+    for field, source in fields.items():
+        item_name = (item_names or {}).get(field) or item_label(field, source)
+        figures += write_field_report(collection_name, field, item_name, counts[field], output_dir, top_n,
+                                      min_occurrences, render, sketch_capacity)
+
+    if figures:
+        print(f"\nRendering {len(figures)} figures")
+        for output_file in render_figures(figures, workers):
+            print(f"Figure saved to {output_file}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Year reports for the items of one or more fields")
+    parser.add_argument("--mongo-uri", default=mongo_uri)
+    parser.add_argument("--db", default=DB_NAME)
+    parser.add_argument("--collection", default=COLLECTION_NAME)
+    parser.add_argument("--enrichment-fields", nargs="*", default=enrichment_fields,
+                        help="fields read from the first enrichment, e.g. NER_persons")
+    parser.add_argument("--document-fields", nargs="*", default=document_fields,
+                        help="array fields of the document itself, e.g. recipient_name")
+    parser.add_argument("--name-filter", help="leave out document items containing this text")
+    parser.add_argument("--top-n", type=int, default=top_n)
+    parser.add_argument("--min-occurrences", type=int, default=min_occurrences)
+    parser.add_argument("--output-dir", default=output_dir)
+    parser.add_argument("--render", choices=["png", "html", "none"], default=render,
+                        help="PNG figures, interactive Plotly HTML figures, or none (only the CSVs)")
+    parser.add_argument("--workers", type=int, default=render_workers, help="processes rendering the figures")
+    parser.add_argument("--sketch", type=int, metavar="K",
+                        help="approximate the counts in bounded memory, keeping only the K most frequent items")
+    parser.add_argument("--no-aggregation", action="store_true",
+                        help="read the documents and count in Python instead of on the server")
+    args = parser.parse_args()
+
+    fields = {field: "enrichments" for field in args.enrichment_fields}
+    fields.update({field: "document" for field in args.document_fields})
+    if not fields:
+        parser.error("no fields given")
+
+    client = pymongo.MongoClient(args.mongo_uri)
+    collection = client[args.db][args.collection]
+    report_fields(collection, args.collection, fields, args.output_dir, args.top_n, args.min_occurrences,
+                  name_filter=args.name_filter.lower() if args.name_filter else None,
+                  use_aggregation=not args.no_aggregation, render=args.render, workers=args.workers,
+                  sketch_capacity=args.sketch)
+
+
+if __name__ == "__main__":
+    main()
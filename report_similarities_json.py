@@ -1,91 +1,194 @@
 import numpy as np
-from sklearn.metrics.pairwise import cosine_similarity
-from pymongo import MongoClient
 import json
+from sklearn.metrics.pairwise import cosine_similarity
+from embedding_cache import load_embedding_cache, load_quantized_embeddings
 
 database_name = "MODAL_sourcedata"  # Replace with your database name
 collection_name = "LH_JPearce"  # Replace with your collection name
 output_filename = f"data/similarities/{collection_name}_sim.json"
 threshold = 0.98  # Adjust the similarity threshold as needed
+output_format = "json"  # "json" for one JSON object, "jsonl" for one document per line
+skip_empty = False  # Leave out documents without similar documents
+pairs_filename = f"data/similarities/{collection_name}_sim_pairs.npz"  # (i, j, score) triples, or None to skip
+tile_size = 2048  # Number of rows/columns compared per block, bounds the memory used for scoring
+float32_margin = 1e-5  # Candidates scored in float32 are kept this far below the threshold, then checked exactly
+embedding_format = "float32"  # "float16" or "int8": score the tiles on the quantized embeddings, same results
 
-def find_similar_documents(db_name, collection_name, output_file="similar_documents.json", similarity_threshold=0.9):
-    """
-    Finds and stores pairs of similar documents in a JSON file.
-
-    Args:
-        db_name (str): The name of the MongoDB database.
-        collection_name (str): The name of the MongoDB collection.
-        output_file (str): The name of the JSON file to write the results to.
-        similarity_threshold (float): The minimum cosine similarity to consider documents similar.
-    """
-
-    with MongoClient('mongodb://localhost:27017/') as client:
-        db = client[db_name]
-        collection = db[collection_name]
-
-        documents = list(collection.find({}))
-
-        if not documents:
-            print("No documents found in the collection.")
-            return
-
-        embeddings = []
-        doc_ids = []
-        doc_paths = {}
-        counter = 0
-
-        for doc in documents:
-            if doc.get('embeddings') and doc['embeddings'][0].get('text_embeddings'):
-                embeddings.append(doc['embeddings'][0]['text_embeddings'])
-                doc_ids.append(str(doc['_id']))  # Convert ObjectId to string
-                doc_paths[str(doc['_id'])] = doc.get('file_path')
-            # else:
-            #     print(f"Skipping document {doc['_id']} (No valid embeddings)")
-
-        if not embeddings:
-            print("No valid embeddings found in the collection.")
-            return
 
-        # Convert embeddings to NumPy array for efficiency
-        embeddings = np.array(embeddings)
+def row_norms(embeddings, chunk_size=65536):
+    """The float64 length of every row, computed in chunks so a memory-mapped matrix is never loaded at once."""
+    norms = np.empty(len(embeddings))
+    for start in range(0, len(embeddings), chunk_size):
+        chunk = np.asarray(embeddings[start:start + chunk_size], dtype=np.float64)
+        norms[start:start + chunk_size] = np.sqrt(np.einsum('ij,ij->i', chunk, chunk))
+    norms[norms == 0] = 1
+    return norms
 
-        # Compute cosine similarity for all pairs at once
-        similarity_matrix = cosine_similarity(embeddings)
 
-        num_docs = len(doc_ids)
-        results = {doc_id: {"id": doc_id, "file_path": doc_paths.get(doc_id), "similar_documents": []} for doc_id in
-                   doc_ids}
-
-        for i in range(num_docs):
-            counter += 1
-            for j in range(i + 1, num_docs):
-                similarity = similarity_matrix[i, j]
-                if similarity >= similarity_threshold:
-                    doc1_id, doc2_id = doc_ids[i], doc_ids[j]
-
-                    results[doc1_id]["similar_documents"].append({
-                        "id": doc2_id,
-                        "file_path": doc_paths.get(doc2_id),
-                        "similarity_score": similarity
-                    })
-                    results[doc2_id]["similar_documents"].append({
-                        "id": doc1_id,
-                        "file_path": doc_paths.get(doc1_id),
-                        "similarity_score": similarity
-                    })
-
-                    print(f"Found similarity: {doc1_id} ↔ {doc2_id} with score {similarity:.4f} ({counter}/{num_docs})")
-
-        # Sort similar documents by similarity score
-        for doc_id in results:
-            results[doc_id]["similar_documents"].sort(key=lambda x: x["similarity_score"], reverse=True)
-
-        with open(output_file, 'w') as f:
-            json.dump(results, f, indent=4)
+def similar_pairs(embeddings, similarity_threshold, tile_size=2048, quantized=None):
+    """
+    Yields the pairs (i < j) of rows with a cosine similarity at or above the threshold, one row block at a time.
 
-        print(f"Similar document information written to '{output_file}'")
+    Each block of rows is normalized and multiplied in float32 against the column blocks at or after it, so
+    only the upper triangle is scored and memory stays at one tile_size x tile_size tile. Candidate pairs are
+    then scored again with sklearn's cosine_similarity on their float64 rows, a tile_size block of columns at a
+    time. The scores can differ from one cosine_similarity over the whole matrix in the last bits (below 1e-15),
+    since BLAS may sum in another order for another matrix shape.
 
+    With quantized embeddings (see embedding_cache.QuantizedEmbeddings) the tiles are scored on those instead,
+    with the margin below the threshold widened by their error bound, so the same pairs are found.
 
+    Args:
+        embeddings (np.ndarray): The embeddings, one row per document (may be memory-mapped).
+        similarity_threshold (float): The minimum cosine similarity to consider documents similar.
+        tile_size (int): The number of rows and columns per tile.
+        quantized (QuantizedEmbeddings): Optional quantized copy of the normalized embeddings to score tiles on.
 
+    Yields:
+        tuple: (block_end, i, j, scores) with every row before block_end complete, and the pairs found
+        for the block as arrays sorted by i, then j.
+    """
+    num_docs = len(embeddings)
+    norms = row_norms(embeddings)
+    margin = float32_margin
+    if quantized is not None:
+        # |a'.b' - a.b| <= |a' - a| + |b' - b| + |a' - a| |b' - b| for unit vectors a and b
+        margin += 2 * quantized.error_bound + quantized.error_bound ** 2
+
+    def normalized_block(start, end, dtype=np.float32):
+        if quantized is not None:
+            return quantized[start:end]
+        return (np.asarray(embeddings[start:end], dtype=np.float64) / norms[start:end, np.newaxis]).astype(dtype)
+
+    def exact_scores(i, j):
+        scores = np.empty(len(i))
+        if not len(i):
+            return scores
+        rows_i, positions_i = np.unique(i, return_inverse=True)
+        rows_j, positions_j = np.unique(j, return_inverse=True)
+        left = np.asarray(embeddings[rows_i], dtype=np.float64)
+        for start in range(0, len(rows_j), tile_size):
+            in_block = (positions_j >= start) & (positions_j < start + tile_size)
+            block = cosine_similarity(left, np.asarray(embeddings[rows_j[start:start + tile_size]], dtype=np.float64))
+            scores[in_block] = block[positions_i[in_block], positions_j[in_block] - start]
+        return scores
+
+    for row_start in range(0, num_docs, tile_size):
+        row_end = min(row_start + tile_size, num_docs)
+        row_block = normalized_block(row_start, row_end)
+        block_i, block_j = [], []
+
+        for col_start in range(row_start, num_docs, tile_size):
+            col_end = min(col_start + tile_size, num_docs)
+            tile = row_block @ normalized_block(col_start, col_end).T
+            rows, cols = np.nonzero(tile >= similarity_threshold - margin)
+            rows += row_start
+            cols += col_start
+            upper = cols > rows
+            block_i.append(rows[upper])
+            block_j.append(cols[upper])
+
+        i = np.concatenate(block_i)
+        j = np.concatenate(block_j)
+        # Exact float64 scores for the candidate pairs only
+        scores = exact_scores(i, j)
+        keep = scores >= similarity_threshold
+        i, j, scores = i[keep], j[keep], scores[keep]
+        order = np.lexsort((j, i))
+        yield row_end, i[order], j[order], scores[order]
+
+
+def find_similar_documents(db_name, collection_name, output_file="similar_documents.json", similarity_threshold=0.9,
+                           output_format="json", skip_empty=False, pairs_file=None, embedding_format="float32"):
+    """
+    Finds and stores pairs of similar documents in a JSON or JSON Lines file.
 
-find_similar_documents(database_name, collection_name, output_filename, threshold)
+    Args:
+        db_name (str): The name of the MongoDB database.
+        collection_name (str): The name of the MongoDB collection.
+        output_file (str): The name of the JSON file to write the results to.
+        similarity_threshold (float): The minimum cosine similarity to consider documents similar.
+        output_format (str): "json" writes one object keyed by document id, "jsonl" one document per line.
+        skip_empty (bool): Leave out documents without similar documents.
+        pairs_file (str): Optional .npz file for the pairs as arrays i, j (row numbers, i < j), score and the
+            ids of the rows, so they can be loaded without parsing JSON.
+        embedding_format (str): "float16" or "int8" to score on quantized embeddings, with the same results.
+    """
+    if output_format not in ("json", "jsonl"):
+        raise ValueError(f"Unknown output format: {output_format}")
+
+    # Embeddings and metadata come from the local embedding cache (see embedding_cache.py)
+    embeddings, metadata = load_embedding_cache(db_name, collection_name)
+
+    if not len(embeddings):
+        print("No valid embeddings found in the collection.")
+        return
+
+    quantized = None
+    if embedding_format != "float32":
+        quantized, _ = load_quantized_embeddings(db_name, collection_name, embedding_format, refresh=False)
+
+    doc_ids = metadata["_id"].tolist()
+    doc_paths = metadata["file_path"].tolist()
+
+    num_docs = len(doc_ids)
+    # Neighbours found for documents whose row block hasn't been reached yet
+    pending = {}
+    pair_blocks = []
+    written = 0
+
+    with open(output_file, 'w') as f:
+        if output_format == "json":
+            f.write("{")
+        next_doc = 0
+        pairs = similar_pairs(embeddings, similarity_threshold, tile_size, quantized)
+        for block_end, block_i, block_j, block_scores in pairs:
+            if pairs_file:
+                pair_blocks.append((block_i.astype(np.int32), block_j.astype(np.int32),
+                                    block_scores.astype(np.float32)))
+            for i, j, similarity in zip(block_i.tolist(), block_j.tolist(), block_scores.tolist()):
+                pending.setdefault(i, []).append((j, similarity))
+                pending.setdefault(j, []).append((i, similarity))
+                print(f"Found similarity: {doc_ids[i]} ↔ {doc_ids[j]} with score {similarity:.4f} ({i + 1}/{num_docs})")
+
+            # Every pair involving a row before block_end has been found, so those entries can be written
+            while next_doc < block_end:
+                neighbours = sorted(pending.pop(next_doc, []), key=lambda pair: pair[0])
+                if neighbours or not skip_empty:
+                    # Sort similar documents by similarity score, ties keep document order
+                    neighbours.sort(key=lambda pair: pair[1], reverse=True)
+                    entry = {
+                        "id": doc_ids[next_doc],
+                        "file_path": doc_paths[next_doc],
+                        "similar_documents": [
+                            {"id": doc_ids[j], "file_path": doc_paths[j], "similarity_score": similarity}
+                            for j, similarity in neighbours
+                        ]
+                    }
+                    if output_format == "jsonl":
+                        f.write(json.dumps(entry) + "\n")
+                    else:
+                        # Same layout as json.dump(results, f, indent=4), one document at a time
+                        f.write(("," if written else "") + json.dumps({doc_ids[next_doc]: entry}, indent=4)[1:-2])
+                    written += 1
+                next_doc += 1
+        if output_format == "json":
+            f.write("\n}" if written else "}")
+
+    if pairs_file:
+        np.savez(
+            pairs_file,
+            i=np.concatenate([block[0] for block in pair_blocks]),
+            j=np.concatenate([block[1] for block in pair_blocks]),
+            score=np.concatenate([block[2] for block in pair_blocks]),
+            ids=np.array(doc_ids)
+        )
+        print(f"Similar document pairs written to '{pairs_file}'")
+
+    print(f"Similar document information written to '{output_file}'")
+
+
+if __name__ == "__main__":
+    find_similar_documents(database_name, collection_name, output_filename, threshold,
+                           output_format=output_format, skip_empty=skip_empty, pairs_file=pairs_filename,
+                           embedding_format=embedding_format)
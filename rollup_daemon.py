@@ -0,0 +1,183 @@
+# Keeps the folder summaries up to date while documents are ingested: tails the change stream of the collection
+# (MongoDB must run as a replica set), collects the documents whose enrichments or location changed, and applies
+# them in micro-batches to the per-folder aggregates of folder_aggregates.py. A batch is applied once no relevant
+# change arrived for debounce_seconds, when max_batch documents are waiting, or after max_wait_seconds.
+# The resume token of the last applied batch is stored, so a restarted daemon continues where it stopped; while
+# nothing relevant happens, the token the stream has advanced to is stored every max_wait_seconds, so it doesn't
+# fall out of the oplog. A first start (no stored position) rebuilds the aggregates, since the changes made
+# before it, including enrichments added to existing documents, are in no stream: the stream starts at the
+# cluster time read before the rebuild, so the changes made during it are applied afterwards as well. That
+# time is stored once the rebuild is done, so a daemon stopped before the first batch doesn't rebuild again.
+#
+#     python rollup_daemon.py                         # run until interrupted
+#     python rollup_daemon.py --replay events.jsonl   # apply a recorded feed of change events instead
+#
+# A replay feed has one change event per line in MongoDB extended JSON, as produced by a change stream, e.g.
+#     {"operationType": "update", "documentKey": {"_id": {"$oid": "..."}},
+#      "updateDescription": {"updatedFields": {"enrichments": [...]}, "removedFields": []},
+#      "fullDocument": {"file_name": "letter.pdf", ...}}
+
+import argparse
+import time
+
+from bson import json_util
+
+from folder_aggregates import apply_document_changes, collection, rebuild_aggregates
+
+debounce_seconds = 2.0  # Apply the waiting changes once no relevant change arrived for this long
+max_wait_seconds = 30.0  # ... or once the oldest waiting change is this old
+max_batch = 1000  # ... or once this many documents are waiting
+poll_milliseconds = 500  # How long the change stream waits for new events before the batch is checked
+
+WATCHED_FIELDS = ["enrichments", "file_path", "parent_path"]  # Updates to other fields don't change the folders
+
+state_collection = collection.database[f"{collection.name}_rollup_state"]
+
+# Leaves out folder records (the daemon's own writes) and updates that don't touch the watched fields
+WATCH_PIPELINE = [{"$match": {
+    "fullDocument.file_name": {"$ne": "folder_summary"},
+    "$or": [
+        {"operationType": {"$in": ["insert", "replace", "delete"]}},
+        {"operationType": "update", "$expr": {"$anyElementTrue": [{"$map": {
+            "input": {"$concatArrays": [
+                {"$map": {"input": {"$objectToArray": {"$ifNull": ["$updateDescription.updatedFields", {}]}},
+                          "in": "$$this.k"}},
+                {"$ifNull": ["$updateDescription.removedFields", []]}
+            ]},
+            "in": {"$in": [{"$arrayElemAt": [{"$split": ["$$this", "."]}, 0]}, WATCHED_FIELDS]}
+        }}]}}
+    ]
+}}]
+
+
+def is_relevant(event):
+    """The same filter as WATCH_PIPELINE, for events that didn't come from the server (e.g. a replay)."""
+    operation = event.get("operationType")
+    if operation not in ("insert", "replace", "update", "delete"):
+        return False
+    if (event.get("fullDocument") or {}).get("file_name") == "folder_summary":
+        return False
+    if operation == "update":
+        description = event.get("updateDescription") or {}
+        changed = list(description.get("updatedFields") or {}) + list(description.get("removedFields") or [])
+        return any(field.split(".")[0] in WATCHED_FIELDS for field in changed)
+    return True
+
+
+def load_stream_position():
+    """The stored (resume token, start cluster time), one of them None; (None, None) before the first start."""
+    state = state_collection.find_one({"_id": "resume_token"}) or {}
+    return state.get("token"), state.get("start_at")
+
+
+def save_resume_token(token):
+    state_collection.replace_one({"_id": "resume_token"}, {"_id": "resume_token", "token": token}, upsert=True)
+
+
+def save_start_time(start_at):
+    state_collection.replace_one({"_id": "resume_token"}, {"_id": "resume_token", "start_at": start_at},
+                                 upsert=True)
+
+
+def cluster_time():
+    """The current operation time of the replica set, where a change stream opened later can start."""
+    return collection.database.command("ping")["operationTime"]
+
+
+def change_stream_events(resume_token=None, start_at=None):
+    """
+    Yields (event, resume token) for the relevant change events after the resume token (or from the cluster
+    time start_at), with the event None whenever nothing arrived within poll_milliseconds. The token is where
+    the stream has got to, which keeps advancing while only irrelevant changes happen.
+    """
+    with collection.watch(WATCH_PIPELINE, full_document="updateLookup", resume_after=resume_token,
+                          start_at_operation_time=start_at, max_await_time_ms=poll_milliseconds) as stream:
+        while stream.alive:
+            event = stream.try_next()
+            yield event, stream.resume_token
+
+
+def replay_events(path):
+    """Yields (event, resume token) for the change events of a JSONL feed, see the top of this file."""
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                event = json_util.loads(line)
+                yield event, event.get("_id")
+
+
+def rollup_events(events, save_tokens=True):
+    """
+    Applies the changed documents of a stream of change events in micro-batches.
+
+    Args:
+        events: (event, resume token) pairs, with the event None meaning no event arrived for a while (so a
+            waiting batch can be applied).
+        save_tokens (bool): Store the resume token of every applied batch, and while idle every max_wait_seconds.
+
+    Returns:
+        int: The number of documents applied.
+    """
+    pending = {}  # Changed document ids, in order of their first change; a document changed twice is applied once
+    first_change = last_change = None
+    token = saved_token = None
+    last_save = time.monotonic()
+    applied = 0
+
+    def save():
+        nonlocal saved_token, last_save
+        if save_tokens and token is not None and token != saved_token:
+            save_resume_token(token)
+            saved_token, last_save = token, time.monotonic()
+
+    def flush():
+        nonlocal pending, first_change, applied
+        apply_document_changes(list(pending))
+        applied += len(pending)
+        save()
+        pending, first_change = {}, None
+
+    for event, event_token in events:
+        now = time.monotonic()
+        token = event_token if event_token is not None else token
+        if event is not None and is_relevant(event):
+            pending[event["documentKey"]["_id"]] = None
+            first_change = first_change or now
+            last_change = now
+
+        if not pending and now - last_save >= max_wait_seconds:
+            save()  # Nothing waits to be applied, so every change up to the token is
+        if pending and (len(pending) >= max_batch or now - last_change >= debounce_seconds or
+                        now - first_change >= max_wait_seconds):
+            flush()
+
+    if pending:
+        flush()
+    return applied
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Update the folder summaries from the change stream")
+    parser.add_argument("--replay", metavar="JSONL", help="apply a recorded feed of change events and stop")
+    parser.add_argument("--debounce", type=float, default=debounce_seconds,
+                        help="seconds without changes before a batch is applied")
+    parser.add_argument("--max-batch", type=int, default=max_batch, help="documents applied at most per batch")
+    args = parser.parse_args()
+    debounce_seconds, max_batch = args.debounce, args.max_batch
+
+    if args.replay:
+        applied = rollup_events(replay_events(args.replay), save_tokens=False)
+        print(f"Replayed the changes of {applied} documents")
+    else:
+        resume_token, start_at = load_stream_position()
+        if resume_token is None and start_at is None:
+            # The changes made since the aggregates were built can't be replayed, so they are rebuilt
+            start_at = cluster_time()
+            print("No resume token stored, rebuilding the aggregates first")
+            rebuild_aggregates()
+            save_start_time(start_at)
+        print("Watching for changes...")
+        try:
+            rollup_events(change_stream_events(resume_token, start_at))
+        except KeyboardInterrupt:
+            print("Stopped")
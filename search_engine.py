@@ -0,0 +1,264 @@
+# Batch semantic search over the embeddings of a collection, for running many queries at once (e.g. every
+# entry of a finding aid overnight) without the Streamlit app. Queries are encoded in batches and scored with
+# one matrix multiplication per chunk of the corpus against the normalized embeddings of the embedding cache
+# (see embedding_cache.py); only the top_k of every query are kept and sorted. With corpus_format "float16" or
+# "int8" the corpus is scored in that format (2x or 4x less memory) and the best candidates are re-scored in
+# float32; --recall-report measures how many of the exact results each format finds.
+#
+#     python search_engine.py "brief aan de uitgever" "contract 1987"
+#     python search_engine.py --queries-file queries.txt --top-k 20 --output results.jsonl
+#     python search_engine.py --hybrid "dossier 1987/123"  # fused with BM25 results (see lexical_index.py)
+#     python search_engine.py --format int8 --recall-report
+#     python search_engine.py --mimetype application/pdf --year-from 1980 --folder /archive/letters/ "contract"
+
+import argparse
+import json
+import time
+from functools import lru_cache
+
+import numpy as np
+
+from embedding_cache import load_normalized_embeddings, load_quantized_embeddings
+from facet_filters import build_facets, filter_mask
+
+database_name = "MODAL_data"  # Replace with your database name
+collection_name = "collection_name"  # Replace with your collection name
+model_name = "paraphrase-multilingual-mpnet-base-v2"  # Must be the model that made the stored embeddings
+encode_batch_size = 64  # Number of queries encoded at once
+score_chunk_rows = 65536  # Number of corpus rows multiplied at once, bounds the memory of the score matrix
+corpus_format = "float32"  # "float32", or "float16" / "int8" for a quantized corpus (see embedding_cache.py)
+rerank_factor = 4  # With a quantized corpus, top_k * rerank_factor candidates are re-scored in float32 (0: don't)
+
+
+@lru_cache(maxsize=1)
+def load_model():
+    import torch
+    from sentence_transformers import SentenceTransformer
+
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    return SentenceTransformer(model_name, device=device)
+
+
+@lru_cache(maxsize=4)
+def load_corpus(db_name, collection_name, corpus_format="float32"):
+    """The normalized embeddings (memory-mapped) and metadata of a collection, loaded once per process."""
+    if corpus_format == "float32":
+        return load_normalized_embeddings(db_name, collection_name)
+    return load_quantized_embeddings(db_name, collection_name, corpus_format)
+
+
+def exact_corpus(db_name, collection_name, corpus_format):
+    """The float32 embeddings the candidates of a quantized corpus are re-scored with, or None."""
+    if corpus_format == "float32" or not rerank_factor:
+        return None
+    return load_corpus(db_name, collection_name)[0]
+
+
+@lru_cache(maxsize=4)
+def load_facets(db_name, collection_name):
+    """The search filter facets of a collection (see facet_filters.py), aligned with load_corpus()."""
+    return build_facets(load_corpus(db_name, collection_name)[1])
+
+
+def encode_queries(queries, model=None):
+    """Encodes the queries in batches as normalized float32 vectors."""
+    model = model or load_model()
+    vectors = model.encode(list(queries), batch_size=encode_batch_size, convert_to_numpy=True,
+                           normalize_embeddings=True)
+    return np.asarray(vectors, dtype=np.float32)
+
+
+def top_k_indices(scores, top_k):
+    """The column indices of the top_k highest scores in every row, sorted from highest to lowest score."""
+    top_k = min(top_k, scores.shape[1])
+    if top_k == 0:
+        return np.empty((len(scores), 0), dtype=np.int64)
+    # argpartition finds the top_k in linear time, only those are sorted
+    best = np.argpartition(-scores, top_k - 1, axis=1)[:, :top_k]
+    order = np.argsort(-np.take_along_axis(scores, best, axis=1), axis=1, kind="stable")
+    return np.take_along_axis(best, order, axis=1)
+
+
+def search_vectors(query_vectors, corpus, top_k=10, chunk_rows=score_chunk_rows, mask=None, exact=None):
+    """
+    Scores normalized query vectors against the normalized corpus, a chunk of rows at a time.
+    With a boolean mask over the corpus rows (see facet_filters.py), only the rows it selects are scored.
+    With the float32 embeddings of a quantized corpus as `exact`, the top_k * rerank_factor best candidates are
+    re-scored with those, and the top_k of them are returned with their exact scores.
+
+    Returns:
+        tuple: (rows, scores), both of shape (number of queries, top_k), best match first.
+    """
+    query_vectors = np.asarray(query_vectors, dtype=np.float32)
+    if exact is not None:
+        rows, _ = search_vectors(query_vectors, corpus, top_k * rerank_factor, chunk_rows, mask)
+        return rerank(query_vectors, rows, exact, top_k)
+
+    best_rows = np.empty((len(query_vectors), 0), dtype=np.int64)
+    best_scores = np.empty((len(query_vectors), 0), dtype=np.float32)
+
+    allowed = None if mask is None else np.flatnonzero(mask)
+    for start in range(0, len(corpus) if allowed is None else len(allowed), chunk_rows):
+        if allowed is None:
+            chunk = corpus[start:start + chunk_rows]
+            row_ids = np.arange(start, start + len(chunk))
+        else:
+            row_ids = allowed[start:start + chunk_rows]
+            chunk = corpus[row_ids]
+        chunk_scores = query_vectors @ np.asarray(chunk).T
+        # The top_k of this chunk compete with the top_k found so far
+        scores = np.concatenate([best_scores, chunk_scores], axis=1)
+        rows = np.concatenate([best_rows, np.broadcast_to(row_ids, chunk_scores.shape)], axis=1)
+        keep = top_k_indices(scores, top_k)
+        best_rows = np.take_along_axis(rows, keep, axis=1)
+        best_scores = np.take_along_axis(scores, keep, axis=1)
+    return best_rows, best_scores
+
+
+def rerank(query_vectors, rows, exact, top_k):
+    """Scores the candidate rows of every query with the exact embeddings and keeps the top_k."""
+    # The candidates of all queries are read from the (memory-mapped) embeddings at once, in row order
+    unique_rows, inverse = np.unique(rows, return_inverse=True)
+    vectors = np.asarray(exact[unique_rows], dtype=np.float32)[inverse.reshape(rows.shape)]
+    scores = np.einsum("qd,qkd->qk", query_vectors, vectors)
+    keep = top_k_indices(scores, top_k)
+    return np.take_along_axis(rows, keep, axis=1), np.take_along_axis(scores, keep, axis=1)
+
+
+def recall_report(db_name, collection_name, formats=("float16", "int8"), top_k=10, sample_size=200, seed=42):
+    """
+    Measures every quantized format against exact float32 search: the memory of the corpus, and the recall@top_k
+    (the share of the exact top_k results found) with and without re-ranking, using a random sample of the
+    documents as queries.
+    """
+    corpus, _ = load_corpus(db_name, collection_name)
+    rng = np.random.default_rng(seed)
+    sample = np.sort(rng.choice(len(corpus), min(sample_size, len(corpus)), replace=False))
+    query_vectors = np.asarray(corpus[sample])
+
+    started = time.perf_counter()
+    exact_rows, _ = search_vectors(query_vectors, corpus, top_k)
+    print(f"float32: {corpus.nbytes / 2 ** 20:.1f} MB, {time.perf_counter() - started:.2f}s "
+          f"for {len(sample)} queries")
+
+    def recall(rows):
+        return np.mean([len(np.intersect1d(found, expected)) / len(expected)
+                        for found, expected in zip(rows, exact_rows)])
+
+    for quantized_format in formats:
+        quantized, _ = load_corpus(db_name, collection_name, quantized_format)
+        started = time.perf_counter()
+        rows, _ = search_vectors(query_vectors, quantized, top_k)
+        scored = time.perf_counter()
+        reranked_rows, _ = search_vectors(query_vectors, quantized, top_k, exact=corpus)
+        reranked = time.perf_counter()
+        print(f"{quantized_format}: {quantized.nbytes / 2 ** 20:.1f} MB ({corpus.nbytes / quantized.nbytes:.1f}x "
+              f"smaller), recall@{top_k} {recall(rows):.4f} in {scored - started:.2f}s, "
+              f"re-ranked {recall(reranked_rows):.4f} in {reranked - scored:.2f}s")
+
+
+def search(queries, top_k=10, db_name=database_name, collection_name=collection_name, filters=None,
+           corpus_format=corpus_format):
+    """
+    Searches the documents most similar to every query.
+
+    Args:
+        queries (list[str]): The queries.
+        top_k (int): The number of results per query.
+        db_name (str): The name of the MongoDB database.
+        collection_name (str): The name of the MongoDB collection.
+        filters (dict): Only search the documents matching these filters, the arguments of
+            facet_filters.filter_mask() (e.g. {"mimetypes": ["application/pdf"], "min_year": 1980}).
+        corpus_format (str): "float32", or "float16" / "int8" to score a quantized corpus.
+
+    Returns:
+        list: For every query a list of its top_k results, each a dict with the _id, file_path and score of
+        a document, best match first.
+    """
+    corpus, metadata = load_corpus(db_name, collection_name, corpus_format)
+    mask = filter_mask(load_facets(db_name, collection_name), **filters) if filters else None
+    rows, scores = search_vectors(encode_queries(queries), corpus, top_k, mask=mask,
+                                  exact=exact_corpus(db_name, collection_name, corpus_format))
+    return [results_for(metadata, query_rows, query_scores) for query_rows, query_scores in zip(rows, scores)]
+
+
+def results_for(metadata, rows, scores):
+    ids, paths = metadata["_id"].to_numpy(), metadata["file_path"].to_numpy()
+    return [{"_id": ids[row], "file_path": paths[row], "score": float(score)} for row, score in zip(rows, scores)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Semantic search for many queries at once")
+    parser.add_argument("queries", nargs="*", help="the queries to search")
+    parser.add_argument("--queries-file", help="a text file with one query per line")
+    parser.add_argument("--top-k", type=int, default=10)
+    parser.add_argument("--db", default=database_name)
+    parser.add_argument("--collection", default=collection_name)
+    parser.add_argument("--hybrid", action="store_true",
+                        help="fuse the results with those of the lexical (BM25) index by reciprocal rank")
+    parser.add_argument("--mimetype", action="append", help="only search documents of this mimetype (repeatable)")
+    parser.add_argument("--min-words", type=int, help="only search documents with at least this many words")
+    parser.add_argument("--max-words", type=int, help="only search documents with at most this many words")
+    parser.add_argument("--year-from", type=int, help="only search documents estimated from this year onwards")
+    parser.add_argument("--year-to", type=int, help="only search documents estimated up to this year")
+    parser.add_argument("--folder", help="only search documents below this folder path")
+    parser.add_argument("--format", choices=["float32", "float16", "int8"], default=corpus_format,
+                        help="the format the corpus is scored in")
+    parser.add_argument("--recall-report", action="store_true",
+                        help="measure the recall of the quantized formats against exact search and stop")
+    parser.add_argument("--output", help="write the results as JSON Lines, one query per line, instead of printing")
+    args = parser.parse_args()
+
+    if args.recall_report:
+        formats = [args.format] if args.format != "float32" else ["float16", "int8"]
+        recall_report(args.db, args.collection, formats, args.top_k)
+        return
+
+    queries = list(args.queries)
+    if args.queries_file:
+        with open(args.queries_file, encoding="utf-8") as f:
+            queries += [line.strip() for line in f if line.strip()]
+    if not queries:
+        parser.error("no queries given")
+
+    started = time.perf_counter()
+    corpus, metadata = load_corpus(args.db, args.collection, args.format)
+    exact = exact_corpus(args.db, args.collection, args.format)
+    facets = load_facets(args.db, args.collection)
+    model = load_model()
+    loaded = time.perf_counter()
+    query_vectors = encode_queries(queries, model)
+    encoded = time.perf_counter()
+    mask = filter_mask(facets, args.mimetype, args.min_words, args.max_words, args.year_from, args.year_to,
+                       args.folder)
+    if args.hybrid:
+        # Imported here, as lexical_index uses this module
+        from lexical_index import hybrid_rows, load_lexical_index
+
+        lexical = load_lexical_index(args.db, args.collection)
+        rows, scores = hybrid_rows(queries, query_vectors, corpus, lexical, args.top_k, mask, exact)
+    else:
+        rows, scores = search_vectors(query_vectors, corpus, args.top_k, mask=mask, exact=exact)
+    scored = time.perf_counter()
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            for query, query_rows, query_scores in zip(queries, rows, scores):
+                f.write(json.dumps({"query": query, "results": results_for(metadata, query_rows, query_scores)},
+                                   ensure_ascii=False) + "\n")
+        print(f"Results written to '{args.output}'")
+    else:
+        for query, query_rows, query_scores in zip(queries, rows, scores):
+            print(f"\n{query}")
+            for result in results_for(metadata, query_rows, query_scores):
+                print(f"  {result['score']:.4f}  {result['file_path']}")
+
+    search_time = scored - loaded
+    searched = len(corpus) if mask is None else int(np.count_nonzero(mask))
+    print(f"\n{len(queries)} queries against {searched} documents: loading {loaded - started:.2f}s, "
+          f"encoding {encoded - loaded:.2f}s, scoring {scored - encoded:.2f}s "
+          f"({len(queries) / search_time:.1f} queries/s)")
+
+
+if __name__ == "__main__":
+    main()
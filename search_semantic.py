@@ -6,17 +6,32 @@ import os
 import numpy as np
 import torch
 import pandas as pd
-from pymongo import MongoClient
 from sentence_transformers import SentenceTransformer
-from sklearn.metrics.pairwise import cosine_similarity
+from vector_index import build_index, index_directory, load_index, search_index
+from lexical_index import (build_lexical_index, fusion_candidates, lexical_directory, load_lexical_index,
+                           reciprocal_rank_fusion, search_lexical)
+from facet_filters import build_facets, filter_mask
 
 database_name = "MODAL_data"  # Replace with your database name
 collection_name = "collection_name"  # Replace with your collection name
+max_results = 100  # Number of results fetched per query, shown results_per_page at a time
+results_per_page = 10
+query_cache_size = 256  # Number of recent queries whose embeddings and results are kept
 
 
-# Load the sentence transformer model for embedding generation
-device = 'cuda' if torch.cuda.is_available() else 'cpu'
-model = SentenceTransformer('paraphrase-multilingual-mpnet-base-v2', device=device)
+# Load the sentence transformer model for embedding generation, once per server process instead of on every rerun
+@st.cache_resource
+def load_model():
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    return SentenceTransformer('paraphrase-multilingual-mpnet-base-v2', device=device)
+
+
+# Streamlit reruns the script on every interaction (e.g. a page change or "Open" click), so a repeated query
+# reuses its embedding instead of encoding it again
+@st.cache_data(max_entries=query_cache_size)
+def encode_query(query):
+    return load_model().encode([query])[0]
+
 
 def open_local_file(file_path):
     try:
@@ -27,90 +42,123 @@ def open_local_file(file_path):
     except Exception as e:
         st.error(f"Cannot open file: {e}")
 
-# MongoDB client setup
-def load_documents_from_mongo(db_name, collection_name):
-    client = MongoClient('mongodb://localhost:27017/')
-    db = client[db_name]
-    collection = db[collection_name]
-
-    documents = list(collection.find({})) # change query if needed
-    client.close()
-    return documents
+# Load the persistent vector index, building it first if it doesn't exist yet (see vector_index.py).
+# The index (with its memory-mapped vectors) is shared by all sessions; clear the cache after rebuilding it.
+@st.cache_resource
+def load_vector_index(db_name, collection_name):
+    index_dir = index_directory(db_name, collection_name)
+    if not os.path.exists(os.path.join(index_dir, "info.json")):
+        if build_index(db_name, collection_name, index_dir) is None:
+            return None
+    return load_index(db_name, collection_name, index_dir)
 
 
-# Preload the documents and embeddings from MongoDB
-def load_embeddings_and_texts(db_name, collection_name):
-    documents = load_documents_from_mongo(db_name, collection_name)
+# Load the lexical (BM25) index for exact words, building it first if it doesn't exist yet (see lexical_index.py)
+@st.cache_resource
+def load_lexical(db_name, collection_name):
+    index_dir = lexical_directory(db_name, collection_name)
+    if not os.path.exists(os.path.join(index_dir, "info.json")):
+        build_lexical_index(db_name, collection_name, index_dir)
+    return load_lexical_index(db_name, collection_name, index_dir)
 
-    texts = []
-    embeddings = []
-    doc_ids = []
-    extracted_texts = []
-    for doc in documents:
-        if doc.get('embeddings') and doc['embeddings'][0].get('text_embeddings'):
-            embeddings.append(np.array(doc['embeddings'][0]['text_embeddings']))
-            texts.append(doc.get('file_path', 'N/A'))  # Or any other text field you wish to show
-            doc_ids.append(doc['_id'])
-            extracted_text = doc.get('extracted_text', '')
-            extracted_texts.append(extracted_text[:100])  # Take first 100 characters
 
-    return texts, np.array(embeddings), doc_ids, extracted_texts
+# The filter facets of the indexed documents (see facet_filters.py), built once per server process
+@st.cache_resource
+def load_facets(db_name, collection_name):
+    index = load_vector_index(db_name, collection_name)
+    return None if index is None else build_facets(index["metadata"])
 
 
-# Semantic search function
-def semantic_search(query, embeddings, texts, doc_ids, extracted_texts, top_k=10):
+# Semantic search function, fused with the lexical ranking when a lexical index is given, and restricted to the
+# rows of the mask when one is given
+def semantic_search(query, index, top_k=10, lexical=None, mask=None):
     # Encode the query
-    query_embedding = model.encode([query])
+    query_embedding = encode_query(query)
 
-    # Compute cosine similarity
-    similarities = cosine_similarity(query_embedding, embeddings)
-
-    # Get top_k most similar documents
-    sorted_idx = similarities.argsort()[0][-top_k:][::-1]
+    # Get top_k most similar documents from the index
+    if lexical is None:
+        rows, scores = search_index(index, query_embedding, top_k, mask=mask)
+    else:
+        dense_rows, _ = search_index(index, query_embedding, max(top_k, fusion_candidates), mask=mask)
+        lexical_rows, _ = search_lexical(lexical, query, fusion_candidates, mask)
+        rows, scores = reciprocal_rank_fusion([dense_rows, lexical_rows], top_k)
 
     # Return the top_k results
+    metadata = index["metadata"]
     results = []
-    for idx in sorted_idx:
+    for row, score in zip(rows, scores):
         results.append({
-            'Text': texts[idx],
-            'ObjectId': str(doc_ids[idx]),  # Convert ObjectId to string for better readability
-            'Extracted Text': extracted_texts[idx],  # Include the truncated extracted_text
-            'Similarity Score': similarities[0][idx]
+            'Text': metadata["file_path"].iat[row],
+            'ObjectId': metadata["_id"].iat[row],
+            'Extracted Text': metadata["text_preview"].iat[row],  # Include the truncated extracted_text
+            'Similarity Score': float(score)
         })
     return results
 
 
+# The results of recent queries, so paging through them doesn't search again
+@st.cache_data(max_entries=query_cache_size)
+def search_results(db_name, collection_name, query, top_k, hybrid=False, filters=None):
+    index = load_vector_index(db_name, collection_name)
+    if index is None:
+        return None
+    lexical = load_lexical(db_name, collection_name) if hybrid else None
+    # The filters become a mask over the indexed rows with a few array comparisons, no database query
+    mask = filter_mask(load_facets(db_name, collection_name), **filters) if filters else None
+    return semantic_search(query, index, top_k, lexical, mask)
+
+
+# Filter inputs, returned as the arguments of filter_mask() that were set
+def filter_inputs(facets):
+    with st.expander("Filters"):
+        mimetypes = st.multiselect("File types", sorted(facets["mimetype_masks"]))
+        min_words = st.number_input("Minimum word count", min_value=0, value=0, step=10)
+        first_year, last_year = st.columns(2)
+        min_year = first_year.number_input("From year", min_value=0, max_value=9999, value=None, step=1)
+        max_year = last_year.number_input("Up to year", min_value=0, max_value=9999, value=None, step=1)
+        folder = st.text_input("Folder", placeholder="/path/to/folder/")
+    filters = {"mimetypes": mimetypes, "min_words": min_words or None, "min_year": min_year,
+               "max_year": max_year, "folder": folder.strip()}
+    return {name: value for name, value in filters.items() if value}
+
+
 # Streamlit UI
 def main():
     st.title("Semantic Search for Documents")
 
     # Input: User's query
     query = st.text_input("Enter your search query:")
+    hybrid = st.checkbox("Also match exact words (names, dossier numbers)")
+    facets = load_facets(database_name, collection_name)
+    filters = filter_inputs(facets) if facets is not None else {}
 
     if query:
-        # Load documents and embeddings from MongoDB
-        texts, embeddings, doc_ids , extracted_texts= load_embeddings_and_texts(database_name, collection_name)
+        # Perform semantic search (or reuse the results of the same query and filters)
+        search_results_all = search_results(database_name, collection_name, query, max_results, hybrid, filters)
 
-        if len(embeddings) == 0:
+        if search_results_all is None:
             st.error("No valid embeddings found in the database.")
             return
 
-        # Perform semantic search
-        search_results = semantic_search(query, embeddings, texts, doc_ids, extracted_texts)
+        if search_results_all:
+            page_count = (len(search_results_all) - 1) // results_per_page + 1
+            page = st.number_input("Page", min_value=1, max_value=page_count, value=1, step=1)
+            start = (page - 1) * results_per_page
+            page_results = search_results_all[start:start + results_per_page]
 
-        if search_results:
-            st.write(f"Top {len(search_results)} results:")
-            for result in search_results:
+            st.write(f"Results {start + 1}-{start + len(page_results)} of the top {len(search_results_all)}:")
+            for result in page_results:
                 file_path = result['Text']
 
                 # Display file information
                 # st.write(f"ObjectId: {result['ObjectId']}")
                 st.write(f"File Path: {file_path}")
                 # st.write(f"Extracted Text (Preview): {result['Extracted Text']}")
-                st.write(f"Similarity Score: {result['Similarity Score']:.4f}")
+                score_label = "Fused Rank Score" if hybrid else "Similarity Score"
+                st.write(f"{score_label}: {result['Similarity Score']:.4f}")
 
                 # Add a button to open the file
-                if st.button(f"Open {file_path}"):
+                if st.button(f"Open {file_path}", key=f"open_{result['ObjectId']}"):
                     open_local_file(file_path)
 
                 st.write("---")
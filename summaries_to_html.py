@@ -1,9 +1,45 @@
 from pymongo import MongoClient
+from create_folder_hierarchy import backfill_path_fields, create_path_indexes
+import hashlib
+import json
 import os
 import html
 
 database_name = "MODAL_data"
 collection_name = "collection_name"
+lazy_browser = True  # Write a small page plus one file per folder, loaded when the folder is opened
+skip_levels = 5  # Number of top path levels that are not shown
+hidden_path_prefix = "media/henk/LaCie/2025_MODAL"  # Removed from the paths shown in the browser
+
+PAGE_STYLE = """<style>
+            body { font-family: Arial, sans-serif; }
+            h2 {background: lightblue; padding: 5px 10px;}
+            ul { list-style-type: none; }
+            .folder { cursor: pointer; font-weight: bold; color: #007BFF; border: 1px solid grey; background: snow; width: 100%; padding: 5px 10px; font-family: Courier New, monospace;}
+            .nested { display: none; margin-left: 30px; padding: 5px 5px;}
+            .metadata { font-size: 0.9em; color: #666; margin-left: 30px; position: relative; padding: 5px 5px; border: 1px solid #ccc;}
+            .file {font-family: Courier New, monospace; font-weight: bold;}
+        
+            .ner-info {
+                display: none;
+                background-color: #f9f9f9;
+                border: 1px solid #ccc;
+                opacity: 0.9;
+                padding: 8px;
+                position: absolute;
+                top: 10%;
+                left: 3%;
+                z-index: 10;
+                min-width: 250px;
+                box-shadow: 0 2px 5px rgba(0,0,0,0.2);
+            }
+        
+            .metadata:hover .ner-info {
+                display: block;
+            }
+        </style>
+"""
+
 
 def extract_field(enrichments, field_name):
     """Extracts field data from enrichment elements, normalizing strings/lists."""
@@ -20,6 +56,28 @@ def extract_field(enrichments, field_name):
     return [] if field_name.startswith("NER") or field_name in ["Topic_representation", "Topic_label"] else ""
 
 
+def extract_metadata(doc):
+    """Collects the enrichments and correspondence fields shown for a file or folder."""
+    enrichments = doc.get("enrichments", [])
+    # extracted_text = doc.get("extracted_text", "")[300]
+
+    return {
+        "NER_persons": extract_field(enrichments, "NER_persons"),
+        "NER_organisations": extract_field(enrichments, "NER_organisations"),
+        "NER_locations": extract_field(enrichments, "NER_locations"),
+        "NER_miscellaneous": extract_field(enrichments, "NER_miscellaneous"),
+        "Topic_representation": extract_field(enrichments, "Topic_representation"),
+        "Topic_label": extract_field(enrichments, "Topic_label"),
+        "summary": extract_field(enrichments, "summary"),
+        "sender_email": doc.get("sender_email", []),
+        "sender_name": doc.get("sender_name", []),
+        "recipient_email": doc.get("recipient_email", []),
+        "recipient_name": doc.get("recipient_name", []),
+        # "estimated_creation_date": doc.get("estimated_creation_date", [])
+
+    }
+
+
 def build_hierarchy():
     """Builds a hierarchical dictionary representing the file and folder structure."""
     client = MongoClient("mongodb://localhost:27017/")
@@ -32,24 +90,7 @@ def build_hierarchy():
 
     for doc in all_docs:
         file_path = os.path.normpath(doc["file_path"].strip("/"))
-        enrichments = doc.get("enrichments", [])
-        # extracted_text = doc.get("extracted_text", "")[300]
-
-        metadata_map[file_path] = {
-            "NER_persons": extract_field(enrichments, "NER_persons"),
-            "NER_organisations": extract_field(enrichments, "NER_organisations"),
-            "NER_locations": extract_field(enrichments, "NER_locations"),
-            "NER_miscellaneous": extract_field(enrichments, "NER_miscellaneous"),
-            "Topic_representation": extract_field(enrichments, "Topic_representation"),
-            "Topic_label": extract_field(enrichments, "Topic_label"),
-            "summary": extract_field(enrichments, "summary"),
-            "sender_email": doc.get("sender_email", []),
-            "sender_name": doc.get("sender_name", []),
-            "recipient_email": doc.get("recipient_email", []),
-            "recipient_name": doc.get("recipient_name", []),
-            # "estimated_creation_date": doc.get("estimated_creation_date", [])
-
-        }
+        metadata_map[file_path] = extract_metadata(doc)
 
         print(f'\n====\nProcessing file: {file_path}')
         print(metadata_map[file_path])
@@ -69,51 +110,42 @@ def safe_join(items):
     return ", ".join(str(item) for item in items if item)
 
 
-def generate_html_structure(hierarchy, metadata_map, path="", level=0, skip_levels=5):
+def ner_lines(metadata):
+    """The (label, value) lines shown when hovering over the metadata of a file or folder."""
+    # Prepare NER lines conditionally
+    fields = [
+        ("Sender Email", "sender_email"),
+        # ("Sender Name", "sender_name"),
+        ("Recipient Email", "recipient_email"),
+        # ("Recipient Name", "recipient_name"),
+        ("NER Persons", "NER_persons"),
+        ("NER Organisations", "NER_organisations"),
+        ("NER Locations", "NER_locations"),
+        ("NER Miscellaneous", "NER_miscellaneous"),
+        ("Topic Representation", "Topic_representation"),
+        # ("Estimated Creation Date", "estimated_creation_date"),
+    ]
+    lines = []
+    for label, field in fields:
+        value = safe_join(metadata.get(field, []))
+        if value:
+            lines.append((label, value))
+    return lines
+
+
+def generate_html_structure(hierarchy, metadata_map, path="", level=0, skip_levels=skip_levels):
     """Generates the HTML structure for the file and folder hierarchy."""
     result = ""
 
     for name, sub_items in sorted(hierarchy.items()):
         full_path = "/".join([path, name]) if path else name
         metadata = metadata_map.get(full_path, {})
-        show_path = full_path.replace("media/henk/LaCie/2025_MODAL", "")
+        show_path = full_path.replace(hidden_path_prefix, "")
 
         # Generate content only if we're at or below the desired level
         if level >= skip_levels:
 
-            # Prepare NER lines conditionally
-            ner_persons = safe_join(metadata.get('NER_persons', []))
-            ner_organisations = safe_join(metadata.get('NER_organisations', []))
-            ner_locations = safe_join(metadata.get('NER_locations', []))
-            ner_miscellaneous = safe_join(metadata.get('NER_miscellaneous', []))
-            topic_representation = safe_join(metadata.get('Topic_representation', []))
-            sender_email = safe_join(metadata.get('sender_email', []))
-            sender_name = safe_join(metadata.get('sender_name', []))
-            recipient_email = safe_join(metadata.get('recipient_email', []))
-            recipient_name = safe_join(metadata.get('recipient_name', []))
-            # estimated_creation_date = safe_join(metadata.get('estimated_creation_date', []))
-
-            ner_info = ""
-            if sender_email:
-                ner_info += f"<strong>Sender Email:</strong> {sender_email}<br>"
-            # if sender_name:
-            #     ner_info += f"<strong>Sender Name:</strong> {sender_name}<br>"
-            if recipient_email:
-                ner_info += f"<strong>Recipient Email:</strong> {recipient_email}<br>"
-            # if recipient_name:
-            #     ner_info += f"<strong>Recipient Name:</strong> {recipient_name}<br>"
-            if ner_persons:
-                ner_info += f"<strong>NER Persons:</strong> {ner_persons}<br>"
-            if ner_organisations:
-                ner_info += f"<strong>NER Organisations:</strong> {ner_organisations}<br>"
-            if ner_locations:
-                ner_info += f"<strong>NER Locations:</strong> {ner_locations}<br>"
-            if ner_miscellaneous:
-                ner_info += f"<strong>NER Miscellaneous:</strong> {ner_miscellaneous}<br>"
-            if topic_representation:
-                ner_info += f"<strong>Topic Representation:</strong> {topic_representation}<br>"
-            # if estimated_creation_date:
-            #     ner_info += f"<strong>Estimated Creation Date:</strong> {estimated_creation_date}<br>"
+            ner_info = "".join(f"<strong>{label}:</strong> {value}<br>" for label, value in ner_lines(metadata))
 
             # Then build the summary block
             summary = f"""
@@ -158,33 +190,7 @@ def generate_html():
         <meta name="viewport" content="width=device-width, initial-scale=1.0">
         <title>File and Folder Structure {collection_name}</title>
         
-        <style>
-            body {{ font-family: Arial, sans-serif; }}
-            h2 {{background: lightblue; padding: 5px 10px;}}
-            ul {{ list-style-type: none; }}
-            .folder {{ cursor: pointer; font-weight: bold; color: #007BFF; border: 1px solid grey; background: snow; width: 100%; padding: 5px 10px; font-family: Courier New, monospace;}}
-            .nested {{ display: none; margin-left: 30px; padding: 5px 5px;}}
-            .metadata {{ font-size: 0.9em; color: #666; margin-left: 30px; position: relative; padding: 5px 5px; border: 1px solid #ccc;}}
-            .file {{font-family: Courier New, monospace; font-weight: bold;}}
-        
-            .ner-info {{
-                display: none;
-                background-color: #f9f9f9;
-                border: 1px solid #ccc;
-                opacity: 0.9;
-                padding: 8px;
-                position: absolute;
-                top: 10%;
-                left: 3%;
-                z-index: 10;
-                min-width: 250px;
-                box-shadow: 0 2px 5px rgba(0,0,0,0.2);
-            }}
-        
-            .metadata:hover .ner-info {{
-                display: block;
-            }}
-        </style>
+        {PAGE_STYLE}
 
         <script>
             function toggleFolder(element) {{
@@ -212,5 +218,185 @@ def generate_html():
     print(f"\n\nHTML file generated: {html_filename}")
 
 
+def path_level(path):
+    """The level of a path in the hierarchy built above, e.g. 0 for 'media' and 1 for 'media/henk'."""
+    return len(os.path.normpath(path.strip("/")).split("/")) - 1
+
+
+def shard_id(folder_path):
+    return hashlib.md5(folder_path.encode("utf-8")).hexdigest()[:16]
+
+
+def browser_entry(doc):
+    """Describes a file or folder as it is listed in the folder file of its parent."""
+    file_path = doc.get("file_path", "")
+    metadata = extract_metadata(doc)
+    is_folder = doc.get("file_name") == "folder_summary" or file_path.endswith("/")
+    entry = {
+        "name": os.path.basename(file_path.rstrip("/")),
+        "path": os.path.normpath(file_path.strip("/")).replace(hidden_path_prefix, ""),
+        "summary": safe_join(metadata.get("summary", [])),
+        "topic_label": safe_join(metadata.get("Topic_label", [])),
+        "ner": ner_lines(metadata),
+    }
+    if is_folder:
+        entry["shard"] = shard_id(file_path)
+    return entry
+
+
+def write_shard(shard_dir, shard, entries):
+    """Writes the entries of one folder as a script, which also works when the page is opened from disk."""
+    entries.sort(key=lambda entry: entry["path"])
+    with open(os.path.join(shard_dir, f"{shard}.js"), "w", encoding="utf-8") as file:
+        file.write(f"loadShard({json.dumps(shard)}, {json.dumps(entries, ensure_ascii=False)});\n")
+
+
+LAZY_SCRIPT = """
+            var shards = {};
+
+            function loadShard(id, entries) {
+                shards[id] = entries;
+                var container = document.getElementById("shard-" + id);
+                if (container) {
+                    renderEntries(container, entries);
+                }
+            }
+
+            function requestShard(id, container) {
+                container.id = "shard-" + id;
+                if (shards[id]) {
+                    renderEntries(container, shards[id]);
+                    return;
+                }
+                var script = document.createElement("script");
+                script.src = "shards/" + id + ".js";
+                document.head.appendChild(script);
+            }
+
+            function addElement(parent, tag, className, text) {
+                var element = document.createElement(tag);
+                if (className) { element.className = className; }
+                if (text) { element.textContent = text; }
+                parent.appendChild(element);
+                return element;
+            }
+
+            function renderEntries(container, entries) {
+                container.textContent = "";
+                entries.forEach(function (entry) {
+                    var item = addElement(addElement(container, "ul"), "li");
+                    var name = addElement(item, "span", entry.shard ? "folder" : "file", entry.name);
+                    if (entry.shard) {
+                        name.dataset.shard = entry.shard;
+                        name.onclick = function () { toggleFolder(name); };
+                    }
+                    var metadata = addElement(item, "div", "metadata");
+                    addElement(addElement(metadata, "div"), "strong", "", "Summary:").after(" " + entry.summary);
+                    addElement(addElement(metadata, "div"), "strong", "", "Topic Label:").after(" " + entry.topic_label);
+                    addElement(addElement(metadata, "div"), "i", "", "Path:").after(" " + entry.path);
+                    var nerInfo = addElement(metadata, "div", "ner-info");
+                    entry.ner.forEach(function (line) {
+                        addElement(nerInfo, "strong", "", line[0] + ":").after(" " + line[1]);
+                        addElement(nerInfo, "br");
+                    });
+                    if (entry.shard) {
+                        addElement(item, "div", "nested");
+                    }
+                });
+            }
+
+            function toggleFolder(element) {
+                var nested = element.nextElementSibling.nextElementSibling;
+                if (!nested.dataset.loaded) {
+                    nested.dataset.loaded = "true";
+                    requestShard(element.dataset.shard, nested);
+                }
+                if (nested.style.display === "block") {
+                    nested.style.display = "none";
+                } else {
+                    nested.style.display = "block";
+                }
+            }
+"""
+
+
+def generate_lazy_html():
+    """
+    Generates the archive browser as a small HTML page plus one file per folder in a 'shards' directory.
+
+    The records are streamed grouped by parent_path, and the file of a folder is written as soon as all of its
+    children have been read, so memory use doesn't grow with the size of the collection. The page loads the
+    file of a folder when the folder is opened.
+    """
+    client = MongoClient("mongodb://localhost:27017/")
+    db = client[database_name]
+    collection = db[collection_name]
+
+    # Records are grouped by parent_path, make sure every record has it
+    backfill_path_fields(collection)
+    create_path_indexes(collection)
+
+    browser_dir = f"data/browser_files/{collection_name}_browser"
+    shard_dir = os.path.join(browser_dir, "shards")
+    os.makedirs(shard_dir, exist_ok=True)
+
+    projection = {"extracted_text": 0, "embeddings": 0}
+    cursor = collection.find({"parent_path": {"$ne": None}}, projection).sort("parent_path", 1)
+
+    root_entries = []  # the entries shown when the page opens
+    current_parent = None
+    entries = []
+    shard_count = 0
+    for doc in cursor:
+        parent_path = doc["parent_path"]
+        if parent_path != current_parent:
+            if entries and path_level(current_parent) >= skip_levels:
+                write_shard(shard_dir, shard_id(current_parent), entries)
+                shard_count += 1
+            current_parent = parent_path
+            entries = []
+
+        entry = browser_entry(doc)
+        if path_level(doc["file_path"]) == skip_levels:
+            root_entries.append(entry)
+        entries.append(entry)
+
+    if entries and path_level(current_parent) >= skip_levels:
+        write_shard(shard_dir, shard_id(current_parent), entries)
+        shard_count += 1
+    write_shard(shard_dir, "root", root_entries)
+    client.close()
+
+    html_content = f"""
+    <!DOCTYPE html>
+    <html lang="en">
+    <head>
+        <meta charset="UTF-8">
+        <meta name="viewport" content="width=device-width, initial-scale=1.0">
+        <title>File and Folder Structure {collection_name}</title>
+
+        {PAGE_STYLE}
+
+        <script>{LAZY_SCRIPT}</script>
+    </head>
+    <body>
+        <h2>MODAL archive browser {collection_name}</h2>
+        <p>Klik op de naam van een folder om te openen, hou je muis over metadata voor meer info.</p>
+        <div id="browser"></div>
+        <script>requestShard("root", document.getElementById("browser"));</script>
+    </body>
+    </html>
+    """
+
+    html_filename = os.path.join(browser_dir, "index.html")
+    with open(html_filename, "w", encoding="utf-8") as file:
+        file.write(html_content)
+    print(f"\n\nHTML file generated: {html_filename} ({shard_count} folder files)")
+
+
 # Run the script
-generate_html()
\ No newline at end of file
+if __name__ == "__main__":
+    if lazy_browser:
+        generate_lazy_html()
+    else:
+        generate_html()
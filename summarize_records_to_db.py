@@ -1,9 +1,11 @@
-from collections import Counter
-from pymongo import MongoClient
+from collections import Counter, defaultdict
+from pymongo import MongoClient, UpdateOne
 from urllib.parse import unquote
 import os
 import re
 from datetime import datetime  # For enrichment date
+from create_folder_hierarchy import parent_folder
+from heavy_hitters import SpaceSaving
 # from create_folder_hierarchy import create_folder_records
 
 
@@ -16,11 +18,19 @@ client = MongoClient("mongodb://localhost:27017/")  # Adjust if necessary
 db = client[database_name]
 collection = db[collection_name]
 
+# Enrichment fields to summarize, mapped to the key used in the folder enrichment record
+SUMMARY_FIELDS = {
+    "NER_persons": "NER_persons",
+    "NER_organisations": "NER_organisations",
+    "NER_locations": "NER_locations",
+    "NER_miscellaneous": "NER_miscellaneous",
+    "Topic_representation": "TOPIC_representation",
+    "Topic_label": "TOPIC_label",
+}
+top_n = 20  # Number of most common values kept per field
+sketch_capacity = None  # None counts exactly; e.g. 1000 keeps at most that many values per field and folder
+                        # (approximate Space-Saving counts, see heavy_hitters.py), for very large archives
 
-def escape_regex_chars(text):
-    """Escape special regex characters in a string."""
-    special_chars = '[\\^$.|?*+(){}'
-    return ''.join('\\' + char if char in special_chars else char for char in text)
 
 def extract_ner_data(enrichments, field_name):
     """Extracts NER data from any enrichment element that contains it."""
@@ -39,110 +49,116 @@ def extract_ner_data(enrichments, field_name):
     return extracted_values
 
 
+
+
+def new_folder_counters():
+    if sketch_capacity:
+        return {field: SpaceSaving(sketch_capacity) for field in SUMMARY_FIELDS}
+    return {field: Counter() for field in SUMMARY_FIELDS}
+
+
+def report_error_bounds(folder_counters):
+    """Prints how far the approximate counts may be off, for the folder with the largest bound."""
+    bounds = [(counter.error_bound, folder, field) for folder, counters in folder_counters.items()
+              for field, counter in counters.items()]
+    if bounds:
+        bound, folder, field = max(bounds)
+        print(f"Approximate counts (Space-Saving, {sketch_capacity} values per field): counts are at most "
+              f"{bound:.0f} too high (total / {sketch_capacity}), largest for {field} in '{folder}'")
+
+
+def collect_folder_counters():
+    """Streams the collection once and counts the enrichments of each document in its parent folder."""
+    projection = {"file_path": 1, "parent_path": 1}
+    projection.update({f"enrichments.{field}": 1 for field in SUMMARY_FIELDS})
+
+    folder_counters = defaultdict(new_folder_counters)
+    doc_count = 0
+    cursor = collection.find(
+        {"file_name": {"$ne": "folder_summary"}, "enrichments": {"$exists": True}},
+        projection,
+        batch_size=1000
+    )
+    for doc in cursor:
+        folder = doc.get("parent_path") or parent_folder(doc.get("file_path", ""))
+        if folder is None:
+            continue
+        doc_count += 1
+        if doc_count % 10000 == 0:
+            print(f"Counted {doc_count} documents")
+
+        enrichments = doc.get("enrichments", [])
+        counters = folder_counters[folder]
+        for field in SUMMARY_FIELDS:
+            counters[field].update(extract_ner_data(enrichments, field))
+
+    print(f"Counted {doc_count} documents in {len(folder_counters)} folders")
+    return folder_counters
+
+
+def rollup_folder_counters(folder_counters):
+    """Merges the counters of every folder into its parent, deepest folders first."""
+    folders_by_depth = defaultdict(set)
+    for folder in folder_counters:
+        folders_by_depth[folder.count("/")].add(folder)
+
+    depth = max(folders_by_depth, default=0)
+    while depth > 0:
+        for folder in folders_by_depth.pop(depth, ()):
+            parent = parent_folder(folder)
+            if parent is None:
+                continue
+            # Parent folders without documents of their own still receive their children's counts
+            folders_by_depth[depth - 1].add(parent)
+            parent_counters = folder_counters[parent]
+            for field, counter in folder_counters[folder].items():
+                parent_counters[field].update(counter)
+        depth -= 1
+
+    return folder_counters
+
+
+def build_enrichment_record(counters):
+    """Prepares the folder enrichment record with the most common values of each field."""
+    enrichment_record = {
+        "model_used": "summarizer",
+        "enrichment_date": datetime.now().isoformat(),
+    }
+    for field, summary_field in SUMMARY_FIELDS.items():
+        enrichment_record[summary_field] = [value for value, _ in counters[field].most_common(top_n)]
+    return enrichment_record
+
+
 def summarize_records():
-    all_folder_docs = list(collection.find({'file_name': 'folder_summary','enrichments': {'$exists': 0}}))
-    print(len(all_folder_docs))
-    counter = 0
-    total = len(all_folder_docs)
+    folder_counters = rollup_folder_counters(collect_folder_counters())
+    if sketch_capacity:
+        report_error_bounds(folder_counters)
+
+    # Select all records representing a folder and missing enrichments
+    all_folder_docs = collection.find({'file_name': 'folder_summary', 'enrichments': {'$exists': 0}}, {"file_path": 1})
 
-    all_folder_paths = []
+    requests = []
     for folder_doc in all_folder_docs:
-        counter = counter + 1
-        print(f"Folder {counter} of {total}")
-        # Get the file_path and split it into levels
-        # file_path = doc.get("file_path", "").split(path_start_to_ignore)[-1]
         folder_path = folder_doc.get("file_path")
-        print(folder_path)
-        all_folder_paths.append(folder_path)
-
-    for path in all_folder_paths:
-        print(f"\nProcessing Path: {path}")
-        
-        # Escape special characters in path and create a safe regex pattern
-        escaped_path = escape_regex_chars(path)
-        regex = f"^{escaped_path}[^/]*$"
-
-        # Query MongoDB for documents where the `file_path` matches the regex
-        docs = list(collection.find({
-            "file_path": {"$regex": regex},
-            "enrichments": {"$exists": True}
-        }))
-        # docs = list(collection.find({"file_path": {"$regex": regex}}))
-
-        # Summarize the number of documents found for this path
-        print(f"Found {len(docs)} documents for {path}")
-
-        # get the metadata
-        NER_persons = []
-        NER_organisations = []
-        NER_locations = []
-        NER_miscellaneous = []
-        Topic_representation = []
-        Topic_label = []
-
-        for doc in docs:
-            enrichments = doc.get("enrichments", [])
-
-            ner_persons = extract_ner_data(enrichments, "NER_persons")
-            NER_persons = NER_persons + ner_persons
-
-            ner_organisations = extract_ner_data(enrichments, "NER_organisations")
-            NER_organisations = NER_organisations + ner_organisations
-
-            ner_locations = extract_ner_data(enrichments, "NER_locations")
-            NER_locations = NER_locations + ner_locations
-
-            ner_miscellaneous = extract_ner_data(enrichments, "NER_miscellaneous")
-            NER_miscellaneous = NER_miscellaneous + ner_miscellaneous
-
-            topic_representation = extract_ner_data(enrichments, "Topic_representation")
-            Topic_representation = Topic_representation + topic_representation
-
-            topic_label = extract_ner_data(enrichments, "Topic_label")
-            Topic_label = Topic_label + topic_label
-
-
-
-        # get top20
-        NER_persons_counter = Counter(NER_persons)
-        NER_persons_top20 = NER_persons_counter.most_common(20)
-        NER_organisations_counter = Counter(NER_organisations)
-        NER_organisations_top20 = NER_organisations_counter.most_common(20)
-        NER_locations_counter = Counter(NER_locations)
-        NER_locations_top20 = NER_locations_counter.most_common(20)
-        NER_miscellaneous_counter = Counter(NER_miscellaneous)
-        NER_miscellaneous_top20 = NER_miscellaneous_counter.most_common(20)
-        Topic_representation_counter = Counter(Topic_representation)
-        Topic_representation_top20 = Topic_representation_counter.most_common(20)
-        Topic_label_counter = Counter(Topic_label)
-        Topic_label_top20 = Topic_label_counter.most_common(20)
-
-
-                # Prepare the enrichment record
-        enrichment_record = {
-            "model_used": "summarizer",
-            "enrichment_date": datetime.now().isoformat(),
-            "NER_persons": [person for person, _ in NER_persons_top20],
-            "NER_organisations": [organisation for organisation, _ in NER_organisations_top20],
-            "NER_locations": [location for location, _ in NER_locations_top20],
-            "NER_miscellaneous": [miscellaneous for miscellaneous, _ in NER_miscellaneous_top20],
-            "TOPIC_representation": [representation for representation, _ in Topic_representation_top20],
-            "TOPIC_label": [label for label, _ in Topic_label_top20]
-        }
+        counters = folder_counters.get(folder_path) or new_folder_counters()
 
         # Append the enrichment to the `enrichments` array
-        collection.update_one(
-            {"file_path": path},
+        requests.append(UpdateOne(
+            {"_id": folder_doc["_id"]},
             {
-                "$push": {"enrichments": enrichment_record},  # Append to enrichments array
+                "$push": {"enrichments": build_enrichment_record(counters)},
                 "$set": {"file_name": "folder_summary"}  # Ensure correct file_name is set
-            },
-            upsert=False  # Create the record if it doesn't exist
-        )
+            }
+        ))
 
+    print(f"Writing enrichments for {len(requests)} folders")
+    if requests:
+        result = collection.bulk_write(requests, ordered=False)
+        print(f"Updated {result.modified_count} folder records")
 
 
-# paths = create_folder_records()
-# print(f"Paths: {paths}")
-print("\n\nStarting summarization process... This may take a while. Please be patient. :)")
-summarize_records()
\ No newline at end of file
+if __name__ == "__main__":
+    # paths = create_folder_records()
+    # print(f"Paths: {paths}")
+    print("\n\nStarting summarization process... This may take a while. Please be patient. :)")
+    summarize_records()
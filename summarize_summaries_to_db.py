@@ -1,9 +1,11 @@
 from transformers import pipeline, AutoTokenizer, AutoModelForCausalLM
 import torch
-from pymongo import MongoClient
+from pymongo import MongoClient, UpdateOne
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 import logging
-import re
+from create_folder_hierarchy import backfill_path_fields, create_path_indexes, folder_depth
 
 database_name = "MODAL_data"  # Replace with your database name
 collection_name = "collection_name"  # Replace with your collection name
@@ -19,18 +21,21 @@ device = "cuda:0" if torch.cuda.is_available() else "cpu"
 model_name = "google/gemma-3-1b-it"
 # model_name = "google/gemma-3-4b-it"
 
-# Load model in 8-bit precision
-model = AutoModelForCausalLM.from_pretrained(model_name)
-tokenizer = AutoTokenizer.from_pretrained(model_name)
+batch_size = 8  # Number of prompts generated together
+sort_window = 256  # Number of folder prompts sorted by token length before they are split into batches
+max_workers = 8  # Number of threads reading the summaries of folders in the same wave
 
-pipe = pipeline("text-generation", model=model_name, torch_dtype=torch.bfloat16, max_new_tokens=100, device=device)
+# Load the model once and share it with the pipeline
+model = AutoModelForCausalLM.from_pretrained(model_name, torch_dtype=torch.bfloat16)
+tokenizer = AutoTokenizer.from_pretrained(model_name)
+tokenizer.padding_side = "left"  # decoder-only models continue after the prompt, so pad on the left
+if tokenizer.pad_token is None:
+    tokenizer.pad_token = tokenizer.eos_token
 
+pipe = pipeline("text-generation", model=model, tokenizer=tokenizer, max_new_tokens=100, device=device)
 
-def summarize_summaries(summaries): #concatenate
-    summarized = ""
-    file_count = 0
-    error_count = 0
 
+def build_prompt(summaries):
     message = [
         {
             "role": "system",
@@ -42,113 +47,156 @@ def summarize_summaries(summaries): #concatenate
         }
     ]
 
-    prompt = pipe.tokenizer.apply_chat_template(message, tokenize=False, add_generation_prompt=True)
+    return pipe.tokenizer.apply_chat_template(message, tokenize=False, add_generation_prompt=True)
+
+
+def summarize_summaries(prompts):
+    """Generates a summary for every prompt, batch_size prompts at a time."""
+    summarized = [""] * len(prompts)
     try:
         outputs = pipe(
-            prompt,
+            prompts,
+            batch_size=batch_size,
             do_sample=True,
             temperature=0.1,
             top_k=20,
             top_p=0.1,
         )
+    except RuntimeError as e:
+        if len(prompts) == 1:
+            logging.error(f"Error processing text from file: {e}")
+            return summarized
+        # Retry one prompt at a time, so a single failing prompt doesn't lose the whole batch
+        logging.error(f"Error processing batch, retrying prompts separately: {e}")
+        return [summarize_summaries([prompt])[0] for prompt in prompts]
+
+    for i, (prompt, output) in enumerate(zip(prompts, outputs)):
+        if not output or "generated_text" not in output[0]:
+            logging.error(f"Unexpected model output: {output}")
+            continue
+        summarized[i] = output[0]["generated_text"][len(prompt):].replace('#', '')
+    return summarized
 
-        if not outputs or "generated_text" not in outputs[0]:
-            logging.error(f"Unexpected model output: {outputs}")
-            # continue  # Skip to the next record
 
-        summarized = outputs[0]["generated_text"][len(prompt):].replace('#', '')
-        # extracted_response = extract_model_reply(response)
-        # print(f"\nExtracted response: {summarized}")
-        file_count += 1
-        # print(f"Files processed: {file_count}")
-        # print("--------------------------------")
-    except RuntimeError as e:
-        logging.error(f"Error processing text from file: {e}")
-        error_count += 1
-        print(f"Errors encountered: {error_count}")
-        # continue
+def enrichment_update(path, summarized):
+    # Prepare the enrichment record
+    enrichment_record = {
+        "model_used": model_name,
+        "enrichment_date": datetime.now().isoformat(),
+        "summary": summarized
+    }
+
+    # Append the enrichment to the `enrichments` array
+    return UpdateOne(
+        {"file_path": path},
+        {
+            "$push": {"enrichments": enrichment_record},
+            "$set": {"file_name": "folder_summary"}
+        },
+        upsert=False  # Create the record if it doesn't exist
+    )
+
+
+def summarize_pending(pending):
+    """
+    Summarizes the (path, prompt) pairs of a window of folders and writes the results.
+
+    The prompts are sorted by token length, so every batch is padded to a similar length. The summaries of
+    each batch are written before the next batch starts: a folder is only selected again while its summary
+    is missing, so an interrupted run resumes with the folders that weren't finished.
+    """
+    pending = sorted(pending, key=lambda item: len(tokenizer(item[1]).input_ids))
+    for start in range(0, len(pending), batch_size):
+        batch = pending[start:start + batch_size]
+        summaries = summarize_summaries([prompt for _, prompt in batch])
+        collection.bulk_write([enrichment_update(path, summarized)
+                               for (path, _), summarized in zip(batch, summaries)], ordered=False)
+        for (path, _), summarized in zip(batch, summaries):
+            print(f"\nsummarized {path}: {summarized}")
+
+
+def collect_folder_summaries(path):
+    """Concatenates the summaries of the files and folders directly inside a folder."""
+    # Query MongoDB for the files and folders whose parent is this folder
+    docs = collection.find({
+          "parent_path": path,
+          "enrichments.summary": {"$exists": True}
+      }, {"enrichments.summary": 1})
+
+    # get the summaries
+    summary_list = "" #concatenate all summaries
+    summaries_counter = 0
+    for doc in docs:
+        enrichments = doc.get("enrichments", [])
+
+        for enrichment in enrichments:
+            if "summary" in enrichment:
+                summary = enrichment["summary"]
+                if len(summary) > 10:  # summary must exist
+                    summaries_counter = summaries_counter + 1
+                    if summaries_counter < 30:
+                        summary_list += summary + "\n "
+                    else:
+                        # print("reached max of 30 summaries to summarize. \n")
+                        continue
+                else:
+                    continue
+
+    # Summarize the number of summaries found for this path
+    print(f"Found {summaries_counter} summaries for {path}")
+    return path, summaries_counter, summary_list[:5000]  # limit to max X characters
+
+
+def summarize_wave(folder_paths, executor):
+    """
+    Summarizes folders of the same depth. None of them contains another, so their child summaries are read
+    in parallel, one window ahead of the window that is being generated.
+    """
+    windows = [folder_paths[start:start + sort_window] for start in range(0, len(folder_paths), sort_window)]
+    next_results = executor.map(collect_folder_summaries, windows[0])
+
+    for window_number in range(len(windows)):
+        results = list(next_results)
+        if window_number + 1 < len(windows):
+            next_results = executor.map(collect_folder_summaries, windows[window_number + 1])
+
+        pending = []  # folders waiting for a generated summary
+        direct_updates = []
+        for path, summaries_counter, summary_list_short in results:
+            if summary_list_short == "":
+                direct_updates.append(enrichment_update(path, ""))
+            elif summaries_counter == 1:  # don't summarize if there's only one summary
+                direct_updates.append(enrichment_update(path, summary_list_short))
+            else:
+                pending.append((path, build_prompt(summary_list_short)))
+
+        if direct_updates:
+            collection.bulk_write(direct_updates, ordered=False)
+        if pending:
+            summarize_pending(pending)
 
-    return summarized
 
 def summarize_records():
+    # Child lookups use parent_path, make sure recently added records have it
+    backfill_path_fields(collection)
+    create_path_indexes(collection)
+
     # Select all records representing a folder and missing a summary
-    all_folder_docs = list(collection.find({"$and": [{"file_name":"folder_summary"},{"enrichments.summary":{"$exists":0}}]}))
+    all_folder_docs = collection.find({"$and": [{"file_name":"folder_summary"},{"enrichments.summary":{"$exists":0}}]}, {"file_path": 1, "depth": 1})
     # all_folder_docs = list(collection.find({'file_path': '/media/henk/LaCie/2025_MODAL/LH/UitgeverijVrijdag/Acq_lh_179_Uitgeverij Vrijdag N.V/Uitgeverij Vrijdag N.V/Uitgeverij Vrijdag - Hoofdmap/vrijdag/_W.I.P/C/Caron, Bart/Vanop de frontlijn (Caron, Bart & Redig, Guy)/DRUKKLAAR/'}))
-    print(len(all_folder_docs))
-    all_folder_paths = []
+
+    # Deepest folders first: a folder is only summarized once all of its subfolders have a summary
+    waves = defaultdict(list)
     for folder_doc in all_folder_docs:
         folder_path = folder_doc.get("file_path","")
-        print("paths of records representing a folder:")
-        print(folder_path)
-        all_folder_paths.append(folder_path)
-
-    for path in all_folder_paths:
-        print(f"\nProcessing Path: {path}")
-
-        # Escape special regex characters in the path
-        escaped_path = re.escape(path)
-        # Match file_path strings that start with 'path' and do not contain additional forward slashes
-        regex = f"^{escaped_path}([^/]*|[^/]+/)$"
-
-        # Query MongoDB for documents
-        docs = list(collection.find({
-              "file_path": {"$regex": regex},
-              "enrichments.summary": {"$exists": True}
-          }))
-
-        # Summarize the number of documents found for this path
-        print(f"Found {len(docs)} documents for {path}")
-
-        # get the summaries
-        summary_list = "" #concatenate all summaries
-        print("selecting summaries:")
-        summaries_counter = 0
-        for doc in docs:
-            enrichments = doc.get("enrichments", [])
-            file_name = doc.get("file_name")
-
-            for enrichment in enrichments:
-                if "summary" in enrichment:
-                    summary = enrichment["summary"]
-                    if len(summary) > 10:  # summary must exist
-                        summaries_counter = summaries_counter + 1
-                        if summaries_counter < 30:
-                            summary_list += summary + "\n "
-                            print(f"summary {summaries_counter}: {summary}")
-                        else:
-                            # print("reached max of 30 summaries to summarize. \n")
-                            continue
-                    else:
-                        print("empty summary, skipping..")
-                        continue
-
-        summary_list_short = summary_list[:5000]  # limit to max X characters
-
-        if summary_list_short == "":
-            summarized = ""
-        elif summaries_counter == 1:  # don't summarize if there's only one summary
-            summarized = summary_list_short
-        else:
-            summarized = summarize_summaries(summary_list_short)
-        print(f"\nsummarized: {summarized}")
-
-        # Prepare the enrichment record
-        enrichment_record = {
-            "model_used": model_name,
-            "enrichment_date": datetime.now().isoformat(),
-            "summary": summarized
-        }
+        waves[folder_doc.get("depth", folder_depth(folder_path))].append(folder_path)
+    print(f"{sum(len(paths) for paths in waves.values())} folders to summarize in {len(waves)} waves")
 
-
-        # Append the enrichment to the `enrichments` array
-        collection.update_one(
-            {"file_path": path},
-            {
-                "$push": {"enrichments": enrichment_record},
-                "$set": {"file_name": "folder_summary"}
-            },
-            upsert=False  # Create the record if it doesn't exist
-        )
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for depth in sorted(waves, reverse=True):
+            print(f"\nProcessing {len(waves[depth])} folders at depth {depth}")
+            summarize_wave(waves[depth], executor)
 
 
-summarize_records()
\ No newline at end of file
+if __name__ == "__main__":
+    summarize_records()
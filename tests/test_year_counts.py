@@ -0,0 +1,61 @@
+# Compares the aggregation pipeline of year_counts.py with the Python fallback. The pipeline needs a MongoDB
+# server ($convert isn't supported by mongomock), so the comparison is skipped when none is reachable.
+
+import uuid
+from datetime import datetime
+
+import numpy as np
+import pytest
+from pymongo import MongoClient
+from pymongo.errors import PyMongoError
+
+from year_counts import count_fields_by_year, document_year
+
+DOCUMENTS = [
+    {"estimated_creation_date": "1990-05-01", "enrichments": [{"NER_persons": ["Ann", "Bob"]}],
+     "recipient_name": [" Ann ", "", "Henk Pearce"]},
+    {"estimated_creation_date": datetime(1991, 1, 2), "enrichments": [{"NER_persons": ["Ann"]}],
+     "recipient_name": ["Bob"]},
+    {"estimated_creation_date": "0000", "enrichments": [{"NER_persons": ["Cas"]}], "recipient_name": ["Cas"]},
+    {"estimated_creation_date": "0000-00-00", "enrichments": [{"NER_persons": ["Ann"]}]},
+    {"estimated_creation_date": "N/A", "enrichments": [{"NER_persons": ["Dirk"]}]},
+    {"estimated_creation_date": "unknown", "enrichments": [{"NER_persons": ["Dirk"]}]},
+    {"estimated_creation_date": "", "recipient_name": ["Dirk"]},
+    {"enrichments": [{"NER_persons": ["Dirk"]}]},
+    {"estimated_creation_date": "1990", "enrichments": [], "recipient_name": "not a list"},
+]
+FIELDS = {"NER_persons": "enrichments", "recipient_name": "document"}
+
+
+@pytest.fixture
+def collection():
+    client = MongoClient("mongodb://localhost:27017/", serverSelectionTimeoutMS=1000)
+    try:
+        client.admin.command("ping")
+    except PyMongoError:
+        pytest.skip("no MongoDB server reachable")
+    collection = client["year_counts_test"][f"documents_{uuid.uuid4().hex}"]
+    collection.insert_many([dict(document) for document in DOCUMENTS])
+    yield collection
+    collection.drop()
+    client.close()
+
+
+def test_document_year_keeps_year_zero():
+    assert document_year({"estimated_creation_date": "0000-00-00"}) == 0
+    assert document_year({"estimated_creation_date": "N/A"}) is None
+
+
+@pytest.mark.parametrize("sketch_capacity", [None, 10])
+def test_aggregation_matches_python_counts(collection, sketch_capacity):
+    aggregated = count_fields_by_year(collection, FIELDS, name_filter="pearce", sketch_capacity=sketch_capacity)
+    streamed = count_fields_by_year(collection, FIELDS, name_filter="pearce", use_aggregation=False,
+                                    sketch_capacity=sketch_capacity)
+    assert 0 in aggregated["NER_persons"][1]
+    for field in FIELDS:
+        (items, years, matrix, totals), (expected_items, expected_years, expected_matrix, expected_totals) = (
+            aggregated[field], streamed[field])
+        assert list(items) == list(expected_items)
+        assert list(years) == list(expected_years)
+        assert np.array_equal(matrix.toarray(), expected_matrix.toarray())
+        assert np.array_equal(totals, expected_totals)
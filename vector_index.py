@@ -0,0 +1,309 @@
+# Persistent vector index over the text embeddings of a collection, built from the embedding cache
+# (see embedding_cache.py). Index rows are cache rows, so the cache metadata describes the search results.
+# The index is built once, stored on disk and memory-mapped when loaded, so searches no longer read Mongo.
+# hnswlib is used when it is installed; otherwise a pure NumPy IVF (inverted file) index is built.
+# Searches can be restricted to the rows of a boolean mask (see facet_filters.py); a selective mask is searched
+# exactly over its rows of the normalized embeddings instead of through the index.
+#
+#     python vector_index.py           # build the index
+#     python vector_index.py --update  # add the documents inserted since the last build
+
+import argparse
+import json
+import os
+from datetime import datetime
+
+import numpy as np
+
+from embedding_cache import load_embedding_cache, load_normalized_embeddings
+from search_engine import search_vectors, top_k_indices
+
+try:
+    import hnswlib
+except ImportError:
+    hnswlib = None
+
+database_name = "MODAL_data"  # Replace with your database name
+collection_name = "collection_name"  # Replace with your collection name
+
+INDEX_ROOT = "data/vector_index"
+exact_search_rows = 50000  # Filters selecting at most this many documents are searched exactly
+
+
+def index_directory(db_name, collection_name):
+    return os.path.join(INDEX_ROOT, f"{db_name}_{collection_name}")
+
+
+def normalize_rows(vectors):
+    """Scales every row to unit length, so inner products are cosine similarities."""
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    return vectors / norms
+
+
+def fetch_embeddings(db_name, collection_name, start=0):
+    """Reads the normalized embeddings from the rows `start` onwards of the embedding cache, sorted by _id."""
+    embeddings, metadata = load_embedding_cache(db_name, collection_name)
+    if len(embeddings) <= start:
+        return np.empty((0, 0), dtype=np.float32), metadata
+    return normalize_rows(embeddings[start:]), metadata
+
+
+def save_array(path, array):
+    """Writes an array next to its destination first, so a crash never leaves a half-written index."""
+    tmp_path = path + ".tmp.npy"
+    np.save(tmp_path, array)
+    os.replace(tmp_path, path)
+
+
+def save_json(path, data):
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(data, f)
+    os.replace(tmp_path, path)
+
+
+def kmeans(vectors, n_clusters, iterations=10, sample_size=100000, seed=42):
+    """Spherical k-means on a sample of the (normalized) vectors, returns the normalized centroids."""
+    rng = np.random.default_rng(seed)
+    if len(vectors) > sample_size:
+        vectors = vectors[np.sort(rng.choice(len(vectors), sample_size, replace=False))]
+    centroids = vectors[rng.choice(len(vectors), n_clusters, replace=False)].copy()
+
+    for _ in range(iterations):
+        assignments = assign_to_centroids(vectors, centroids)
+        for cluster in range(n_clusters):
+            members = vectors[assignments == cluster]
+            if len(members):  # empty clusters keep their previous centroid
+                centroids[cluster] = members.sum(axis=0)
+        centroids = normalize_rows(centroids)
+    return centroids
+
+
+def assign_to_centroids(vectors, centroids, chunk_size=65536):
+    assignments = np.empty(len(vectors), dtype=np.int32)
+    for start in range(0, len(vectors), chunk_size):
+        chunk = vectors[start:start + chunk_size]
+        assignments[start:start + chunk_size] = np.argmax(chunk @ centroids.T, axis=1)
+    return assignments
+
+
+def write_ivf_lists(index_dir, centroids, vectors, rows):
+    """Stores the vectors grouped by inverted list, with offsets marking where each list starts."""
+    assignments = assign_to_centroids(vectors, centroids)
+    order = np.argsort(assignments, kind="stable")
+    offsets = np.zeros(len(centroids) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum(np.bincount(assignments, minlength=len(centroids)))
+
+    save_array(os.path.join(index_dir, "ivf_centroids.npy"), centroids)
+    save_array(os.path.join(index_dir, "ivf_vectors.npy"), vectors[order])
+    save_array(os.path.join(index_dir, "ivf_rows.npy"), rows[order])
+    save_array(os.path.join(index_dir, "ivf_offsets.npy"), offsets)
+
+
+def merge_ivf_lists(index_dir, vectors, rows, chunk_size=65536):
+    """
+    Adds vectors to the inverted lists of their nearest centroids. The stored lists are read through memory maps
+    and written list by list with the new vectors appended, so neither is held in memory at once.
+    """
+    centroids = np.load(os.path.join(index_dir, "ivf_centroids.npy"))
+    old_vectors = np.load(os.path.join(index_dir, "ivf_vectors.npy"), mmap_mode="r")
+    old_rows = np.load(os.path.join(index_dir, "ivf_rows.npy"), mmap_mode="r")
+    old_offsets = np.load(os.path.join(index_dir, "ivf_offsets.npy"))
+
+    assignments = assign_to_centroids(vectors, centroids)
+    order = np.argsort(assignments, kind="stable")
+    new_offsets = np.zeros(len(centroids) + 1, dtype=np.int64)
+    new_offsets[1:] = np.cumsum(np.bincount(assignments, minlength=len(centroids)))
+    offsets = old_offsets + new_offsets
+    total = int(offsets[-1])
+
+    merged_vectors = np.lib.format.open_memmap(os.path.join(index_dir, "ivf_vectors.npy.tmp.npy"), mode="w+",
+                                               dtype=np.float32, shape=(total, old_vectors.shape[1]))
+    merged_rows = np.lib.format.open_memmap(os.path.join(index_dir, "ivf_rows.npy.tmp.npy"), mode="w+",
+                                            dtype=np.int64, shape=(total,))
+    for p in range(len(centroids)):
+        start, end = old_offsets[p], old_offsets[p + 1]
+        for chunk_start in range(start, end, chunk_size):
+            chunk_end = min(chunk_start + chunk_size, end)
+            target = offsets[p] + chunk_start - start
+            merged_vectors[target:target + chunk_end - chunk_start] = old_vectors[chunk_start:chunk_end]
+            merged_rows[target:target + chunk_end - chunk_start] = old_rows[chunk_start:chunk_end]
+        added = order[new_offsets[p]:new_offsets[p + 1]]
+        merged_vectors[offsets[p] + end - start:offsets[p + 1]] = vectors[added]
+        merged_rows[offsets[p] + end - start:offsets[p + 1]] = rows[added]
+    merged_vectors.flush()
+    merged_rows.flush()
+    del merged_vectors, merged_rows, old_vectors, old_rows  # Close the memory maps before their files are replaced
+
+    for name in ("vectors", "rows"):
+        os.replace(os.path.join(index_dir, f"ivf_{name}.npy.tmp.npy"), os.path.join(index_dir, f"ivf_{name}.npy"))
+    save_array(os.path.join(index_dir, "ivf_offsets.npy"), offsets)
+
+
+def build_index(db_name, collection_name, index_dir=None, backend=None):
+    """Builds the vector index from the `embeddings[0].text_embeddings` vectors of a collection."""
+    index_dir = index_dir or index_directory(db_name, collection_name)
+    backend = backend or ("hnsw" if hnswlib is not None else "ivf")
+    os.makedirs(index_dir, exist_ok=True)
+
+    vectors, metadata = fetch_embeddings(db_name, collection_name)
+    if not len(vectors):
+        print("No valid embeddings found in the collection.")
+        return None
+    count, dim = vectors.shape
+    print(f"Building {backend} index for {count} documents ({dim} dimensions)")
+
+    info = {"backend": backend, "dim": dim, "count": count, "last_id": metadata["_id"].iloc[count - 1],
+            "built": datetime.now().isoformat()}
+
+    if backend == "hnsw":
+        index = hnswlib.Index(space="ip", dim=dim)
+        index.init_index(max_elements=count, ef_construction=200, M=16)
+        index.add_items(vectors, np.arange(count))
+        index.save_index(os.path.join(index_dir, "hnsw.bin"))
+    else:
+        n_lists = max(1, min(int(np.sqrt(count)), count))
+        info["n_lists"] = n_lists
+        centroids = kmeans(vectors, n_lists)
+        write_ivf_lists(index_dir, centroids, vectors, np.arange(count, dtype=np.int64))
+
+    save_json(os.path.join(index_dir, "info.json"), info)
+    print(f"Index written to '{index_dir}'")
+    return info
+
+
+def index_matches_cache(info, metadata):
+    """
+    Whether the index rows are still rows of the embedding cache: a rebuilt cache (e.g. after a document was
+    deleted or embedded again) shifts its rows, and the index rows would point at other documents.
+    """
+    count = info["count"]
+    return len(metadata) >= count and (count == 0 or metadata["_id"].iloc[count - 1] == info["last_id"])
+
+
+def update_index(db_name, collection_name, index_dir=None):
+    """
+    Adds the cache rows after the last indexed document, without rebuilding the index. An hnsw index grows in
+    place; an IVF update rewrites the full ivf_vectors and ivf_rows files (streamed, see merge_ivf_lists()).
+    """
+    index_dir = index_dir or index_directory(db_name, collection_name)
+    info_file = os.path.join(index_dir, "info.json")
+    if not os.path.exists(info_file):
+        return build_index(db_name, collection_name, index_dir)
+
+    with open(info_file, encoding="utf-8") as f:
+        info = json.load(f)
+    vectors, metadata = fetch_embeddings(db_name, collection_name, start=info["count"])
+
+    if not index_matches_cache(info, metadata):
+        print("The embedding cache was rebuilt, rebuilding the index.")
+        return build_index(db_name, collection_name, index_dir, info["backend"])
+    if not len(vectors):
+        print("Index is up to date.")
+        return info
+    print(f"Adding {len(vectors)} documents to the {info['backend']} index")
+
+    count = info["count"]
+    rows = np.arange(count, count + len(vectors), dtype=np.int64)
+    if info["backend"] == "hnsw":
+        index = hnswlib.Index(space="ip", dim=info["dim"])
+        index.load_index(os.path.join(index_dir, "hnsw.bin"), max_elements=count + len(vectors))
+        index.add_items(vectors, rows)
+        index.save_index(os.path.join(index_dir, "hnsw.bin"))
+    else:
+        # New vectors go to their nearest existing list; the centroids are only recomputed by a full build
+        merge_ivf_lists(index_dir, vectors, rows)
+
+    info.update({"count": count + len(vectors), "last_id": metadata["_id"].iloc[-1],
+                 "updated": datetime.now().isoformat()})
+    save_json(info_file, info)
+    return info
+
+
+def load_index(db_name, collection_name, index_dir=None):
+    """
+    Opens an index for searching; the IVF arrays and embeddings are memory-mapped instead of read into memory.
+    An index that no longer lines up with the embedding cache is rebuilt first, so its rows never describe the
+    wrong documents.
+    """
+    index_dir = index_dir or index_directory(db_name, collection_name)
+    with open(os.path.join(index_dir, "info.json"), encoding="utf-8") as f:
+        index = json.load(f)
+    # The embeddings are only read for filtered searches
+    index["corpus"], index["metadata"] = load_normalized_embeddings(db_name, collection_name, refresh=False)
+    if not index_matches_cache(index, index["metadata"]):
+        print("The embedding cache was rebuilt since the index was built, rebuilding the index.")
+        if build_index(db_name, collection_name, index_dir, index["backend"]) is None:
+            raise ValueError("No valid embeddings found in the collection.")
+        return load_index(db_name, collection_name, index_dir)
+
+    if index["backend"] == "hnsw":
+        hnsw = hnswlib.Index(space="ip", dim=index["dim"])
+        hnsw.load_index(os.path.join(index_dir, "hnsw.bin"))
+        index["hnsw"] = hnsw
+    else:
+        for name in ("centroids", "vectors", "rows", "offsets"):
+            index[name] = np.load(os.path.join(index_dir, f"ivf_{name}.npy"), mmap_mode="r")
+    return index
+
+
+def search_index(index, query_vector, top_k=10, n_probe=8, mask=None):
+    """
+    Returns the (rows, scores) of the top_k most similar documents for one query vector, only among the rows
+    selected by the boolean mask if one is given.
+    """
+    query_vector = normalize_rows(np.reshape(query_vector, (1, -1)))[0]
+    mask = None if mask is None else np.asarray(mask[:index["count"]])  # rows added to the cache after the index
+    allowed = index["count"] if mask is None else int(np.count_nonzero(mask))
+    top_k = min(top_k, allowed)
+    if top_k == 0:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+
+    if mask is not None and allowed <= exact_search_rows:
+        rows, scores = search_vectors(query_vector[np.newaxis, :], index["corpus"][:index["count"]], top_k,
+                                      mask=mask)
+        return rows[0], scores[0]
+    # The fraction of the documents a filter keeps: the index has to look further to find top_k of them
+    selectivity = allowed / index["count"]
+
+    if index["backend"] == "hnsw":
+        index["hnsw"].set_ef(max(int(top_k * 4 / selectivity), 50))
+        if mask is None:
+            labels, distances = index["hnsw"].knn_query(query_vector, k=top_k)
+        else:
+            labels, distances = index["hnsw"].knn_query(query_vector, k=top_k, filter=lambda label: mask[label])
+        return indexed_rows(index, labels[0].astype(np.int64), 1 - distances[0])  # "ip" distance is 1 - product
+
+    # Only the vectors in the n_probe lists closest to the query are scored
+    offsets = index["offsets"]
+    n_probe = min(int(np.ceil(n_probe / selectivity)), len(offsets) - 1)
+    probes = np.argsort(index["centroids"] @ query_vector)[::-1][:n_probe]
+    candidates = np.concatenate([np.arange(offsets[p], offsets[p + 1]) for p in probes])
+    if mask is not None:
+        candidates = candidates[mask[index["rows"][candidates]]]
+    if len(candidates) == 0:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+
+    scores = index["vectors"][candidates] @ query_vector
+    best = top_k_indices(scores[np.newaxis, :], top_k)[0]
+    return indexed_rows(index, np.asarray(index["rows"][candidates[best]]), scores[best])
+
+
+def indexed_rows(index, rows, scores):
+    """Drops hits outside the rows the index was built from, which the cache metadata can't describe."""
+    keep = (rows >= 0) & (rows < index["count"])
+    return rows[keep], scores[keep]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build the vector index used by search_semantic.py")
+    parser.add_argument("--update", action="store_true", help="only add documents inserted since the last build")
+    parser.add_argument("--backend", choices=["hnsw", "ivf"], help="defaults to hnsw when hnswlib is installed")
+    args = parser.parse_args()
+
+    if args.update:
+        update_index(database_name, collection_name)
+    else:
+        build_index(database_name, collection_name, backend=args.backend)
@@ -0,0 +1,220 @@
+# Counts how often each item of a field (e.g. a person in NER_persons) occurs per year of estimated_creation_date.
+# Used by report_graph_by_year.py. The counting runs as one aggregation pipeline in MongoDB for all fields, so only
+# the (field, item, year, count) table is sent back; count_fields_by_year(..., use_aggregation=False) reads the
+# documents with a projection and counts them in Python instead, and stream_year_counts() also accepts plain dicts.
+
+import re
+from array import array
+from collections import Counter
+
+import numpy as np
+from scipy import sparse
+
+from heavy_hitters import SpaceSaving
+
+# Year of estimated_creation_date: the first 4 characters as an integer, or null when they aren't a number
+YEAR_EXPRESSION = {"$convert": {
+    "input": {"$substrCP": [
+        {"$convert": {"input": "$estimated_creation_date", "to": "string", "onError": "", "onNull": ""}}, 0, 4
+    ]},
+    "to": "int",
+    "onError": None,
+    "onNull": None
+}}
+
+
+def document_year(document):
+    """Returns the year of estimated_creation_date as an integer, or None if it is missing or invalid."""
+    year = document.get("estimated_creation_date", "")
+    if not year or year == "N/A":
+        return None
+
+    # Try to extract year as integer
+    try:
+        return int(str(year)[:4])  # Take first 4 characters in case date is in full format
+    except (ValueError, TypeError):
+        return None
+
+
+def document_items(document, field, source="enrichments", name_filter=None):
+    """
+    Returns the items of a field in a document.
+
+    Args:
+        document (dict): The MongoDB document.
+        field (str): The field to count, e.g. "NER_persons" or "recipient_name".
+        source (str): "enrichments" reads the field from the first enrichment, "document" from the document
+            itself; document fields are stripped and empty items or items containing name_filter are skipped.
+        name_filter (str): Leave out document items containing this (lowercase) text, e.g. the archive creator.
+    """
+    if source == "enrichments":
+        # Get items from enrichments
+        if ("enrichments" in document and
+                document["enrichments"] and
+                isinstance(document["enrichments"][0].get(field), list)):
+            return document["enrichments"][0][field]
+        return []
+
+    items = document.get(field)
+    if not isinstance(items, list):
+        return []
+    # Clean and normalize the item strings, skip empty strings
+    items = [item.strip() for item in items]
+    return [item for item in items if item and not (name_filter and name_filter in item.lower())]
+
+
+def field_items_expression(field, source):
+    """An array of {f: field, v: item} pairs with the items of one field of a document."""
+    if source == "enrichments":
+        items = {"$let": {"vars": {"first": {"$arrayElemAt": ["$enrichments", 0]}}, "in": f"$$first.{field}"}}
+        value = "$$v"
+    else:
+        items = f"${field}"
+        value = {"$trim": {"input": "$$v"}}
+    return {"$map": {
+        "input": {"$cond": [{"$isArray": items}, items, []]},
+        "as": "v",
+        "in": {"f": field, "v": value}
+    }}
+
+
+def year_count_pipeline(fields, name_filter=None):
+    """
+    The aggregation pipeline that groups the items of several fields by field, item and year on the server,
+    so a single scan of the collection counts all of them.
+
+    Args:
+        fields (dict): The source ("enrichments" or "document", see document_items()) of every field to count.
+        name_filter (str): Leave out document items containing this text.
+    """
+    document_fields = [field for field, source in fields.items() if source != "enrichments"]
+    item_match = {"$ne": ""}
+    if name_filter:
+        item_match["$not"] = re.compile(re.escape(name_filter), re.IGNORECASE)
+
+    pipeline = [
+        {"$match": {"estimated_creation_date": {"$nin": [None, "", "N/A"]}}},
+        {"$project": {
+            "_id": 0,
+            "year": YEAR_EXPRESSION,
+            "pairs": {"$concatArrays": [field_items_expression(field, source) for field, source in fields.items()]}
+        }},
+        {"$match": {"year": {"$ne": None}}},  # Year 0 is kept, as document_year() keeps it
+        {"$unwind": "$pairs"},
+    ]
+    if document_fields:
+        pipeline.append({"$match": {"$or": [{"pairs.f": {"$nin": document_fields}}, {"pairs.v": item_match}]}})
+    pipeline.append({"$group": {"_id": {"f": "$pairs.f", "item": "$pairs.v", "year": "$year"}, "count": {"$sum": 1}}})
+    return pipeline
+
+
+def new_year_counts(sketch_capacity=None):
+    """
+    The (item, year, count) triples counted so far, with the items coded in order of first occurrence, and the
+    exact number of occurrences per year. With a sketch_capacity only the most frequent items are kept, in a
+    Space-Saving sketch with their counts per year (see heavy_hitters.py).
+    """
+    if sketch_capacity:
+        return {"sketch": SpaceSaving(sketch_capacity, track_keys=True), "year_totals": Counter()}
+    return {"codes": {}, "rows": array("q"), "years": array("q"), "counts": array("q"), "year_totals": Counter()}
+
+
+def add_count(counts, item, year, count=1):
+    counts["year_totals"][year] += count
+    if "sketch" in counts:
+        counts["sketch"].add(item, count, key=year)
+        return
+    counts["rows"].append(counts["codes"].setdefault(item, len(counts["codes"])))
+    counts["years"].append(year)
+    counts["counts"].append(count)
+
+
+def sketch_triples(sketch):
+    """The monitored items of a sketch as coded (item, year, count) triples, like new_year_counts()."""
+    counts = new_year_counts()
+    for item, year_counts in sketch.keys.items():
+        for year, count in year_counts.items():
+            add_count(counts, item, year, count)
+    return counts
+
+
+def year_matrix(counts):
+    """
+    Returns (items, years, matrix, year_totals): the sorted items, the sorted years, a sparse CSR matrix with the
+    occurrences of items[i] in years[j] at (i, j), and the occurrences of all items in years[j]. Triples of the
+    same item and year are summed. For a sketch, only the monitored items are in the matrix, with the
+    occurrences counted since they were last monitored (lower bounds of their true counts).
+    """
+    year_totals = counts["year_totals"]
+    if "sketch" in counts:
+        counts = sketch_triples(counts["sketch"])
+
+    items = np.array(list(counts["codes"]), dtype=object)
+    order = np.argsort(items, kind="stable")
+    item_rank = np.empty(len(items), dtype=np.int64)
+    item_rank[order] = np.arange(len(items))
+
+    years = np.array(sorted(year_totals), dtype=np.int64)
+    matrix = sparse.coo_matrix(
+        (np.frombuffer(counts["counts"], dtype=np.int64),
+         (item_rank[np.frombuffer(counts["rows"], dtype=np.int64)],
+          np.searchsorted(years, np.frombuffer(counts["years"], dtype=np.int64)))),
+        shape=(len(items), len(years))
+    ).tocsr()
+    return items[order], years, matrix, np.array([year_totals[year] for year in years], dtype=np.int64)
+
+
+def aggregate_year_counts(collection, fields, name_filter=None, sketch_capacity=None):
+    """Counts the items of several fields per year with one aggregation, see year_count_pipeline()."""
+    counts = {field: new_year_counts(sketch_capacity) for field in fields}
+    for group in collection.aggregate(year_count_pipeline(fields, name_filter), allowDiskUse=True):
+        add_count(counts[group["_id"]["f"]], group["_id"]["item"], group["_id"]["year"], group["count"])
+    return {field: year_matrix(field_counts) for field, field_counts in counts.items()}
+
+
+def stream_year_counts(documents, fields, name_filter=None, sketch_capacity=None):
+    """Counts the items of several fields per year in Python, for any iterable of documents."""
+    counts = {field: new_year_counts(sketch_capacity) for field in fields}
+    for document in documents:
+        year = document_year(document)
+        if year is None:
+            continue
+
+        for field, source in fields.items():
+            # Count occurrences for each item in this document
+            for item in document_items(document, field, source, name_filter):
+                add_count(counts[field], item, year)
+    return {field: year_matrix(field_counts) for field, field_counts in counts.items()}
+
+
+def count_fields_by_year(collection, fields, name_filter=None, use_aggregation=True, sketch_capacity=None):
+    """
+    Counts the items of several fields per year of estimated_creation_date in one scan of the collection.
+
+    Args:
+        collection: The MongoDB collection.
+        fields (dict): The source of every field to count, e.g. {"NER_persons": "enrichments",
+            "recipient_name": "document"}.
+        name_filter (str): Leave out document items containing this (lowercase) text.
+        use_aggregation (bool): Count on the server; False reads the projected documents and counts in Python.
+        sketch_capacity (int): Only keep (about) the sketch_capacity most frequent items per field, in bounded
+            memory; their counts are at most (total occurrences) / sketch_capacity too low. None counts exactly.
+
+    Returns:
+        dict: For every field a tuple (items, years, matrix, year_totals) with the occurrences of items[i] in
+        years[j] in a sparse matrix, and of all items per year, see year_matrix().
+    """
+    if use_aggregation:
+        return aggregate_year_counts(collection, fields, name_filter, sketch_capacity)
+
+    projection = {"_id": 0, "estimated_creation_date": 1}
+    for field, source in fields.items():
+        projection[f"enrichments.{field}" if source == "enrichments" else field] = 1
+    documents = collection.find({}, projection, batch_size=1000)
+    return stream_year_counts(documents, fields, name_filter, sketch_capacity)
+
+
+def count_items_by_year(collection, field, source="enrichments", name_filter=None, use_aggregation=True,
+                        sketch_capacity=None):
+    """Counts the items of one field per year, see count_fields_by_year()."""
+    return count_fields_by_year(collection, {field: source}, name_filter, use_aggregation, sketch_capacity)[field]